@@ -2,12 +2,12 @@ from typing import Any
 
 from sqladmin.fields import FileField
 
-from app.database import get_db
+from app.database import get_db_context
 from app.models import User, Quest, Project, Chain, Wallet, Task
 from fastapi import Request
 from sqladmin import ModelView
 from admin.dependencies import check_admin_access, is_admin
-from s3_manager.routers import upload_any_on_s3
+from s3_manager.routers import upload_any_file, s3_delete_old_files, run_in_background, FILE_PATHS
 
 
 class AdminSchema(ModelView):
@@ -46,10 +46,20 @@ class AdminSchema(ModelView):
 
         await super().after_model_change(data, model, is_created, request)
 
+    async def after_model_delete(self, model: Any, request: Request) -> None:
+        # Картинки удаленного объекта чистятся в фоне, ответ админке их не ждет
+        if self.file_dir in FILE_PATHS:
+            object_path = FILE_PATHS[self.file_dir]['dirname'] + str(model.id)
+            run_in_background(s3_delete_old_files(object_path + '_'))
+            run_in_background(s3_delete_old_files(object_path + '.'))
+
+        await super().after_model_delete(model, request)
+
     async def upload_s3(self, file, request: Request, obj: Any):
         if file and file.size > 0:
-            have_access = is_admin(request)
-            filepath = await upload_any_on_s3(self.file_dir, obj.id, file, next(get_db()), have_access)
+            is_admin(request)
+            with get_db_context() as db:
+                filepath = await upload_any_file(self.file_dir, obj.id, file, db)
             setattr(obj, 'filepath', filepath)
 
 
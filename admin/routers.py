@@ -14,7 +14,7 @@ import os
 
 from admin.crud import get_admin
 from admin.schemes import AdminToken, AdminLogin
-from app.database import SessionLocal, get_db
+from app.database import get_db, get_db_context
 from admin.security import verify_password, create_access_token
 from app.models import Admin
 
@@ -78,6 +78,7 @@ def get_current_admin(token: str = Depends(oauth2_scheme_admin)) -> Admin:
         return None
 
     # Получаем администратора из базы данных
-    admin = get_admin(SessionLocal(), username=username)
+    with get_db_context() as db:
+        admin = get_admin(db, username=username)
 
     return admin
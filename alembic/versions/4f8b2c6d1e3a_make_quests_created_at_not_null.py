@@ -0,0 +1,36 @@
+"""make quests created_at not null
+
+Revision ID: 4f8b2c6d1e3a
+Revises: 9a4d6b2e8f17
+Create Date: 2026-10-19 10:12:37.402815
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4f8b2c6d1e3a'
+down_revision: Union[str, None] = '9a4d6b2e8f17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Квесты без даты создания уходят в начало каталога (и в конец при filter=new)
+UNKNOWN_CREATED_AT = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+quests = sa.table('quests', sa.column('created_at', sa.DateTime(timezone=True)))
+
+
+def upgrade() -> None:
+    # Keyset пагинация сравнивает (created_at, id): строки с NULL не попадали ни на одну страницу
+    op.execute(quests.update().where(quests.c.created_at.is_(None)).values(created_at=UNKNOWN_CREATED_AT))
+    with op.batch_alter_table('quests') as batch_op:
+        batch_op.alter_column('created_at', existing_type=sa.DateTime(timezone=True), nullable=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('quests') as batch_op:
+        batch_op.alter_column('created_at', existing_type=sa.DateTime(timezone=True), nullable=True)
@@ -0,0 +1,125 @@
+"""store ip addresses in binary form
+
+Revision ID: 7c3e5a1f9b28
+Revises: e1f4a7c39d20
+Create Date: 2026-10-18 22:47:03.119845
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from app.ip_types import normalize_ip, ip_to_bytes, ip_from_bytes
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c3e5a1f9b28'
+down_revision: Union[str, None] = 'e1f4a7c39d20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ip_addresses = sa.table('ip_addresses', sa.column('id', sa.Integer), sa.column('ip', sa.String),
+                        sa.column('visited_at', sa.DateTime(timezone=True)),
+                        sa.column('ip_packed', sa.LargeBinary))
+user_ip = sa.table('user_ip', sa.column('user_id', sa.String), sa.column('ip_address_id', sa.Integer))
+
+
+def normalize_rows(bind) -> dict[str, int]:
+    # Невалидные адреса удаляются, записи одного адреса (::ffff:1.2.3.4 и 1.2.3.4) склеиваются в первую
+    kept = {}
+    visited = {}
+    renamed = []
+    removed = []
+    rows = bind.execute(
+        sa.select(ip_addresses.c.id, ip_addresses.c.ip, ip_addresses.c.visited_at).order_by(ip_addresses.c.id)
+    ).all()
+    for ip_address_id, ip, visited_at in rows:
+        normalized = normalize_ip(ip)
+        if normalized is None:
+            removed.append(ip_address_id)
+            continue
+        if normalized in kept:
+            keep_id = kept[normalized]
+            if visited_at is not None and (visited[keep_id] is None or visited_at > visited[keep_id]):
+                visited[keep_id] = visited_at
+                bind.execute(
+                    ip_addresses.update().where(ip_addresses.c.id == keep_id).values(visited_at=visited_at)
+                )
+            bind.execute(user_ip.delete().where(
+                user_ip.c.ip_address_id == ip_address_id,
+                user_ip.c.user_id.in_(sa.select(user_ip.c.user_id).where(user_ip.c.ip_address_id == keep_id))
+            ))
+            bind.execute(
+                user_ip.update().where(user_ip.c.ip_address_id == ip_address_id).values(ip_address_id=keep_id)
+            )
+            removed.append(ip_address_id)
+            continue
+        kept[normalized] = ip_address_id
+        visited[ip_address_id] = visited_at
+        if normalized != ip:
+            renamed.append({'row_id': ip_address_id, 'new_ip': normalized})
+
+    if removed:
+        bind.execute(user_ip.delete().where(user_ip.c.ip_address_id.in_(removed)))
+        bind.execute(ip_addresses.delete().where(ip_addresses.c.id.in_(removed)))
+    if renamed:
+        bind.execute(
+            ip_addresses.update().where(ip_addresses.c.id == sa.bindparam('row_id'))
+            .values(ip=sa.bindparam('new_ip')),
+            renamed
+        )
+    return kept
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    kept = normalize_rows(bind)
+
+    if bind.dialect.name == 'postgresql':
+        op.alter_column('ip_addresses', 'ip',
+                        existing_type=sa.String(length=39),
+                        type_=postgresql.INET(),
+                        postgresql_using='ip::inet')
+        return
+
+    # В остальных БД: 16 байт, IPv4 как IPv4-mapped IPv6 (см. app/ip_types.py)
+    op.add_column('ip_addresses', sa.Column('ip_packed', sa.LargeBinary(length=16), nullable=True))
+    if kept:
+        bind.execute(
+            ip_addresses.update().where(ip_addresses.c.id == sa.bindparam('row_id'))
+            .values(ip_packed=sa.bindparam('packed')),
+            [{'row_id': ip_address_id, 'packed': ip_to_bytes(ip)} for ip, ip_address_id in kept.items()]
+        )
+    op.drop_index('ix_ip_addresses_ip', table_name='ip_addresses')
+    with op.batch_alter_table('ip_addresses') as batch_op:
+        batch_op.drop_column('ip')
+        batch_op.alter_column('ip_packed', new_column_name='ip')
+    op.create_index(op.f('ix_ip_addresses_ip'), 'ip_addresses', ['ip'], unique=True)
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+
+    if bind.dialect.name == 'postgresql':
+        op.alter_column('ip_addresses', 'ip',
+                        existing_type=postgresql.INET(),
+                        type_=sa.String(length=39),
+                        postgresql_using='host(ip)')
+        return
+
+    rows = bind.execute(sa.select(ip_addresses.c.id, ip_addresses.c.ip)).all()
+    op.drop_index('ix_ip_addresses_ip', table_name='ip_addresses')
+    with op.batch_alter_table('ip_addresses') as batch_op:
+        batch_op.alter_column('ip', new_column_name='ip_packed')
+    op.add_column('ip_addresses', sa.Column('ip', sa.String(length=39), nullable=True))
+    if rows:
+        bind.execute(
+            ip_addresses.update().where(ip_addresses.c.id == sa.bindparam('row_id'))
+            .values(ip=sa.bindparam('new_ip')),
+            [{'row_id': ip_address_id, 'new_ip': ip_from_bytes(packed)} for ip_address_id, packed in rows if packed]
+        )
+    with op.batch_alter_table('ip_addresses') as batch_op:
+        batch_op.drop_column('ip_packed')
+    op.create_index(op.f('ix_ip_addresses_ip'), 'ip_addresses', ['ip'], unique=True)
@@ -0,0 +1,69 @@
+"""add expires_at field in tokens
+
+Revision ID: 83ec650e0ef5
+Revises: 8fea5ec9bd36
+Create Date: 2026-10-18 18:20:41.118203
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+import jwt
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '83ec650e0ef5'
+down_revision: Union[str, None] = '8fea5ec9bd36'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+tokens = sa.table(
+    'tokens',
+    sa.column('id', sa.Integer),
+    sa.column('access_token', sa.String),
+    sa.column('expires_at', sa.DateTime(timezone=True)),
+)
+
+
+def get_expires_at(access_token: str) -> datetime:
+    # Подпись здесь не важна - нужен только exp. Токены без exp считаем уже истекшими
+    try:
+        payload = jwt.decode(access_token, options={'verify_signature': False})
+        return datetime.fromtimestamp(payload['exp'], tz=timezone.utc)
+    except Exception:
+        return datetime.now(timezone.utc)
+
+
+def upgrade() -> None:
+    op.add_column('tokens', sa.Column('expires_at', sa.DateTime(timezone=True), nullable=True))
+
+    # Заполняем expires_at для уже выданных токенов
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(tokens.c.id, tokens.c.access_token)
+            .where(tokens.c.id > last_id)
+            .order_by(tokens.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+
+        connection.execute(
+            tokens.update().where(tokens.c.id == sa.bindparam('token_id')).values(expires_at=sa.bindparam('exp')),
+            [{'token_id': token_id, 'exp': get_expires_at(access_token)} for token_id, access_token in rows]
+        )
+        last_id = rows[-1].id
+
+    op.alter_column('tokens', 'expires_at', nullable=False)
+    op.create_index(op.f('ix_tokens_expires_at'), 'tokens', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_tokens_expires_at'), table_name='tokens')
+    op.drop_column('tokens', 'expires_at')
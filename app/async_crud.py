@@ -0,0 +1,45 @@
+from datetime import datetime
+
+from fastapi import HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+from app.crud import quest_detail_stmt, quests_keyset_stmt, count_quests_stmt, chains_by_ids_stmt, \
+    projects_by_ids_stmt, task_counts_stmt
+
+# Асинхронные версии горячих функций из app/crud.py: те же запросы, но через AsyncSession
+
+
+async def get_quest_detail(db: AsyncSession, quest_id: int) -> models.Quest:
+    quest = (await db.execute(quest_detail_stmt(quest_id))).scalar_one_or_none()
+
+    if quest is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Quest not found")
+    return quest
+
+
+async def get_quests_keyset(db: AsyncSession, filter: str = None, after: tuple[datetime, int] = None,
+                            limit: int = 50) -> list[models.Quest]:
+    return list((await db.execute(quests_keyset_stmt(filter, after, limit))).scalars())
+
+
+async def count_quests(db: AsyncSession) -> int:
+    return (await db.execute(count_quests_stmt())).scalar()
+
+
+async def get_chains_by_ids(db: AsyncSession, chain_ids: set[int]) -> dict[int, models.Chain]:
+    if not chain_ids:
+        return {}
+    return {chain.id: chain for chain in (await db.execute(chains_by_ids_stmt(chain_ids))).scalars()}
+
+
+async def get_projects_by_ids(db: AsyncSession, project_ids: set[int]) -> dict[int, models.Project]:
+    if not project_ids:
+        return {}
+    return {project.id: project for project in (await db.execute(projects_by_ids_stmt(project_ids))).scalars()}
+
+
+async def get_task_counts(db: AsyncSession, quest_ids: list[int]) -> dict[int, int]:
+    if not quest_ids:
+        return {}
+    return {quest_id: count for quest_id, count in await db.execute(task_counts_stmt(quest_ids))}
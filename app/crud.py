@@ -1,15 +1,23 @@
-from datetime import timedelta, datetime
+from datetime import datetime, timezone, date
 
 import pytz
 from fastapi import HTTPException, status
-from sqlalchemy import func, select
-from sqlalchemy.exc import NoResultFound
-from sqlalchemy.orm import Session, Query as QueryOrm
+from sqlalchemy import func, select, delete, update, exists, text, literal, String, DateTime, tuple_, Select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import NoResultFound, IntegrityError
+from sqlalchemy.orm import Session, Query as QueryOrm, joinedload, selectinload
 from random_username.generate import generate_username
 
 from app import models
-from app.models import IpAddress, WalletNetwork
+from app.models import WalletNetwork
+from app.database import run_after_commit
+from app.ip_types import normalize_ip
 from app.schemas import UsernameSchema
+from app.token_cache import token_cache, TokenRecord
+
+# Строк в одном INSERT ... VALUES: у SQLite лимит 32766 параметров, а огромный запрос Postgres планирует заново
+IP_UPSERT_CHUNK_SIZE = 1000
 
 
 def get_object_or_404(model, db: Session, **kwargs):
@@ -36,6 +44,23 @@ def get_quest_by_id(db: Session, quest_id: int) -> models.Quest:
     return get_object_or_404(models.Quest, db, id=quest_id)
 
 
+def quest_detail_stmt(quest_id: int) -> Select:
+    # Квест вместе с сетью, проектом и задачами за фиксированное число запросов (2 независимо от числа задач)
+    return select(models.Quest).options(
+        joinedload(models.Quest.chain),
+        joinedload(models.Quest.project),
+        selectinload(models.Quest.tasks)
+    ).where(models.Quest.id == quest_id)
+
+
+def get_quest_detail(db: Session, quest_id: int) -> models.Quest:
+    quest = db.execute(quest_detail_stmt(quest_id)).scalar_one_or_none()
+
+    if quest is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Quest not found")
+    return quest
+
+
 def get_chain_by_id(db: Session, chain_id: int) -> models.Chain:
     return get_object_or_404(models.Chain, db, id=chain_id)
 
@@ -59,7 +84,6 @@ def update_docs_streak(db: Session, user: models.User):
             if user.curr_docs_streak > 0:
                 user.previous_docs_streak = user.curr_docs_streak
             user.curr_docs_streak = 0
-            db.commit()
 
 def get_quests_query(db: Session, filter: str = None) -> QueryOrm:
     if filter:
@@ -70,6 +94,69 @@ def get_quests_query(db: Session, filter: str = None) -> QueryOrm:
     return db.query(models.Quest)
 
 
+def quests_keyset_stmt(filter: str = None, after: tuple[datetime, int] = None, limit: int = 50) -> Select:
+    # Страница каталога после ключа (created_at, id): стоимость не зависит от глубины, в отличие от OFFSET
+    descending = filter is not None and filter.lower() == 'new'
+    key = tuple_(models.Quest.created_at, models.Quest.id)
+
+    stmt = select(models.Quest)
+    if after is not None:
+        stmt = stmt.where(key < tuple_(*after) if descending else key > tuple_(*after))
+
+    if descending:
+        stmt = stmt.order_by(models.Quest.created_at.desc(), models.Quest.id.desc())
+    else:
+        stmt = stmt.order_by(models.Quest.created_at, models.Quest.id)
+
+    return stmt.limit(limit)
+
+
+def get_quests_keyset(db: Session, filter: str = None, after: tuple[datetime, int] = None,
+                      limit: int = 50) -> list[models.Quest]:
+    return list(db.execute(quests_keyset_stmt(filter, after, limit)).scalars())
+
+
+def count_quests_stmt() -> Select:
+    return select(func.count(models.Quest.id))
+
+
+def count_quests(db: Session) -> int:
+    return db.execute(count_quests_stmt()).scalar()
+
+
+def chains_by_ids_stmt(chain_ids: set[int]) -> Select:
+    return select(models.Chain).where(models.Chain.id.in_(chain_ids))
+
+
+def get_chains_by_ids(db: Session, chain_ids: set[int]) -> dict[int, models.Chain]:
+    if not chain_ids:
+        return {}
+    return {chain.id: chain for chain in db.execute(chains_by_ids_stmt(chain_ids)).scalars()}
+
+
+def projects_by_ids_stmt(project_ids: set[int]) -> Select:
+    return select(models.Project).where(models.Project.id.in_(project_ids))
+
+
+def get_projects_by_ids(db: Session, project_ids: set[int]) -> dict[int, models.Project]:
+    if not project_ids:
+        return {}
+    return {project.id: project for project in db.execute(projects_by_ids_stmt(project_ids)).scalars()}
+
+
+def task_counts_stmt(quest_ids: list[int]) -> Select:
+    # Количество задач для каждого квеста одним GROUP BY запросом
+    return select(models.Task.quest_id, func.count(models.Task.id)).where(
+        models.Task.quest_id.in_(quest_ids)
+    ).group_by(models.Task.quest_id)
+
+
+def get_task_counts(db: Session, quest_ids: list[int]) -> dict[int, int]:
+    if not quest_ids:
+        return {}
+    return {quest_id: count for quest_id, count in db.execute(task_counts_stmt(quest_ids))}
+
+
 def get_chains(db: Session, filter: str = None):
     return db.query(models.Chain).all()
 
@@ -78,27 +165,120 @@ def get_projects(db: Session, filter: str = None):
     return db.query(models.Project).all()
 
 
-def calculate_24h_online(db: Session):
-    today_date = datetime.now(pytz.UTC).date()
-    return db.query(models.IpAddress).filter(func.date(models.IpAddress.visited_at) == today_date).count()
+def merge_online_rollup(db: Session, period_start: datetime, registers: bytes, users_registers: bytes,
+                        merge) -> tuple[bytes, bytes]:
+    # Строка блокируется до коммита, поэтому одновременные чекпоинты разных воркеров не теряют данные друг друга
+    insert = get_insert_for_dialect(db)
+    db.execute(
+        insert(models.OnlineRollup)
+        .values(period_start=period_start, sketch=registers, users_sketch=users_registers,
+                updated_at=datetime.now(timezone.utc))
+        .on_conflict_do_nothing(index_elements=['period_start'])
+    )
+    rollup = db.execute(
+        select(models.OnlineRollup).where(models.OnlineRollup.period_start == period_start).with_for_update()
+    ).scalar_one()
+    rollup.sketch = merge(rollup.sketch, registers)
+    # У часов, записанных до появления users_sketch, скетча пользователей нет
+    rollup.users_sketch = merge(rollup.users_sketch, users_registers) if rollup.users_sketch else users_registers
+    rollup.updated_at = datetime.now(timezone.utc)
+    return rollup.sketch, rollup.users_sketch
+
+
+def get_online_rollups(db: Session, since: datetime) -> list[tuple[datetime, bytes, bytes | None]]:
+    stmt = (
+        select(models.OnlineRollup.period_start, models.OnlineRollup.sketch, models.OnlineRollup.users_sketch)
+        .where(models.OnlineRollup.period_start >= since)
+    )
+    return [(period_start, sketch, users_sketch) for period_start, sketch, users_sketch in db.execute(stmt)]
+
+
+def delete_online_rollups_before(db: Session, before: datetime) -> int:
+    return db.query(models.OnlineRollup).filter(models.OnlineRollup.period_start < before).delete(
+        synchronize_session=False
+    )
 
 
-def add_token_to_user(db: Session, user_id: str, access_token: str):
+def get_changed_online_rollups(db: Session, limit: int) -> list[models.OnlineRollup]:
+    # Часы, которых еще нет в visitor_hourly_stats или которые обновились после последнего пересчета
+    hourly = models.VisitorHourlyStats
+    stmt = (
+        select(models.OnlineRollup)
+        .outerjoin(hourly, hourly.period_start == models.OnlineRollup.period_start)
+        .where((hourly.period_start.is_(None)) | (models.OnlineRollup.updated_at > hourly.updated_at))
+        .order_by(models.OnlineRollup.period_start)
+        .limit(limit)
+    )
+    return list(db.execute(stmt).scalars())
+
+
+def upsert_visitor_hourly_stats(db: Session, period_start: datetime, unique_ips: int, unique_users: int,
+                                updated_at: datetime):
+    insert = get_insert_for_dialect(db)
+    stmt = insert(models.VisitorHourlyStats).values(
+        period_start=period_start, unique_ips=unique_ips, unique_users=unique_users, updated_at=updated_at
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['period_start'],
+        set_={'unique_ips': stmt.excluded.unique_ips, 'unique_users': stmt.excluded.unique_users,
+              'updated_at': stmt.excluded.updated_at},
+    ))
+
+
+def merge_visitor_daily_stats(db: Session, day: date, ips_registers: bytes, users_registers: bytes,
+                              merge, count) -> models.VisitorDailyStats:
+    # Как и в merge_online_rollup: вставка пустой строки и блокировка, затем объединение скетчей
+    insert = get_insert_for_dialect(db)
+    db.execute(
+        insert(models.VisitorDailyStats)
+        .values(day=day, unique_ips=0, unique_users=0, ips_sketch=ips_registers, users_sketch=users_registers,
+                updated_at=datetime.now(timezone.utc))
+        .on_conflict_do_nothing(index_elements=['day'])
+    )
+    stats = db.execute(
+        select(models.VisitorDailyStats).where(models.VisitorDailyStats.day == day).with_for_update()
+    ).scalar_one()
+    stats.ips_sketch = merge(stats.ips_sketch, ips_registers)
+    stats.users_sketch = merge(stats.users_sketch, users_registers)
+    stats.unique_ips = count(stats.ips_sketch)
+    stats.unique_users = count(stats.users_sketch)
+    stats.updated_at = datetime.now(timezone.utc)
+    return stats
+
+
+def get_visitor_hourly_stats(db: Session, start: datetime, end: datetime) -> list[tuple[datetime, int, int]]:
+    hourly = models.VisitorHourlyStats
+    stmt = (
+        select(hourly.period_start, hourly.unique_ips, hourly.unique_users)
+        .where(hourly.period_start >= start, hourly.period_start < end)
+        .order_by(hourly.period_start)
+    )
+    return [tuple(row) for row in db.execute(stmt)]
+
+
+def get_visitor_daily_stats(db: Session, start: date, end: date, with_sketches: bool = False) -> list[tuple]:
+    # Скетчи весят по 16 КБ, поэтому читаются только когда дни нужно объединять
+    daily = models.VisitorDailyStats
+    columns = [daily.day, daily.unique_ips, daily.unique_users]
+    if with_sketches:
+        columns += [daily.ips_sketch, daily.users_sketch]
+    stmt = select(*columns).where(daily.day >= start, daily.day < end).order_by(daily.day)
+    return [tuple(row) for row in db.execute(stmt)]
+
+
+def add_token_to_user(db: Session, user_id: str, access_token: str, expires_at: datetime):
     user = get_user_by_id(db, user_id)
     if not user:
         raise ValueError("User not found")
 
         # Создаем новый объект Token
-    new_token = models.Token(access_token=access_token, user_id=user_id)
+    new_token = models.Token(access_token=access_token, user_id=user_id, expires_at=expires_at)
 
-    # Добавляем токен в сессию и связываем его с пользователем
+    # Добавляем токен в сессию и связываем его с пользователем, коммит - в конце запроса
     db.add(new_token)
-
-    # Сохраняем изменения в базе данных
-    db.commit()
-
-    # Обновляем объект user, чтобы отразить изменения
-    db.refresh(user)
+    db.flush()
+    # Токен мог попасть в кеш как неизвестный
+    invalidate_tokens(db, access_token)
 
     return new_token.access_token
 
@@ -131,78 +311,122 @@ def create_user(db: Session, web3_address: str, username: str = None) -> models.
     )
 
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    db.flush()
 
     return db_user
 
 
-def add_or_update_ip_address(db: Session, client_ip: str):
-    existing_ip = db.query(IpAddress).filter(IpAddress.ip == client_ip).first()
+def get_insert_for_dialect(db: Session):
+    # INSERT ... ON CONFLICT есть и в Postgres, и в SQLite, но конструкторы у диалектов свои
+    if db.get_bind().dialect.name == 'postgresql':
+        return postgresql_insert
+    return sqlite_insert
 
-    if existing_ip:
-        # Если запись найдена, обновить visited_at
-        existing_ip.visited_at = func.now()
-    else:
-        new_ip = IpAddress(ip=client_ip)
-        db.add(new_ip)
 
-    db.commit()
+def chunked(rows: list, size: int):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
 
 
-def add_ip_to_user(db: Session, user_id: int, client_ip: str):
-    # Получаем объект адреса
-    ip_address_object = db.query(models.IpAddress).filter(models.IpAddress.ip == client_ip).first()
+def upsert_ip_addresses_stmt(insert, rows: list[dict]):
+    # Новый ip вставляется, у существующего обновляется visited_at (и страна с ASN, если они переданы);
+    # id возвращается в обоих случаях
+    stmt = insert(models.IpAddress).values(rows)
+    set_ = {'visited_at': stmt.excluded.visited_at}
+    for column in ('country', 'asn'):
+        if column in rows[0]:
+            set_[column] = stmt.excluded[column]
+    return stmt.on_conflict_do_update(
+        index_elements=[models.IpAddress.ip],
+        set_=set_
+    ).returning(models.IpAddress.id, models.IpAddress.ip)
 
-    if not ip_address_object:
-        ip_address_object = models.IpAddress(ip=client_ip)
-        db.add(ip_address_object)
-        db.commit()
-        db.refresh(ip_address_object)
 
-    # Получаем пользователя
-    user = db.query(models.User).get(user_id)
-    if not user:
-        raise HTTPException(status_code=400, detail='User not found')
+def upsert_user_ip_stmt(stmt):
+    # stmt - insert в user_ip (VALUES или INSERT ... SELECT)
+    return stmt.on_conflict_do_update(
+        index_elements=[models.user_ip.c.user_id, models.user_ip.c.ip_address_id],
+        set_={'visited_at': stmt.excluded.visited_at}
+    )
 
-    # Проверяем, существует ли уже ассоциация
-    association = db.query(models.user_ip).filter(
-        models.user_ip.c.user_id == user_id,
-        models.user_ip.c.ip_address_id == ip_address_object.id
-    ).first()
 
-    if association:
-        # Обновляем время последнего доступа
-        db.execute(
-            models.user_ip.update().where(
-                models.user_ip.c.user_id == user_id,
-                models.user_ip.c.ip_address_id == ip_address_object.id
-            ).values(visited_at=func.now())
-        )
-        db.commit()
-        print("IP address updated with new access time.")
-    else:
-        # Создаем новую запись в связной таблице
-        db.execute(
-            models.user_ip.insert().values(
+def add_ip_to_user(db: Session, user_id: str, client_ip: str) -> datetime | None:
+    client_ip = normalize_ip(client_ip)
+    if client_ip is None:
+        # request.client.host бывает не ip (тестовый клиент, unix socket) - такой адрес не сохраняем
+        return None
+
+    visited_at = datetime.now(timezone.utc)
+    insert = get_insert_for_dialect(db)
+    ip_stmt = upsert_ip_addresses_stmt(insert, [{'ip': client_ip, 'visited_at': visited_at}])
+
+    try:
+        if db.get_bind().dialect.name == 'postgresql':
+            # Один запрос: WITH upserted_ip AS (INSERT INTO ip_addresses ... RETURNING id)
+            # INSERT INTO user_ip SELECT ... FROM upserted_ip ON CONFLICT DO UPDATE ... RETURNING visited_at
+            ip_cte = ip_stmt.cte('upserted_ip')
+            user_ip_stmt = insert(models.user_ip).from_select(
+                ['user_id', 'ip_address_id', 'visited_at'],
+                select(
+                    literal(user_id, String(36)),
+                    ip_cte.c.id,
+                    literal(visited_at, DateTime(timezone=True))
+                )
+            )
+        else:
+            # SQLite не поддерживает INSERT внутри CTE, поэтому два запроса в одной транзакции
+            ip_address_id = db.execute(ip_stmt).one().id
+            user_ip_stmt = insert(models.user_ip).values(
                 user_id=user_id,
-                ip_address_id=ip_address_object.id,
-                visited_at=func.now()
+                ip_address_id=ip_address_id,
+                visited_at=visited_at
             )
-        )
-        db.commit()
-        print("IP address added to user.")
 
-    # Получаем обновленное время из смежной таблицы
-    updated_time = db.execute(
-        select(models.user_ip.c.visited_at).where(
-            models.user_ip.c.user_id == user_id,
-            models.user_ip.c.ip_address_id == ip_address_object.id
-        )
-    ).scalar_one_or_none()
+        updated_time = db.execute(
+            upsert_user_ip_stmt(user_ip_stmt).returning(models.user_ip.c.visited_at)
+        ).scalar_one()
+    except IntegrityError:
+        # Нарушение внешнего ключа user_id
+        db.rollback()
+        raise HTTPException(status_code=400, detail='User not found')
+
+    return updated_time
+
+
+def bulk_upsert_ip_visits(db: Session, visits: dict[tuple[str | None, str], datetime],
+                          ip_tags: dict[str, tuple[str | None, int | None]] | None = None,
+                          chunk_size: int = IP_UPSERT_CHUNK_SIZE):
+    """Записывает накопленные посещения (user_id, ip) -> visited_at пачками upsert-запросов и одним коммитом.
+
+    ip_tags - страна и ASN каждого ip; если None, у существующих ip они не меняются.
+    """
+    if not visits:
+        return
+
+    # Время последнего посещения для каждого ip (анонимного и авторизованного)
+    ip_visited_at = {}
+    for (user_id, ip), visited_at in visits.items():
+        if ip not in ip_visited_at or ip_visited_at[ip] < visited_at:
+            ip_visited_at[ip] = visited_at
+
+    insert = get_insert_for_dialect(db)
+
+    # Сортируем ключи, чтобы параллельные воркеры брали блокировки строк в одном порядке
+    ip_rows = [{'ip': ip, 'visited_at': ip_visited_at[ip]} for ip in sorted(ip_visited_at)]
+    if ip_tags is not None:
+        for row in ip_rows:
+            row['country'], row['asn'] = ip_tags.get(row['ip'], (None, None))
+    ip_ids = {}
+    for rows in chunked(ip_rows, chunk_size):
+        ip_ids.update({ip: ip_id for ip_id, ip in db.execute(upsert_ip_addresses_stmt(insert, rows)).all()})
 
-    if updated_time:
-        ip_address_object.visited_at = updated_time
+    user_ip_rows = [
+        {'user_id': user_id, 'ip_address_id': ip_ids[ip], 'visited_at': visited_at}
+        for (user_id, ip), visited_at in sorted(visits.items(), key=lambda item: (item[0][0] or '', item[0][1]))
+        if user_id is not None
+    ]
+    for rows in chunked(user_ip_rows, chunk_size):
+        db.execute(upsert_user_ip_stmt(insert(models.user_ip).values(rows)))
 
     db.commit()
 
@@ -227,23 +451,177 @@ def get_user_ips(db: Session, web3_address: str) -> list[str]:
         return []
 
 
-def verify_token_in_db(db: Session, token: str):
-    # Выполнение асинхронного запроса к базе данных
-    result = db.execute(select(models.Token).filter(models.Token.access_token == token))
-    token_record = result.scalars().first()
+def get_ip_addresses_in_range(db: Session, first: str, last: str, after: str | None,
+                              limit: int) -> list[models.IpAddress]:
+    # BETWEEN по уникальному индексу ip: range scan по подсети, продолжение страницы - с адреса после after
+    stmt = select(models.IpAddress).where(models.IpAddress.ip.between(first, last))
+    if after is not None:
+        stmt = stmt.where(models.IpAddress.ip > after)
+    return list(db.execute(stmt.order_by(models.IpAddress.ip).limit(limit)).scalars())
 
-    if token_record is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid or expired token",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    return token_record.access_token
+
+def get_ip_users(db: Session, ip_address_ids: list[int]) -> dict[int, list[dict]]:
+    if not ip_address_ids:
+        return {}
+    stmt = (
+        select(models.user_ip.c.ip_address_id, models.User.id, models.User.username, models.user_ip.c.visited_at)
+        .join(models.User, models.User.id == models.user_ip.c.user_id)
+        .where(models.user_ip.c.ip_address_id.in_(ip_address_ids))
+        .order_by(models.user_ip.c.visited_at.desc())
+    )
+    users = {}
+    for ip_address_id, user_id, username, visited_at in db.execute(stmt):
+        users.setdefault(ip_address_id, []).append({'id': user_id, 'username': username, 'visited_at': visited_at})
+    return users
+
+
+def get_ip_addresses_after(db: Session, after_id: int, limit: int) -> list[tuple[int, str]]:
+    stmt = (
+        select(models.IpAddress.id, models.IpAddress.ip)
+        .where(models.IpAddress.id > after_id)
+        .order_by(models.IpAddress.id)
+        .limit(limit)
+    )
+    return [tuple(row) for row in db.execute(stmt)]
+
+
+def update_ip_address_tags(db: Session, rows: list[dict]):
+    # rows: {'id', 'country', 'asn'}
+    if rows:
+        db.execute(update(models.IpAddress), rows)
+
+
+def aggregate_users_by_ip_tag(db: Session, column, limit: int) -> list[tuple]:
+    # Уникальные пользователи и ip по стране или ASN; ip без пользователей тоже считаются
+    users = func.count(models.user_ip.c.user_id.distinct())
+    ips = func.count(models.IpAddress.id.distinct())
+    stmt = (
+        select(column, users, ips)
+        .select_from(models.IpAddress)
+        .outerjoin(models.user_ip, models.user_ip.c.ip_address_id == models.IpAddress.id)
+        .where(column.is_not(None))
+        .group_by(column)
+        .order_by(users.desc(), ips.desc())
+        .limit(limit)
+    )
+    return [tuple(row) for row in db.execute(stmt)]
+
+
+def expired_user_ip_filter(before: datetime):
+    return models.user_ip.c.visited_at < before
+
+
+def expired_ip_address_filter(before: datetime, user_ip_before: datetime | None):
+    # ip удаляется вместе со связями (ondelete=CASCADE), поэтому у него не должно остаться связей, которые переживут
+    # очистку user_ip: более свежих, чем user_ip_before, или вообще никаких, если user_ip не чистится
+    links = select(models.user_ip.c.ip_address_id).where(models.user_ip.c.ip_address_id == models.IpAddress.id)
+    if user_ip_before is not None:
+        links = links.where(models.user_ip.c.visited_at >= user_ip_before)
+    return (models.IpAddress.visited_at < before) & ~exists(links)
+
+
+def count_expired_user_ips(db: Session, before: datetime) -> int:
+    return db.scalar(select(func.count()).select_from(models.user_ip).where(expired_user_ip_filter(before)))
+
+
+def count_expired_ip_addresses(db: Session, before: datetime, user_ip_before: datetime | None) -> int:
+    return db.scalar(select(func.count(models.IpAddress.id)).where(expired_ip_address_filter(before, user_ip_before)))
+
+
+def delete_expired_user_ips(db: Session, before: datetime, batch_size: int) -> list[dict]:
+    """Удаляет до batch_size самых старых связей user_ip и возвращает удаленные строки. Коммит за вызывающим."""
+    user_ip = models.user_ip
+    expired = (
+        select(user_ip.c.user_id, user_ip.c.ip_address_id)
+        .where(expired_user_ip_filter(before))
+        .order_by(user_ip.c.visited_at)
+        .limit(batch_size)
+    )
+    # Условие по visited_at повторяется: строку, которую успел обновить буфер посещений, удалять нельзя
+    rows = db.execute(
+        delete(user_ip)
+        .where(tuple_(user_ip.c.user_id, user_ip.c.ip_address_id).in_(expired), expired_user_ip_filter(before))
+        .returning(user_ip.c.user_id, user_ip.c.ip_address_id, user_ip.c.visited_at)
+    ).all()
+    if not rows:
+        return []
+
+    ip_address_ids = {row.ip_address_id for row in rows}
+    ips = dict(db.execute(
+        select(models.IpAddress.id, models.IpAddress.ip).where(models.IpAddress.id.in_(ip_address_ids))
+    ).all())
+    return [
+        {'user_id': row.user_id, 'ip_address_id': row.ip_address_id, 'ip': ips.get(row.ip_address_id),
+         'visited_at': row.visited_at}
+        for row in rows
+    ]
+
+
+def delete_expired_ip_addresses(db: Session, before: datetime, user_ip_before: datetime | None,
+                                batch_size: int) -> list[dict]:
+    """Удаляет до batch_size старых ip без свежих связей и возвращает удаленные строки. Коммит за вызывающим."""
+    expired_filter = expired_ip_address_filter(before, user_ip_before)
+    expired = select(models.IpAddress.id).where(expired_filter).order_by(models.IpAddress.visited_at).limit(batch_size)
+    rows = db.execute(
+        delete(models.IpAddress)
+        .where(models.IpAddress.id.in_(expired), expired_filter)
+        .returning(models.IpAddress.id, models.IpAddress.ip, models.IpAddress.visited_at)
+        .execution_options(synchronize_session=False)
+    ).all()
+    return [{'id': row.id, 'ip': row.ip, 'visited_at': row.visited_at} for row in rows]
+
+
+def create_archive_partition(db: Session, table_name: str, month_start: datetime, month_end: datetime):
+    # Только Postgres: партиция месяца создается при первой архивации строк этого месяца
+    partition_name = f'{table_name}_y{month_start:%Y}m{month_start:%m}'
+    db.execute(text(
+        f'CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name} '
+        f"FOR VALUES FROM ('{month_start.isoformat()}') TO ('{month_end.isoformat()}')"
+    ))
+
+
+def insert_archive_rows(db: Session, table, rows: list[dict]):
+    if rows:
+        db.execute(table.insert(), rows)
+
+
+def get_token_with_user(db: Session, token: str, exp: float = None) -> tuple[TokenRecord, models.User] | None:
+    found, record = token_cache.get(token)
+    if found:
+        if record is None:
+            return None
+
+        user = db.get(models.User, record.user_id)
+        if user is None:
+            token_cache.invalidate(token)
+            return None
+        return record, user
+
+    # Запись токена и его владелец одним запросом
+    row = db.execute(
+        select(models.Token.id, models.Token.user_id, models.User)
+        .join(models.User, models.Token.user_id == models.User.id)
+        .where(models.Token.access_token == token)
+    ).first()
+
+    if row is None:
+        token_cache.add_negative(token)
+        return None
+
+    record = TokenRecord(row.id, token, row.user_id)
+    token_cache.add(record, exp)
+    return record, row.User
+
+
+def invalidate_tokens(db: Session, *access_tokens: str):
+    # Сразу и еще раз после коммита: до коммита параллельный запрос еще видит старую строку и мог ее закешировать
+    token_cache.invalidate(*access_tokens)
+    run_after_commit(db, lambda: token_cache.invalidate(*access_tokens))
 
 
 def deactivate_token(db: Session, token: str):
     db.query(models.Token).filter(models.Token.access_token == token).delete()
-    db.commit()
+    invalidate_tokens(db, token)
 
 
 def link_web3_address(db: Session, user: models.User, web3_address: str,
@@ -263,8 +641,7 @@ def link_web3_address(db: Session, user: models.User, web3_address: str,
 
     try:
         db.add(new_wallet)
-        db.commit()
-        db.refresh(new_wallet)
+        db.flush()
         return new_wallet
     except Exception as e:
         print("Error while linking wallet to user", user.id)
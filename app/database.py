@@ -1,9 +1,16 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import sessionmaker, Session
 from pathlib import Path
 from dotenv import load_dotenv
 from sqlalchemy.ext.declarative import declarative_base
 import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+from app.pool_monitor import InstrumentedQueuePool, pool_monitor
 
 load_dotenv()
 
@@ -11,14 +18,104 @@ load_dotenv()
 current_directory = Path(__file__).resolve().parent.parent
 DATABASE_URL = os.getenv('DATABASE_URL')
 
-engine = create_engine(DATABASE_URL)
+# Горячие роуты на чтение используют AsyncSession вместо синхронной сессии (для сравнения под нагрузкой)
+DB_ASYNC_ENABLED = os.getenv('DB_ASYNC_ENABLED', 'false').lower() == 'true'
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))  # секунды ожидания свободного соединения
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # секунды, -1 отключает пересоздание соединений
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+
+def get_pool_options(database_url: str) -> dict:
+    # SQLite использует свои пулы, настройки QueuePool к нему не применяются
+    if make_url(database_url).get_backend_name() == 'sqlite':
+        return {}
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+engine = create_engine(DATABASE_URL, **get_pool_options(DATABASE_URL))
+pool_monitor.attach(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+def get_async_database_url(database_url: str) -> str:
+    # Тот же DATABASE_URL, но с асинхронным драйвером (asyncpg для Postgres, aiosqlite для SQLite)
+    url = make_url(database_url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername)).render_as_string(
+        hide_password=False
+    )
+
+
+async_engine = create_async_engine(get_async_database_url(DATABASE_URL)) if DB_ASYNC_ENABLED else None
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+) if DB_ASYNC_ENABLED else None
+
+
+def run_after_commit(db: Session, callback: Callable[[], None]):
+    # Запись в запросе только flush-ится, а коммитит DbSessionMiddleware в конце. Действия, которые нельзя
+    # отменить (сброс кеша, удаление файлов), откладываются до коммита и пропускаются при откате.
+    # Колбэк вызывается в потоке, где прошел коммит
+    db.info.setdefault('after_commit', []).append(callback)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_after_commit_callbacks(session: Session):
+    for callback in session.info.pop('after_commit', []):
+        try:
+            callback()
+        except Exception as e:
+            print(f'After commit callback failed: {e}')
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _drop_after_commit_callbacks(session: Session, transaction):
+    # Транзакция закончилась без коммита (откат или закрытие сессии) - колбэки не нужны
+    if transaction.parent is None:
+        session.info.pop('after_commit', None)
+
+
+# Сессия текущего HTTP запроса (unit of work), ее открывает и коммитит DbSessionMiddleware
+request_db: ContextVar[Session | None] = ContextVar('request_db', default=None)
+
+
 def get_db():
+    db = request_db.get()
+    if db is not None:
+        # Внутри запроса все (middleware, зависимости, хелперы) работают с одной сессией
+        yield db
+        return
+
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+get_db_context = contextmanager(get_db)
+
+
+async def get_async_db():
+    # При выключенном DB_ASYNC_ENABLED отдает None, и роут использует синхронную сессию
+    if AsyncSessionLocal is None:
+        yield None
+        return
+
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,13 +1,32 @@
-from fastapi import Depends
+from fastapi import Depends, Request
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 
-from app.crud import verify_token_in_db
+from app import models
 from app.database import get_db
+from app.utils import AuthContext, resolve_auth_context
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="")
 
 
-def verify_token(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    token = verify_token_in_db(db, token)
-    return token
+def get_auth_context(request: Request, db: Session = Depends(get_db),
+                     token: str = Depends(oauth2_scheme)) -> AuthContext:
+    auth = getattr(request.state, 'auth', None)
+
+    if auth is None or auth.access_token != token:
+        # Middleware не смог аутентифицировать запрос - проверяем заново, чтобы вернуть 401
+        auth = resolve_auth_context(db, token)
+    else:
+        # Пользователь загружен в сессии middleware: переносим его в сессию роута без запросов в БД
+        auth.user = db.merge(auth.user, load=False)
+
+    request.state.auth = auth
+    return auth
+
+
+def verify_token(auth: AuthContext = Depends(get_auth_context)) -> str:
+    return auth.access_token
+
+
+def get_current_user(auth: AuthContext = Depends(get_auth_context)) -> models.User:
+    return auth.user
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import threading
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from app.crud import bulk_upsert_ip_visits
+from app.database import SessionLocal
+from app.online_counter import online_counter
+from app.ip_geo import ip_geo
+
+load_dotenv()
+
+IP_BUFFER_FLUSH_INTERVAL = float(os.getenv('IP_BUFFER_FLUSH_INTERVAL', 5))  # секунды между сбросами в БД
+IP_BUFFER_FLUSH_THRESHOLD = int(os.getenv('IP_BUFFER_FLUSH_THRESHOLD', 1000))  # досрочный сброс
+IP_BUFFER_MAX_SIZE = int(os.getenv('IP_BUFFER_MAX_SIZE', 10000))  # новые ключи сверх лимита отбрасываются
+IP_BUFFER_MAX_RETRIES = int(os.getenv('IP_BUFFER_MAX_RETRIES', 3))  # повторных сбросов посещения после ошибки БД
+
+
+class IpVisitBuffer:
+    """Write-behind буфер посещений: склеивает повторные (user_id, ip) в памяти и периодически сбрасывает их в БД."""
+
+    def __init__(self, flush_interval: float = IP_BUFFER_FLUSH_INTERVAL,
+                 flush_threshold: int = IP_BUFFER_FLUSH_THRESHOLD, max_size: int = IP_BUFFER_MAX_SIZE,
+                 max_retries: int = IP_BUFFER_MAX_RETRIES):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.max_size = max_size
+        self.max_retries = max_retries
+
+        self._visits: dict[tuple[str | None, str], datetime] = {}
+        self._retries: dict[tuple[str | None, str], int] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.dropped = 0
+        self.failed = 0
+
+    def add(self, user_id: str | None, ip: str):
+        # Вызывается на каждом запросе, поэтому только обновляет словарь и никогда не ходит в БД
+        key = (user_id, ip)
+        with self._lock:
+            if key not in self._visits and len(self._visits) >= self.max_size:
+                self.dropped += 1
+                return
+            self._visits[key] = datetime.now(timezone.utc)
+            size = len(self._visits)
+
+        if size >= self.flush_threshold:
+            self._wakeup.set()
+
+    def _take(self) -> dict[tuple[str | None, str], datetime]:
+        with self._lock:
+            visits, self._visits = self._visits, {}
+        return visits
+
+    def _restore(self, visits: dict[tuple[str | None, str], datetime]) -> int:
+        # Несохраненный батч возвращается в буфер и уйдет со следующим сбросом. Посещение, которое не удалось
+        # записать max_retries раз подряд, отбрасывается, чтобы одна плохая строка не держала буфер вечно
+        lost = 0
+        with self._lock:
+            for key, visited_at in visits.items():
+                retries = self._retries.get(key, 0) + 1
+                if retries > self.max_retries or (key not in self._visits and len(self._visits) >= self.max_size):
+                    self._retries.pop(key, None)
+                    lost += 1
+                    continue
+                self._retries[key] = retries
+                if key not in self._visits or self._visits[key] < visited_at:
+                    self._visits[key] = visited_at
+            self.failed += lost
+        return lost
+
+    def _write(self, visits: dict[tuple[str | None, str], datetime]):
+        # Счетчик онлайна пополняется из того же батча, отдельного прохода по запросам нет.
+        # При повторе батча посещения добавятся еще раз, но скетчу HyperLogLog это безразлично
+        online_counter.add_visits(visits)
+
+        # Страна и ASN определяются здесь, в потоке сброса, а не на каждом запросе
+        ip_tags = ip_geo.tag({ip for user_id, ip in visits})
+
+        db = SessionLocal()
+        try:
+            bulk_upsert_ip_visits(db, visits, ip_tags)
+        except Exception as e:
+            db.rollback()
+            lost = self._restore(visits)
+            print(f'Error while flushing ip visits ({len(visits)} records, {len(visits) - lost} returned to buffer, '
+                  f'{lost} dropped after {self.max_retries} retries): {e}')
+            return
+        finally:
+            db.close()
+
+        if self._retries:
+            with self._lock:
+                for key in visits:
+                    self._retries.pop(key, None)
+
+    async def flush(self):
+        async with self._flush_lock:
+            visits = self._take()
+            if visits:
+                # Синхронная сессия, поэтому пишем в отдельном потоке и не блокируем event loop
+                await asyncio.to_thread(self._write, visits)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Сбрасываем остатки буфера перед остановкой приложения
+        await self.flush()
+
+
+ip_visit_buffer = IpVisitBuffer()
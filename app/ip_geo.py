@@ -0,0 +1,199 @@
+import bisect
+import csv
+import gzip
+import ipaddress
+import json
+import mmap
+import os
+import struct
+from array import array
+
+from dotenv import load_dotenv
+
+from app.crud import get_ip_addresses_after, update_ip_address_tags
+from app.database import SessionLocal
+
+load_dotenv()
+
+# Локальная база диапазонов: строки range_start, range_end, asn, country, as_name через таб или запятую
+# (формат ip2asn-combined.tsv с iptoasn.com, можно .gz). Пустое значение отключает определение страны и ASN
+IP_GEO_DB_PATH = os.getenv('IP_GEO_DB_PATH', '')
+IP_GEO_BACKFILL_BATCH_SIZE = int(os.getenv('IP_GEO_BACKFILL_BATCH_SIZE', 5000))
+
+INDEX_MAGIC = b'IPRIDX1\0'
+INDEX_HEADER = struct.Struct('<8sQQQ')  # magic, диапазонов IPv4, диапазонов IPv6, длина json с метками
+
+
+def read_ranges(source_path: str):
+    opener = gzip.open if source_path.endswith('.gz') else open
+    with opener(source_path, 'rt', encoding='utf-8', newline='') as file:
+        sample = file.readline()
+        file.seek(0)
+        delimiter = '\t' if '\t' in sample else ','
+        for row in csv.reader(file, delimiter=delimiter):
+            if len(row) < 4:
+                continue
+            try:
+                start, end = ipaddress.ip_address(row[0].strip()), ipaddress.ip_address(row[1].strip())
+                asn = int(row[2].strip().upper().removeprefix('AS') or 0)
+            except ValueError:
+                # Заголовок и битые строки пропускаются
+                continue
+            country = row[3].strip().upper()
+            # В ip2asn неанонсированные диапазоны помечены ASN 0 и страной None
+            if asn == 0 and country in ('', 'NONE'):
+                continue
+            yield start, end, asn, country if len(country) == 2 else None, row[4].strip() if len(row) > 4 else ''
+
+
+def build_ip_range_index(source_path: str, index_path: str) -> int:
+    """Компилирует текстовую базу диапазонов в бинарный индекс для IpRangeIndex и возвращает число диапазонов.
+
+    IPv4 хранятся как uint32, IPv6 - старшими 64 битами (анонсы крупнее /64, точнее различать не нужно).
+    Повторяющиеся пары (country, asn, as_name) хранятся один раз в json в конце файла.
+    """
+    labels: dict[tuple, int] = {}
+    v4, v6 = [], []
+    for start, end, asn, country, as_name in read_ranges(source_path):
+        label = labels.setdefault((country, asn, as_name), len(labels))
+        if start.version == 4 and end.version == 4:
+            v4.append((int(start), int(end), label))
+        elif start.version == 6 and end.version == 6:
+            v6.append((int(start) >> 64, int(end) >> 64, label))
+    v4.sort()
+    v6.sort()
+
+    labels_json = json.dumps(list(labels)).encode()
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(v4), len(v6), len(labels_json)))
+        # Сначала 8-байтовые массивы, затем 4-байтовые: все срезы выровнены для memoryview.cast
+        for typecode, ranges, column in (('Q', v6, 0), ('Q', v6, 1), ('I', v4, 0), ('I', v4, 1),
+                                         ('I', v6, 2), ('I', v4, 2)):
+            file.write(array(typecode, (item[column] for item in ranges)).tobytes())
+        file.write(labels_json)
+    # Воркеры могут собирать индекс одновременно, подмена файла атомарная
+    os.replace(tmp_path, index_path)
+    return len(v4) + len(v6)
+
+
+class IpRangeIndex:
+    """Поиск диапазона по ip бинарным поиском (bisect) по отсортированным массивам начал диапазонов.
+
+    Файл индекса отображается в память (mmap): воркеры делят одни и те же страницы, а загрузка
+    не требует разбора миллионов строк.
+    """
+
+    def __init__(self, index_path: str):
+        with open(index_path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, v4_count, v6_count, labels_size = INDEX_HEADER.unpack_from(self._mmap)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f'{index_path} is not an ip range index')
+
+        view = memoryview(self._mmap)
+        offset = INDEX_HEADER.size
+        arrays = []
+        for typecode, count in (('Q', v6_count), ('Q', v6_count), ('I', v4_count), ('I', v4_count),
+                                ('I', v6_count), ('I', v4_count)):
+            size = struct.calcsize(typecode) * count
+            arrays.append(view[offset:offset + size].cast(typecode))
+            offset += size
+        self.v6_starts, self.v6_ends, self.v4_starts, self.v4_ends, self.v6_labels, self.v4_labels = arrays
+        self.labels = [tuple(label) for label in json.loads(bytes(view[offset:offset + labels_size]))]
+        self.size = len(self._mmap)
+
+    def __len__(self):
+        return len(self.v4_starts) + len(self.v6_starts)
+
+    def lookup(self, ip: str) -> tuple[str | None, int, str] | None:
+        address = ipaddress.ip_address(ip)
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if address.version == 4:
+            starts, ends, labels, key = self.v4_starts, self.v4_ends, self.v4_labels, int(address)
+        else:
+            starts, ends, labels, key = self.v6_starts, self.v6_ends, self.v6_labels, int(address) >> 64
+
+        index = bisect.bisect_right(starts, key) - 1
+        if index < 0 or ends[index] < key:
+            return None
+        return self.labels[labels[index]]
+
+
+class IpGeo:
+    """Страна и ASN ip по локальной базе IP_GEO_DB_PATH, без внешних сервисов.
+
+    Индекс собирается рядом с базой (<путь>.idx) при первом запуске и пересобирается, если база новее.
+    """
+
+    def __init__(self, source_path: str = IP_GEO_DB_PATH):
+        self.source_path = source_path
+        self.index: IpRangeIndex | None = None
+        self.asn_names: dict[int, str] = {}
+
+    def load(self):
+        if not self.source_path:
+            return
+        try:
+            index_path = f'{self.source_path}.idx'
+            if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(self.source_path):
+                count = build_ip_range_index(self.source_path, index_path)
+                print(f'Built ip range index {index_path}: {count} ranges')
+            self.index = IpRangeIndex(index_path)
+            self.asn_names = {asn: as_name for country, asn, as_name in self.index.labels if as_name}
+        except Exception as e:
+            # Без базы приложение работает как раньше, просто без страны и ASN
+            print(f'Failed to load ip geo database {self.source_path}: {e}')
+
+    def tag(self, ips) -> dict[str, tuple[str | None, int | None]] | None:
+        # None - база не загружена, и существующие метки в БД трогать нельзя
+        if self.index is None:
+            return None
+        tags = {}
+        for ip in ips:
+            try:
+                found = self.index.lookup(ip)
+            except ValueError:
+                found = None
+            tags[ip] = (found[0], found[1]) if found else (None, None)
+        return tags
+
+    def stats(self) -> dict:
+        if self.index is None:
+            return {'loaded': False, 'source_path': self.source_path or None}
+        return {
+            'loaded': True,
+            'source_path': self.source_path,
+            'ipv4_ranges': len(self.index.v4_starts),
+            'ipv6_ranges': len(self.index.v6_starts),
+            'labels': len(self.index.labels),
+            'index_bytes': self.index.size,
+        }
+
+
+ip_geo = IpGeo()
+
+
+def tag_all_ip_addresses() -> int:
+    # Проход по всем ip по возрастанию id, по коммиту на пачку
+    db = SessionLocal()
+    try:
+        tagged = 0
+        after_id = 0
+        while True:
+            rows = get_ip_addresses_after(db, after_id, IP_GEO_BACKFILL_BATCH_SIZE)
+            if not rows:
+                return tagged
+            tags = ip_geo.tag(ip for ip_address_id, ip in rows)
+            update_ip_address_tags(db, [
+                {'id': ip_address_id, 'country': tags[ip][0], 'asn': tags[ip][1]} for ip_address_id, ip in rows
+            ])
+            db.commit()
+            tagged += len(rows)
+            after_id = rows[-1][0]
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
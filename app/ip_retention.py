@@ -0,0 +1,147 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from app.crud import count_expired_user_ips, count_expired_ip_addresses, delete_expired_user_ips, \
+    delete_expired_ip_addresses, create_archive_partition, insert_archive_rows
+from app.database import SessionLocal
+from app.models import user_ip_archive, ip_addresses_archive
+from app.periodic import PeriodicTask
+
+load_dotenv()
+
+IP_RETENTION_INTERVAL = float(os.getenv('IP_RETENTION_INTERVAL', 3600))  # секунды, 0 отключает очистку
+IP_USER_RETENTION_DAYS = int(os.getenv('IP_USER_RETENTION_DAYS', 0))  # связи user_ip, 0 - хранить всегда
+IP_ADDRESS_RETENTION_DAYS = int(os.getenv('IP_ADDRESS_RETENTION_DAYS', 0))  # ip_addresses, 0 - хранить всегда
+IP_RETENTION_BATCH_SIZE = int(os.getenv('IP_RETENTION_BATCH_SIZE', 5000))  # строк за одну транзакцию
+# Куда деваются удаленные строки: '' - никуда, table - в архивные таблицы, ndjson - в .ndjson.gz файлы на диске
+IP_ARCHIVE_MODE = os.getenv('IP_ARCHIVE_MODE', '')
+IP_ARCHIVE_DIR = os.getenv('IP_ARCHIVE_DIR', 'archive')
+
+ARCHIVE_MODES = ('', 'table', 'ndjson')
+if IP_ARCHIVE_MODE not in ARCHIVE_MODES:
+    raise ValueError(f'IP_ARCHIVE_MODE must be one of {ARCHIVE_MODES}')
+
+ARCHIVE_TABLES = {
+    'user_ip': user_ip_archive,
+    'ip_addresses': ip_addresses_archive,
+}
+
+
+def get_month_start(moment: datetime) -> datetime:
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_next_month_start(month_start: datetime) -> datetime:
+    return (month_start + timedelta(days=32)).replace(day=1)
+
+
+def group_by_month(rows: list[dict]) -> dict[datetime, list[dict]]:
+    months = {}
+    for row in rows:
+        months.setdefault(get_month_start(row['visited_at']), []).append(row)
+    return months
+
+
+def archive_to_table(db, table_name: str, rows: list[dict]):
+    archived_at = datetime.now(timezone.utc)
+    is_postgres = db.get_bind().dialect.name == 'postgresql'
+    for month_start, month_rows in group_by_month(rows).items():
+        if is_postgres:
+            create_archive_partition(db, ARCHIVE_TABLES[table_name].name, month_start,
+                                     get_next_month_start(month_start))
+        insert_archive_rows(db, ARCHIVE_TABLES[table_name], [{**row, 'archived_at': archived_at} for row in month_rows])
+
+
+def archive_to_ndjson(table_name: str, rows: list[dict]):
+    # Каждая пачка пишется в отдельный файл через временный: воркеры не пишут в один файл,
+    # а упавшая запись не оставляет битый архив
+    archived_at = datetime.now(timezone.utc)
+    for month_start, month_rows in group_by_month(rows).items():
+        directory = Path(IP_ARCHIVE_DIR) / table_name / f'{month_start:%Y-%m}'
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f'{archived_at:%Y%m%dT%H%M%S%f}-{os.getpid()}.ndjson.gz'
+        tmp_path = path.with_name(path.name + '.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as file:
+            for row in month_rows:
+                file.write(json.dumps(row, default=lambda value: value.isoformat()) + '\n')
+        os.replace(tmp_path, path)
+
+
+def archive_rows(db, table_name: str, rows: list[dict]):
+    if not rows:
+        return
+    if IP_ARCHIVE_MODE == 'table':
+        archive_to_table(db, table_name, rows)
+    elif IP_ARCHIVE_MODE == 'ndjson':
+        archive_to_ndjson(table_name, rows)
+
+
+def apply_ip_retention(db, dry_run: bool = False) -> dict:
+    """Удаляет пачками связи user_ip и ip_addresses старше сроков хранения, по IP_ARCHIVE_MODE сохраняя их в архив.
+
+    Строки удаляются DELETE ... RETURNING и архивируются в той же транзакции, поэтому параллельные воркеры
+    не архивируют одну строку дважды. Файл ndjson пишется до коммита: если коммит упадет, строки останутся
+    в таблице и попадут в архив повторно при следующем запуске.
+    """
+    now = datetime.now(timezone.utc)
+    user_ip_before = now - timedelta(days=IP_USER_RETENTION_DAYS) if IP_USER_RETENTION_DAYS > 0 else None
+    ip_before = now - timedelta(days=IP_ADDRESS_RETENTION_DAYS) if IP_ADDRESS_RETENTION_DAYS > 0 else None
+
+    result = {
+        'dry_run': dry_run,
+        'archive_mode': IP_ARCHIVE_MODE or None,
+        'user_ip_before': user_ip_before,
+        'ip_addresses_before': ip_before,
+        'user_ip': 0,
+        'ip_addresses': 0,
+    }
+
+    if dry_run:
+        if user_ip_before is not None:
+            result['user_ip'] = count_expired_user_ips(db, user_ip_before)
+        if ip_before is not None:
+            result['ip_addresses'] = count_expired_ip_addresses(db, ip_before, user_ip_before)
+        return result
+
+    # Сначала связи: ip удаляется, только когда у него не осталось свежих связей
+    while user_ip_before is not None:
+        rows = delete_expired_user_ips(db, user_ip_before, IP_RETENTION_BATCH_SIZE)
+        archive_rows(db, 'user_ip', rows)
+        db.commit()
+        result['user_ip'] += len(rows)
+        if len(rows) < IP_RETENTION_BATCH_SIZE:
+            break
+
+    while ip_before is not None:
+        rows = delete_expired_ip_addresses(db, ip_before, user_ip_before, IP_RETENTION_BATCH_SIZE)
+        archive_rows(db, 'ip_addresses', rows)
+        db.commit()
+        result['ip_addresses'] += len(rows)
+        if len(rows) < IP_RETENTION_BATCH_SIZE:
+            break
+
+    return result
+
+
+def run_ip_retention(dry_run: bool = False) -> dict:
+    db = SessionLocal()
+    try:
+        result = apply_ip_retention(db, dry_run)
+        if not dry_run and (result['user_ip'] or result['ip_addresses']):
+            print(f"IP retention: deleted {result['user_ip']} user_ip and {result['ip_addresses']} ip_addresses rows")
+        return result
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+ip_retention = PeriodicTask(run_ip_retention, IP_RETENTION_INTERVAL, 'ip_retention')
@@ -0,0 +1,80 @@
+import ipaddress
+
+from sqlalchemy import LargeBinary
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.types import TypeDecorator
+
+IPV4_MAPPED_PREFIX = bytes(10) + b'\xff\xff'
+
+
+def parse_ip(value: str) -> ipaddress.IPv4Address | ipaddress.IPv6Address:
+    address = ipaddress.ip_address(value.strip())
+    # ::ffff:1.2.3.4 и 1.2.3.4 - один и тот же клиент
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+        return address.ipv4_mapped
+    return address
+
+
+def normalize_ip(value: str | None) -> str | None:
+    # None для всего, что не является ip (мусор в X-Forwarded-For, 'testclient' и т.п.)
+    if not value:
+        return None
+    try:
+        return str(parse_ip(value))
+    except ValueError:
+        return None
+
+
+def ip_to_bytes(value: str) -> bytes:
+    # IPv4 хранится как IPv4-mapped IPv6, поэтому все адреса 16 байт и IPv4 лежат в индексе одним отрезком
+    address = parse_ip(value)
+    if address.version == 4:
+        return IPV4_MAPPED_PREFIX + address.packed
+    return address.packed
+
+
+def ip_from_bytes(value: bytes) -> str:
+    if value[:12] == IPV4_MAPPED_PREFIX:
+        return str(ipaddress.IPv4Address(value[12:]))
+    return str(ipaddress.IPv6Address(value))
+
+
+def get_network_range(network: str) -> tuple[str, str]:
+    """Первый и последний адрес подсети ('10.0.0.0/24', '2001:db8::/48' или отдельный ip)."""
+    parsed = ipaddress.ip_network(network.strip(), strict=False)
+    if isinstance(parsed, ipaddress.IPv6Network) and parsed.prefixlen >= 96 \
+            and parsed.network_address.ipv4_mapped is not None:
+        parsed = ipaddress.ip_network(f'{parsed.network_address.ipv4_mapped}/{parsed.prefixlen - 96}')
+    return str(parsed.network_address), str(parsed.broadcast_address)
+
+
+class IpAddressType(TypeDecorator):
+    """ip адрес: INET в Postgres, 16 байт в остальных БД. В Python всегда нормализованная строка.
+
+    Порядок значений в индексе совпадает с порядком адресов, поэтому поиск по подсети - это range scan
+    по условию BETWEEN первый AND последний адрес.
+    """
+
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.INET())
+        return dialect.type_descriptor(LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == 'postgresql':
+            return str(parse_ip(value))
+        return ip_to_bytes(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == 'postgresql':
+            # psycopg2 отдает строку, asyncpg - объект ipaddress. Postgres пишет адреса из ::/96 через точки
+            # ('::1.2.3.4'), а Python - в шестнадцатеричном виде ('::102:304'), поэтому нормализуем
+            return normalize_ip(str(value))
+        return ip_from_bytes(value)
@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import FastAPI
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
@@ -14,10 +16,20 @@ from fastapi_pagination import add_pagination
 from admin.crud import create_admin_user
 from admin.routers import admin_router
 from app.limiter import limiter
-from app.middlewares import AuthAdminMiddleware, IpCollectorMiddleware
+from app.middlewares import AuthAdminMiddleware, IpCollectorMiddleware, DbSessionMiddleware
 from app.routers import router
 from admin.admin_panel import UserAdmin, QuestAdmin, ProjectAdmin, ChainAdmin, WalletAdmin, TaskAdmin
-from app.database import engine, get_db
+from app.database import engine, async_engine, SessionLocal
+from app.periodic import PeriodicTask
+from app.pool_monitor import pool_monitor, DB_POOL_LEAK_CHECK_INTERVAL
+from app.ip_collector import ip_visit_buffer
+from app.online_counter import online_counter_checkpoint
+from app.visitor_stats import visitor_rollup
+from app.ip_retention import ip_retention
+from app.ip_geo import ip_geo
+from authentication.token_sweeper import expired_token_sweeper
+from s3_manager.aws_s3_config import s3_client_manager
+from s3_manager.image_worker import image_worker
 from s3_manager.routers import file_router
 from authentication.routers import auth_router
 
@@ -37,6 +49,7 @@ app.add_middleware(SlowAPIMiddleware)
 
 app.add_middleware(AuthAdminMiddleware)  # Кастомная авторизация по токену
 app.add_middleware(IpCollectorMiddleware)  # Сбор входящих ip адресов
+app.add_middleware(DbSessionMiddleware)  # Общая сессия БД на запрос, коммит в конце
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
@@ -65,10 +78,44 @@ app.include_router(admin_router, prefix="/auth/admin")
 
 
 
+pool_leak_checker = PeriodicTask(pool_monitor.report_leaks, DB_POOL_LEAK_CHECK_INTERVAL, 'pool_leak_checker')
+
+
 @app.on_event("startup")
 async def startup_event():
-    db = next(get_db())
-    create_admin_user(db, ADMIN_LOGIN, ADMIN_PASSWORD)
+    db = SessionLocal()
+    try:
+        create_admin_user(db, ADMIN_LOGIN, ADMIN_PASSWORD)
+    finally:
+        db.close()
+    await s3_client_manager.start()
+    image_worker.start()
+    # Загружаем скетчи онлайна за последние сутки, чтобы счетчик не обнулялся после рестарта
+    await online_counter_checkpoint.run_once()
+    # Индекс диапазонов ip (страна, ASN) собирается из базы при первом запуске, это может занять время
+    await asyncio.to_thread(ip_geo.load)
+    ip_visit_buffer.start()
+    online_counter_checkpoint.start()
+    visitor_rollup.start()
+    expired_token_sweeper.start()
+    ip_retention.start()
+    pool_leak_checker.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await pool_leak_checker.stop()
+    await expired_token_sweeper.stop()
+    await ip_retention.stop()
+    await ip_visit_buffer.stop()
+    await online_counter_checkpoint.stop()
+    await online_counter_checkpoint.run_once()
+    await visitor_rollup.stop()
+    await visitor_rollup.run_once()
+    await image_worker.stop()
+    await s3_client_manager.stop()
+    if async_engine is not None:
+        await async_engine.dispose()
 
 
 if __name__ == "__main__":
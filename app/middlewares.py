@@ -1,14 +1,16 @@
+import asyncio
 import json
 
 from fastapi import HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import RedirectResponse, JSONResponse
 from starlette.requests import Request
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
 
 from admin.routers import get_current_admin
-from app.crud import add_or_update_ip_address, add_ip_to_user
-from app.database import get_db
-from app.utils import get_user_from_token
+from app.database import SessionLocal, get_db_context, request_db
+from app.ip_collector import ip_visit_buffer
+from app.ip_types import normalize_ip
+from app.utils import resolve_auth_context
 from authentication.auth import extract_token_from_header_value
 import os
 from dotenv import load_dotenv
@@ -16,54 +18,143 @@ from dotenv import load_dotenv
 load_dotenv()
 ADMIN_SEED_PARAMETER = os.getenv('ADMIN_SEED_PARAMETER')
 
+# Пути админки: панель sqladmin и страница логина администратора
+ADMIN_PATH_PREFIXES = ('/admin', '/auth/admin')
+# Больше этого тело запроса без cookie администратора не читаем, такой запрос отклоняется с 413
+ADMIN_SEED_BODY_LIMIT = 64 * 1024
 
-class AuthAdminMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
 
-        # Игнорируем все пути кроме /admin/
-        if 'admin' not in request.url.path:
-            response = await call_next(request)
-            return response
+def is_admin_path(path: str) -> bool:
+    return any(path == prefix or path.startswith(prefix + '/') for prefix in ADMIN_PATH_PREFIXES)
 
+
+async def read_body(receive: Receive, limit: int) -> bytes | None:
+    # None - тело больше limit, дочитывать его не нужно
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        body += message.get('body', b'')
+        if len(body) > limit:
+            return None
+        more_body = message.get('more_body', False)
+    return body
+
+
+def replay_body(body: bytes, receive: Receive) -> Receive:
+    # Тело уже прочитано middleware, отдаем его приложению повторно одним сообщением
+    body_sent = False
+
+    async def replay() -> Message:
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return await receive()
+
+    return replay
+
+
+class DbSessionMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        # Одна сессия на запрос: соединение берется из пула лениво и один раз, коммит - в конце запроса
+        db = SessionLocal()
+        context_token = request_db.set(db)
+
+        async def send_with_commit(message: Message):
+            # Коммитим до отправки заголовков: если коммит упадет, клиент получит 500, а не ложный 200.
+            # Сессия синхронная, поэтому коммит и откат идут в потоке и не блокируют event loop;
+            # запросы, которые не трогали БД, поток не занимают
+            if message['type'] == 'http.response.start' and db.in_transaction():
+                await asyncio.to_thread(db.commit if message['status'] < 400 else db.rollback)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_commit)
+        except Exception:
+            if db.in_transaction():
+                await asyncio.to_thread(db.rollback)
+            raise
+        finally:
+            request_db.reset(context_token)
+            db.close()
+
+
+class AuthAdminMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        # Игнорируем все пути кроме /admin и /auth/admin
+        if scope['type'] != 'http' or not is_admin_path(scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
         access_token = request.cookies.get('access_token')
         if access_token:
             # Валидириуем токен
             admin = get_current_admin(access_token)
 
             if admin:
-                response = await call_next(request)
-                return response
+                await self.app(scope, receive, send)
+                return
 
         seed_value = None
         method = request.method
         if method == "GET":
-            query_params = request.query_params
-            seed_value = query_params.get('seed')
+            seed_value = request.query_params.get('seed')
 
         if method == "POST":
+            body = await read_body(receive, ADMIN_SEED_BODY_LIMIT)
+            if body is None:
+                # Часть тела уже прочитана, передать запрос дальше целиком нельзя
+                response = JSONResponse(
+                    status_code=413,
+                    content={"detail": "Request body too large"}
+                )
+                await response(scope, receive, send)
+                return
             try:
                 # Пытаемся распарсить тело запроса
-                body_data = json.loads(await request.body())
-                seed_value = body_data.get('seed')
+                seed_value = json.loads(body).get('seed')
             except:
                 pass
+            receive = replay_body(body, receive)
 
         if seed_value != ADMIN_SEED_PARAMETER:
-            return JSONResponse(
+            response = JSONResponse(
                 status_code=404,
                 content={"detail": "Not Found"}
             )
+        elif scope['path'] == '/admin/':
+            response = RedirectResponse(url=f'/auth/admin?seed={seed_value}')
+        else:
+            await self.app(scope, receive, send)
+            return
 
-        if request.url.path == f'/admin/':
-            return RedirectResponse(url=f'/auth/admin?seed={seed_value}')
+        await response(scope, receive, send)
 
 
-        response = await call_next(request)
-        return response
+class IpCollectorMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
 
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
 
-class IpCollectorMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
+        request = Request(scope)
         ip_address = self.get_client_ip(request)
 
         authorization_header = request.headers.get('Authorization')
@@ -72,29 +163,30 @@ class IpCollectorMiddleware(BaseHTTPMiddleware):
         except HTTPException as e:
             access_token = None
 
-        db = next(get_db())
+        # Аутентифицируем запрос один раз, роуты берут результат из request.state.auth (scope['state'])
+        request.state.auth = None
+        if access_token:
+            with get_db_context() as db:
+                try:
+                    request.state.auth = resolve_auth_context(db, access_token)
+                except Exception as e:
+                    pass
 
-        try:
-            user = get_user_from_token(db, access_token)
-        except Exception as e:
-            user = None
+        user = request.state.auth.user if request.state.auth else None
 
-        if user:
-            # Если пользователь авторизован, связываем IP с пользователем
-            add_ip_to_user(db, user.id, ip_address)
-        else:
-            # Если токен отсутствует или невалидный, записываем IP-адрес в таблицу IpAddress
-            add_or_update_ip_address(db, ip_address)
+        # Запись в БД откладывается: буфер периодически сбрасывает посещения одним bulk upsert.
+        # Если токен отсутствует или невалидный, IP записывается без привязки к пользователю
+        if ip_address is not None:
+            ip_visit_buffer.add(user.id if user else None, ip_address)
 
         # Продолжаем обработку запроса
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send)
 
     @staticmethod
-    def get_client_ip(request: Request) -> str:
+    def get_client_ip(request: Request) -> str | None:
+        # Адрес нормализуется (ip хранится в бинарном виде), мусор в X-Forwarded-For игнорируется
         x_forwarded_for = request.headers.get('x-forwarded-for')
-        if x_forwarded_for:
-            ip_address = x_forwarded_for.split(',')[0].strip()
-        else:
-            ip_address = request.client.host
+        ip_address = normalize_ip(x_forwarded_for.split(',')[0]) if x_forwarded_for else None
+        if ip_address is None and request.client is not None:
+            ip_address = normalize_ip(request.client.host)
         return ip_address
@@ -5,10 +5,11 @@ from datetime import datetime, timezone
 from typing import ClassVar
 
 from pydantic import ValidationError
-from sqlalchemy import Column, Integer, String, DateTime, Table, ForeignKey, Boolean, Enum
+from sqlalchemy import Column, Integer, String, DateTime, Date, Table, ForeignKey, Boolean, Enum, Index, LargeBinary
 from sqlalchemy.orm import relationship, validates
 from sqlalchemy.sql import func
 from app.database import Base
+from app.ip_types import IpAddressType
 
 # Промежуточная таблица many-to-many для User и Quest с состоянием квеста
 user_quest = Table(
@@ -22,8 +23,31 @@ user_quest = Table(
 user_ip = Table(
     'user_ip', Base.metadata,
     Column('user_id', String(36), ForeignKey('users.id', ondelete="CASCADE"), primary_key=True),
-    Column('ip_address_id', Integer, ForeignKey('ip_addresses.id', ondelete="CASCADE"), primary_key=True),
-    Column('visited_at', DateTime(timezone=True), default=datetime.now(timezone.utc))
+    # Отдельный индекс: первичный ключ начинается с user_id, а каскадное удаление ip ищет связи по ip_address_id
+    Column('ip_address_id', Integer, ForeignKey('ip_addresses.id', ondelete="CASCADE"), primary_key=True,
+           index=True),
+    Column('visited_at', DateTime(timezone=True), default=datetime.now(timezone.utc), index=True)
+)
+
+# Архив строк user_ip и ip_addresses, удаленных по сроку хранения (app/ip_retention.py, IP_ARCHIVE_MODE=table).
+# В Postgres таблицы разбиты на помесячные партиции по visited_at, старый месяц удаляется целой партицией
+user_ip_archive = Table(
+    'user_ip_archive', Base.metadata,
+    Column('user_id', String(36), nullable=False),
+    Column('ip_address_id', Integer, nullable=False),
+    Column('ip', String(39)),
+    Column('visited_at', DateTime(timezone=True), nullable=False),
+    Column('archived_at', DateTime(timezone=True), nullable=False),
+    postgresql_partition_by='RANGE (visited_at)',
+)
+
+ip_addresses_archive = Table(
+    'ip_addresses_archive', Base.metadata,
+    Column('id', Integer, nullable=False),
+    Column('ip', String(39)),
+    Column('visited_at', DateTime(timezone=True), nullable=False),
+    Column('archived_at', DateTime(timezone=True), nullable=False),
+    postgresql_partition_by='RANGE (visited_at)',
 )
 
 user_task_association = Table(
@@ -130,7 +154,10 @@ class Quest(Base):
     description = Column(String, nullable=False)
     xp = Column(Integer, default=0)
     filepath = Column(String, nullable=False, default='image/quest/default.jpeg')
-    created_at = Column(DateTime(timezone=True), default=datetime.now(timezone.utc))
+    created_at = Column(DateTime(timezone=True), default=datetime.now(timezone.utc), nullable=False)
+
+    # Индекс под keyset пагинацию каталога (created_at, id)
+    __table_args__ = (Index('ix_quests_created_at_id', 'created_at', 'id'),)
 
     task_count: ClassVar[int]
     file = None  # dummy field (admin panel)
@@ -164,6 +191,7 @@ class Token(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)  # Primary key для токенов
     access_token = Column(String(1024), nullable=False, unique=True, index=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)  # Копия exp из JWT для очистки
 
     # Foreign key, связывающий токен с пользователем
     user_id = Column(String(36), ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
@@ -175,8 +203,12 @@ class Token(Base):
 class IpAddress(Base):
     __tablename__ = "ip_addresses"
     id = Column(Integer, primary_key=True, index=True)
-    ip = Column(String(39), index=True, unique=True)
+    # INET в Postgres, 16 байт в остальных БД (см. app/ip_types.py)
+    ip = Column(IpAddressType, index=True, unique=True)
     visited_at = Column(DateTime(timezone=True), default=datetime.now(timezone.utc), index=True)
+    # Заполняются при сбросе буфера посещений по локальной базе диапазонов (app/ip_geo.py)
+    country = Column(String(2), index=True)
+    asn = Column(Integer, index=True)
 
     # Связь с User через промежуточную таблицу
     users = relationship("User", secondary=user_ip, back_populates="ip_addresses", cascade="all, delete")
@@ -211,3 +243,41 @@ class Project(Base):
 
     def __str__(self):
         return f"id: {self.id}, name: {self.name}"
+
+
+class OnlineRollup(Base):
+    # HyperLogLog скетчи уникальных ip и пользователей за час, их обновляют все воркеры (см. app/online_counter.py)
+    __tablename__ = "online_rollups"
+    period_start = Column(DateTime(timezone=True), primary_key=True)
+    sketch = Column(LargeBinary, nullable=False)
+    users_sketch = Column(LargeBinary, nullable=True)
+    updated_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def __str__(self):
+        return f"period_start: {self.period_start}"
+
+
+class VisitorHourlyStats(Base):
+    # Готовые числа по часам из online_rollups (см. app/visitor_stats.py), updated_at копируется из источника
+    __tablename__ = "visitor_hourly_stats"
+    period_start = Column(DateTime(timezone=True), primary_key=True)
+    unique_ips = Column(Integer, nullable=False, default=0)
+    unique_users = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+    def __str__(self):
+        return f"period_start: {self.period_start}"
+
+
+class VisitorDailyStats(Base):
+    # Скетчи за сутки (UTC) хранятся, чтобы считать уникальных за неделю, месяц и любой другой период
+    __tablename__ = "visitor_daily_stats"
+    day = Column(Date, primary_key=True)
+    unique_ips = Column(Integer, nullable=False, default=0)
+    unique_users = Column(Integer, nullable=False, default=0)
+    ips_sketch = Column(LargeBinary, nullable=False)
+    users_sketch = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def __str__(self):
+        return f"day: {self.day}"
@@ -0,0 +1,199 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from app.crud import merge_online_rollup, get_online_rollups, delete_online_rollups_before
+from app.database import SessionLocal
+from app.periodic import PeriodicTask
+
+load_dotenv()
+
+ONLINE_CHECKPOINT_INTERVAL = float(os.getenv('ONLINE_CHECKPOINT_INTERVAL', 60))  # секунды, 0 отключает чекпоинты
+ONLINE_COUNT_CACHE_SECONDS = float(os.getenv('ONLINE_COUNT_CACHE_SECONDS', 10))
+ONLINE_ROLLUP_RETENTION_DAYS = int(os.getenv('ONLINE_ROLLUP_RETENTION_DAYS', 7))
+
+# 2^14 регистров по байту: 16 КБ на час, стандартная ошибка ~0.8%
+HLL_PRECISION = 14
+# В памяти держим часы, нужные для подсчета за сегодня и за последние 24 часа
+ROLLING_WINDOW_HOURS = 24
+KEEP_HOURS = 25
+
+_POWERS = [2.0 ** -rank for rank in range(65)]
+
+
+class HyperLogLog:
+    """Оценка количества уникальных значений в фиксированном объеме памяти. Скетчи объединяются поэлементным max."""
+
+    def __init__(self, registers: bytes | None = None, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+
+    def add(self, value: str):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        rest_bits = 64 - self.precision
+        rank = rest_bits - (hashed & ((1 << rest_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = merge_registers(self.registers, other.registers)
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(map(_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        # Для небольших количеств точнее linear counting по пустым регистрам
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+
+def merge_registers(*registers: bytes) -> bytearray:
+    # Один проход по всем скетчам сразу заметно быстрее попарного объединения
+    if len(registers) == 1:
+        return bytearray(registers[0])
+    return bytearray(map(max, *registers))
+
+
+def get_hour_start(moment: datetime) -> datetime:
+    if moment.tzinfo is None:
+        # SQLite возвращает DateTime(timezone=True) без зоны, в БД хранится UTC
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+class HourSketches:
+    """Скетчи одного часа: уникальные ip и уникальные авторизованные пользователи."""
+
+    def __init__(self, ips: bytes | None = None, users: bytes | None = None):
+        self.ips = HyperLogLog(ips)
+        self.users = HyperLogLog(users)
+
+    def merge(self, ips: bytes, users: bytes | None):
+        self.ips.registers = merge_registers(self.ips.registers, ips)
+        if users:
+            self.users.registers = merge_registers(self.users.registers, users)
+
+
+class OnlineCounter:
+    """Количество уникальных ip за сегодня (UTC) и за последние 24 часа по часовым HyperLogLog скетчам.
+
+    Скетчи пополняются буфером посещений (app/ip_collector.py) и раз в ONLINE_CHECKPOINT_INTERVAL
+    объединяются с таблицей online_rollups: так счетчик переживает рестарт и учитывает посетителей всех воркеров.
+    Рядом копится скетч пользователей, из online_rollups их забирает история посещений (app/visitor_stats.py).
+    """
+
+    def __init__(self, cache_seconds: float = ONLINE_COUNT_CACHE_SECONDS):
+        self.cache_seconds = cache_seconds
+        self._hours: dict[datetime, HourSketches] = {}
+        self._dirty: set[datetime] = set()
+        self._lock = threading.Lock()
+        self._cache: dict[str, tuple[float, int]] = {}
+
+    def add_visits(self, visits: dict[tuple[str | None, str], datetime]):
+        with self._lock:
+            for (user_id, ip), visited_at in visits.items():
+                hour = get_hour_start(visited_at)
+                sketches = self._hours.get(hour)
+                if sketches is None:
+                    sketches = self._hours[hour] = HourSketches()
+                sketches.ips.add(ip)
+                if user_id is not None:
+                    sketches.users.add(user_id)
+                self._dirty.add(hour)
+
+    def _merge_hour(self, hour: datetime, registers: bytes, users_registers: bytes | None):
+        sketches = self._hours.get(hour)
+        if sketches is None:
+            self._hours[hour] = HourSketches(registers, users_registers)
+        else:
+            sketches.merge(registers, users_registers)
+
+    def _prune(self, now: datetime):
+        oldest = get_hour_start(now) - timedelta(hours=KEEP_HOURS)
+        for hour in [hour for hour in self._hours if hour < oldest]:
+            del self._hours[hour]
+            self._dirty.discard(hour)
+
+    def count(self, window: str = 'day') -> int:
+        # Ответ кешируется на cache_seconds: объединение 25 скетчей стоит несколько миллисекунд
+        cached = self._cache.get(window)
+        if cached is not None and time.monotonic() - cached[0] < self.cache_seconds:
+            return cached[1]
+
+        now = datetime.now(timezone.utc)
+        current_hour = get_hour_start(now)
+        if window == 'rolling':
+            # Скетчи часовые, поэтому окно берется с запасом: текущий неполный час и 24 полных предыдущих.
+            # Последние 24 часа покрыты целиком, лишним может попасть не больше часа до их начала
+            since = current_hour - timedelta(hours=ROLLING_WINDOW_HOURS)
+        else:
+            since = current_hour.replace(hour=0)
+
+        with self._lock:
+            self._prune(now)
+            registers = [sketches.ips.registers for hour, sketches in self._hours.items() if hour >= since]
+
+        total = HyperLogLog()
+        for hour_registers in registers:
+            total.registers = merge_registers(total.registers, hour_registers)
+        count = total.count()
+
+        self._cache[window] = (time.monotonic(), count)
+        return count
+
+    def checkpoint(self, db):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            self._prune(now)
+            dirty = {
+                hour: (bytes(self._hours[hour].ips.registers), bytes(self._hours[hour].users.registers))
+                for hour in self._dirty
+            }
+            self._dirty.clear()
+
+        try:
+            for hour, (registers, users_registers) in dirty.items():
+                merged, users_merged = merge_online_rollup(db, hour, registers, users_registers, merge_registers)
+                db.commit()
+                with self._lock:
+                    self._merge_hour(hour, merged, users_merged)
+
+            # Подтягиваем часы, которые обновили другие воркеры
+            rollups = get_online_rollups(db, get_hour_start(now) - timedelta(hours=KEEP_HOURS))
+            with self._lock:
+                for period_start, sketch, users_sketch in rollups:
+                    self._merge_hour(get_hour_start(period_start), sketch, users_sketch)
+
+            delete_online_rollups_before(db, now - timedelta(days=ONLINE_ROLLUP_RETENTION_DAYS))
+            db.commit()
+        except Exception:
+            # Не записанные часы попадут в следующий чекпоинт
+            with self._lock:
+                self._dirty.update(dirty)
+            raise
+
+
+online_counter = OnlineCounter()
+
+
+def checkpoint_online_counter():
+    db = SessionLocal()
+    try:
+        online_counter.checkpoint(db)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+online_counter_checkpoint = PeriodicTask(checkpoint_online_counter, ONLINE_CHECKPOINT_INTERVAL,
+                                         'online_counter_checkpoint')
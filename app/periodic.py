@@ -0,0 +1,36 @@
+import asyncio
+from typing import Callable
+
+
+class PeriodicTask:
+    """Фоновая задача приложения: раз в interval секунд выполняет синхронную func в отдельном потоке."""
+
+    def __init__(self, func: Callable[[], None], interval: float, name: str):
+        self.func = func
+        self.interval = interval
+        self.name = name
+        self._task: asyncio.Task | None = None
+
+    async def run_once(self):
+        try:
+            await asyncio.to_thread(self.func)
+        except Exception as e:
+            print(f'Periodic task {self.name} failed: {e}')
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_once()
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
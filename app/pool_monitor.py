@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+import traceback
+
+from dotenv import load_dotenv
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+load_dotenv()
+
+DB_POOL_LEAK_THRESHOLD = float(os.getenv('DB_POOL_LEAK_THRESHOLD', 30))  # секунды
+DB_POOL_LEAK_TRACE = os.getenv('DB_POOL_LEAK_TRACE', 'false').lower() == 'true'
+DB_POOL_LEAK_CHECK_INTERVAL = float(os.getenv('DB_POOL_LEAK_CHECK_INTERVAL', 60))  # секунды, 0 отключает проверку
+
+
+class PoolMonitor:
+    """Статистика пула соединений и поиск сессий, которые держат соединение дольше leak_threshold секунд."""
+
+    def __init__(self, leak_threshold: float = DB_POOL_LEAK_THRESHOLD, capture_stack: bool = DB_POOL_LEAK_TRACE):
+        self.leak_threshold = leak_threshold
+        self.capture_stack = capture_stack
+
+        self._engine: Engine | None = None
+        self._checked_out: dict[int, tuple[float, str | None]] = {}
+        self._lock = threading.Lock()
+
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+
+    def attach(self, engine: Engine):
+        self._engine = engine
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        # Стек сохраняется только по флагу: format_stack заметно замедляет каждый checkout
+        stack = ''.join(traceback.format_stack(limit=15)) if self.capture_stack else None
+        with self._lock:
+            self._checked_out[id(connection_record)] = (time.monotonic(), stack)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._checked_out.pop(id(connection_record), None)
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.wait_count += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def find_leaks(self) -> list[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {'held_seconds': round(now - checked_out_at, 3), 'stack': stack}
+                for checked_out_at, stack in self._checked_out.values()
+                if now - checked_out_at > self.leak_threshold
+            ]
+
+    def report_leaks(self):
+        for leak in self.find_leaks():
+            print(f"Connection held for {leak['held_seconds']}s (threshold {self.leak_threshold}s)")
+            if leak['stack']:
+                print(leak['stack'])
+
+    def stats(self) -> dict:
+        pool = self._engine.pool if self._engine is not None else None
+        with self._lock:
+            wait = {
+                'count': self.wait_count,
+                'total_seconds': round(self.wait_total, 6),
+                'avg_seconds': round(self.wait_total / self.wait_count, 6) if self.wait_count else 0.0,
+                'max_seconds': round(self.wait_max, 6),
+                'timeouts': self.timeouts,
+            }
+
+        result = {'pool': pool.status() if pool is not None else None, 'wait': wait,
+                  'leaks': len(self.find_leaks())}
+        if isinstance(pool, QueuePool):
+            result.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow(),
+            })
+        return result
+
+
+pool_monitor = PoolMonitor()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool, который сообщает pool_monitor время ожидания свободного соединения."""
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_monitor.record_wait(time.perf_counter() - started_at, timed_out)
@@ -1,40 +1,59 @@
+import asyncio
 import json
-from datetime import timezone
+from datetime import timezone, datetime, timedelta
 from functools import partial
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, BackgroundTasks
 from fastapi.responses import JSONResponse
 from fastapi_pagination import Page
 from fastapi_pagination.ext.sqlalchemy import paginate
 from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 
-from app.database import get_db
-from app.dependencies import verify_token
+from app import async_crud
+from app.database import get_db, get_async_db
+from app.dependencies import get_current_user
+from app.token_cache import token_cache
+from app.pool_monitor import pool_monitor
+from app.online_counter import online_counter
+from app.visitor_stats import get_visitor_history
+from app.ip_retention import run_ip_retention
+from app.ip_types import get_network_range, normalize_ip
+from app.ip_geo import ip_geo, tag_all_ip_addresses
+from s3_manager.image_worker import image_worker
+from admin.dependencies import is_admin
 from app.schemas import UserBase, QuestBase, ProjectBase, ChainBase, CanGrabDocs, GrabDocs, CountUsers, \
-    UserPatchRequest, UserPatchResponse, TaskBase, QuestShortData
+    VisitorHistory, IpLookupResult, IpGeoStats, UserPatchRequest, UserPatchResponse, TaskBase, QuestShortData, \
+    QuestCursorPage
 from app.crud import *
-from app.utils import get_user_from_token, get_time_until_midnight
-from s3_manager.routers import gen_presigned_url, upload_avatar_on_s3
+from app.utils import get_time_until_midnight, encode_cursor, decode_cursor
+from s3_manager.routers import gen_image_url, upload_avatar_on_s3, ImageOptions, get_image_options
 
 load_dotenv()
 
 router = APIRouter()
 
 
+async def set_images(items: list[tuple[object, str]], image_options: ImageOptions | None = None):
+    # Подписываем ссылки на все картинки разом и сохраняем их в атрибут attr каждого объекта
+    images = await asyncio.gather(*(gen_image_url(obj, image_options) for obj, attr in items))
+    for (obj, attr), image in zip(items, images):
+        setattr(obj, attr, image)
+
+
 @router.get("/user/", response_model=UserBase)
-async def return_user_route(token: str = Depends(verify_token), db: Session = Depends(get_db)):
-    user = get_user_from_token(db, token)
+async def return_user_route(user: models.User = Depends(get_current_user), db: Session = Depends(get_db),
+                            image_options: ImageOptions = Depends(get_image_options)):
     update_docs_streak(db, user)
-    user.avatar = await gen_presigned_url(user.filepath)
+    user.avatar = await gen_image_url(user, image_options)
     return user
 
 
 @router.patch("/user/", response_model=UserPatchResponse)
-async def edit_user(patch_data: UserPatchRequest, token: str = Depends(verify_token), db: Session = Depends(get_db)):
-    user = get_user_from_token(db, token)
-
+async def edit_user(patch_data: UserPatchRequest, background_tasks: BackgroundTasks,
+                    user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
     # Обновляем username, если он передан
     if patch_data.username:
         try:
@@ -45,47 +64,81 @@ async def edit_user(patch_data: UserPatchRequest, token: str = Depends(verify_to
     # Обновляем аватар, если передана картинка в base64
     if patch_data.base64_image:
         try:
-            await upload_avatar_on_s3(patch_data.base64_image, token, db)
+            await upload_avatar_on_s3(patch_data.base64_image, user, db, background_tasks)
         except Exception as e:
             raise HTTPException(status_code=500, detail="Error saving avatar")
 
-    # Сохраняем изменения в БД
-    db.commit()
-
-    return {"status": "success", "user": await return_user_route(token, db)}
+    # Изменения сохранит коммит в конце запроса
+    return {"status": "success", "user": await return_user_route(user, db, None)}
 
 
 @router.get("/quest/{quest_id}", response_model=QuestBase)
-async def return_quest(quest_id: int, db: Session = Depends(get_db), short_desc: bool = False):
+async def return_quest(quest_id: int, db: Session = Depends(get_db), short_desc: bool = False,
+                       async_db: Optional[AsyncSession] = Depends(get_async_db),
+                       image_options: ImageOptions = Depends(get_image_options)):
     if not quest_id:
         raise HTTPException(status_code=400, detail="Quest id must be provided")
 
-    quest = get_quest_by_id(db, quest_id)
-    if not quest:
-        raise HTTPException(status_code=404, detail="Quest not found")
+    if async_db is not None:
+        quest = await async_crud.get_quest_detail(async_db, quest_id)
+    else:
+        quest = get_quest_detail(db, quest_id)
 
-    quest.quest_image = await gen_presigned_url(quest.filepath)
+    related = [obj for obj in (quest.chain, quest.project) if obj is not None]
+    tasks = [] if short_desc else quest.tasks
+    await set_images([(quest, 'quest_image')] + [(obj, 'image') for obj in related + tasks], image_options)
 
-    if quest.chain_id is not None:
-        chain = await return_chain(quest.chain_id, db)
-        quest.chain_name = chain.name
-        quest.chain_image = chain.image
+    if quest.chain is not None:
+        quest.chain_name = quest.chain.name
+        quest.chain_image = quest.chain.image
 
-    if quest.project_id is not None:
-        project = await return_project(quest.project_id, db)
-        quest.project_name = project.name
-        quest.project_image = project.image
+    if quest.project is not None:
+        quest.project_name = quest.project.name
+        quest.project_image = quest.project.image
 
     quest.task_count = len(quest.tasks)
 
-    if not short_desc:
-        quest.tasks = [await return_task(task.id, db) for task in quest.tasks]
-
     return quest
 
 
-async def quests_transformer(db: Session, items: list[models.Quest]) -> List[QuestShortData]:
-    return [await return_quest(item.id, db, True) for item in items]
+async def quests_transformer(db: Session, items: list[models.Quest], async_db: Optional[AsyncSession] = None,
+                             image_options: ImageOptions | None = None) -> List[QuestShortData]:
+    # Связанные сети, проекты и количество задач загружаются для всей страницы разом
+    chain_ids = {item.chain_id for item in items if item.chain_id is not None}
+    project_ids = {item.project_id for item in items if item.project_id is not None}
+    quest_ids = [item.id for item in items]
+
+    if async_db is not None:
+        chains = await async_crud.get_chains_by_ids(async_db, chain_ids)
+        projects = await async_crud.get_projects_by_ids(async_db, project_ids)
+        task_counts = await async_crud.get_task_counts(async_db, quest_ids)
+    else:
+        chains = get_chains_by_ids(db, chain_ids)
+        projects = get_projects_by_ids(db, project_ids)
+        task_counts = get_task_counts(db, quest_ids)
+
+    await set_images(
+        [(item, 'quest_image') for item in items] +
+        [(obj, 'image') for obj in list(chains.values()) + list(projects.values())],
+        image_options
+    )
+
+    result = []
+    for item in items:
+        chain = chains.get(item.chain_id)
+        project = projects.get(item.project_id)
+        result.append(QuestShortData(
+            id=item.id,
+            title=item.title,
+            xp=item.xp,
+            quest_image=item.quest_image,
+            task_count=task_counts.get(item.id, 0),
+            chain_name=chain.name if chain else None,
+            chain_image=chain.image if chain else None,
+            project_name=project.name if project else None,
+            project_image=project.image if project else None
+        ))
+    return result
 
 
 @router.get("/quests", response_model=Page[QuestShortData])
@@ -93,29 +146,72 @@ async def return_quests(
         db: Session = Depends(get_db),
         filter: Optional[str] = Query(None, alias="filter",
                                       description="Filter quests based on the given criteria. Use 'new' to get the latest quests.",
-                                      example="new")
+                                      example="new"),
+        image_options: ImageOptions = Depends(get_image_options)
 ):
     quests_query = get_quests_query(db, filter=filter)
-    pagination_object = paginate(db, quests_query)
-    pagination_object.items = await quests_transformer(db, pagination_object.items)
+
+    # paginate валидирует элементы в QuestShortData, поэтому ORM объекты страницы забираем в transformer
+    quests = []
+
+    def keep_quests(items):
+        quests.extend(items)
+        return items
+
+    pagination_object = paginate(db, quests_query, transformer=keep_quests)
+    pagination_object.items = await quests_transformer(db, quests, image_options=image_options)
 
     return pagination_object
 
 
+@router.get("/quests/cursor", response_model=QuestCursorPage)
+async def return_quests_cursor(
+        db: Session = Depends(get_db),
+        filter: Optional[str] = Query(None, alias="filter",
+                                      description="Filter quests based on the given criteria. Use 'new' to get the latest quests.",
+                                      example="new"),
+        cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+        size: int = Query(50, ge=1, le=100),
+        include_total: bool = Query(False, description="Also return the total number of quests (extra COUNT query)"),
+        async_db: Optional[AsyncSession] = Depends(get_async_db),
+        image_options: ImageOptions = Depends(get_image_options)
+):
+    after = decode_cursor(cursor) if cursor else None
+
+    # Берем на один элемент больше, чтобы понять, есть ли следующая страница
+    if async_db is not None:
+        quests = await async_crud.get_quests_keyset(async_db, filter=filter, after=after, limit=size + 1)
+    else:
+        quests = get_quests_keyset(db, filter=filter, after=after, limit=size + 1)
+    has_next = len(quests) > size
+    quests = quests[:size]
+
+    total = None
+    if include_total:
+        total = await async_crud.count_quests(async_db) if async_db is not None else count_quests(db)
+
+    return QuestCursorPage(
+        items=await quests_transformer(db, quests, async_db, image_options),
+        next_cursor=encode_cursor(quests[-1].created_at, quests[-1].id) if has_next else None,
+        total=total
+    )
+
+
 @router.get("/projects", response_model=List[ProjectBase])
 def return_projects(db: Session = Depends(get_db)):
     projects = get_projects(db)
-    return [return_project(x.id, db) for x in projects]
+    return [return_project(x.id, db, None) for x in projects]
 
 
 @router.get("/chains", response_model=List[ChainBase])
 def return_chains(db: Session = Depends(get_db)):
     chains = get_chains(db)
-    return [return_chain(x.id, db) for x in chains]
+    return [return_chain(x.id, db, None) for x in chains]
 
 
 @router.get("/tasks/{task_id}", response_model=TaskBase)
-async def return_task(task_id: int, db: Session = Depends(get_db)):
+async def return_task(task_id: int, db: Session = Depends(get_db),
+                      image_options: ImageOptions = Depends(get_image_options)):
     if not task_id:
         raise HTTPException(status_code=400, detail="Task id must be provided")
 
@@ -123,13 +219,14 @@ async def return_task(task_id: int, db: Session = Depends(get_db)):
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    task.image = await gen_presigned_url(task.filepath)
+    task.image = await gen_image_url(task, image_options)
 
     return task
 
 
 @router.get("/projects/{project_id}", response_model=ProjectBase)
-async def return_project(project_id: int, db: Session = Depends(get_db)):
+async def return_project(project_id: int, db: Session = Depends(get_db),
+                         image_options: ImageOptions = Depends(get_image_options)):
     if not project_id:
         raise HTTPException(status_code=400, detail="Project id must be provided")
 
@@ -137,13 +234,14 @@ async def return_project(project_id: int, db: Session = Depends(get_db)):
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
 
-    project.image = await gen_presigned_url(project.filepath)
+    project.image = await gen_image_url(project, image_options)
 
     return project
 
 
 @router.get("/chains/{chain_id}", response_model=ChainBase)
-async def return_chain(chain_id: int, db: Session = Depends(get_db)):
+async def return_chain(chain_id: int, db: Session = Depends(get_db),
+                       image_options: ImageOptions = Depends(get_image_options)):
     if not chain_id:
         raise HTTPException(status_code=400, detail="Chain id must be provided")
 
@@ -151,15 +249,13 @@ async def return_chain(chain_id: int, db: Session = Depends(get_db)):
     if not chain:
         raise HTTPException(status_code=404, detail="Chain id not found")
 
-    chain.image = await gen_presigned_url(chain.filepath)
+    chain.image = await gen_image_url(chain, image_options)
 
     return chain
 
 
 @router.get("/docs/check-status", response_model=CanGrabDocs)
-def can_grab_docs(token: str = Depends(verify_token), db: Session = Depends(get_db)) -> JSONResponse:
-    user = get_user_from_token(db, token)
-
+def can_grab_docs(user: models.User = Depends(get_current_user), db: Session = Depends(get_db)) -> JSONResponse:
     if not user.docs_grabbed_at:
         return JSONResponse({'can_grab': True}, status_code=200)
 
@@ -171,13 +267,12 @@ def can_grab_docs(token: str = Depends(verify_token), db: Session = Depends(get_
 
 
 @router.patch("/docs/grab", response_model=GrabDocs)
-async def grab_docs(token: str = Depends(verify_token), db: Session = Depends(get_db)):
+async def grab_docs(user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
     try:
-        can_grab_value = json.loads(can_grab_docs(token, db).body)['can_grab']
+        can_grab_value = json.loads(can_grab_docs(user, db).body)['can_grab']
         if not can_grab_value:
             return JSONResponse({'success': False, 'detail': 'User can collect docs once a day!'}, status_code=200)
 
-        user = get_user_from_token(db, token)
         curr_datetime = datetime.now(timezone.utc)
         last_grabbed = user.docs_grabbed_at
 
@@ -189,8 +284,7 @@ async def grab_docs(token: str = Depends(verify_token), db: Session = Depends(ge
 
         user.max_docs_streak = max(user.max_docs_streak, user.curr_docs_streak)
         user.docs_grabbed_at = curr_datetime
-        db.commit()
-        db.refresh(user)
+        db.flush()
 
         return JSONResponse(
             {
@@ -210,6 +304,96 @@ async def grab_docs(token: str = Depends(verify_token), db: Session = Depends(ge
 
 
 @router.get('/users/get-online', response_model=CountUsers)
-def return_online(db: Session = Depends(get_db)):
-    count = calculate_24h_online(db)
+def return_online(window: str = Query('day', pattern='^(day|rolling)$',
+                                      description="'day' - unique visitors since UTC midnight, "
+                                                  "'rolling' - for the last 24 hours")):
+    # Оценка по HyperLogLog скетчам в памяти, без запросов к БД
+    count = online_counter.count(window)
     return JSONResponse({'count': count}, status_code=200)
+
+
+@router.get('/internal/visitors/history', response_model=VisitorHistory)
+def return_visitor_history(start: Optional[datetime] = Query(None, description='Defaults to 7 days before end'),
+                           end: Optional[datetime] = Query(None, description='Defaults to now'),
+                           points: int = Query(200, ge=1, le=2000, description='Maximum number of points'),
+                           db: Session = Depends(get_db), have_access: bool = Depends(is_admin)):
+    # Читаются только таблицы visitor_hourly_stats и visitor_daily_stats
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=7)
+    return get_visitor_history(db, start, end, points)
+
+
+@router.post('/internal/ip-retention')
+async def apply_ip_retention_route(dry_run: bool = True, have_access: bool = Depends(is_admin)):
+    # По умолчанию только считает строки старше сроков хранения; удаление идет пачками в своей сессии
+    return await asyncio.to_thread(run_ip_retention, dry_run)
+
+
+@router.get('/internal/ips/lookup', response_model=IpLookupResult)
+def lookup_ip_network(network: str = Query(..., description="CIDR ('10.0.0.0/24') or a single ip"),
+                      after: Optional[str] = Query(None, description='next_after from the previous page'),
+                      limit: int = Query(100, ge=1, le=1000),
+                      db: Session = Depends(get_db), have_access: bool = Depends(is_admin)):
+    # Все ip подсети и пользователи, которые с них заходили; выборка идет по индексу ip_addresses.ip
+    try:
+        first, last = get_network_range(network)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Invalid network')
+    if after is not None:
+        after = normalize_ip(after)
+        if after is None:
+            raise HTTPException(status_code=400, detail='Invalid after')
+
+    ip_addresses = get_ip_addresses_in_range(db, first, last, after, limit)
+    users = get_ip_users(db, [ip_address.id for ip_address in ip_addresses])
+    return {
+        'first': first,
+        'last': last,
+        'items': [
+            {'ip': ip_address.ip, 'visited_at': ip_address.visited_at, 'country': ip_address.country,
+             'asn': ip_address.asn, 'users': users.get(ip_address.id, [])}
+            for ip_address in ip_addresses
+        ],
+        'next_after': ip_addresses[-1].ip if len(ip_addresses) == limit else None,
+    }
+
+
+@router.get('/internal/ip-geo/stats', response_model=IpGeoStats)
+def return_ip_geo_stats(by: str = Query('country', pattern='^(country|asn)$'),
+                        limit: int = Query(50, ge=1, le=1000),
+                        db: Session = Depends(get_db), have_access: bool = Depends(is_admin)):
+    # Группировка по колонкам ip_addresses, которые заполняет буфер посещений (app/ip_geo.py)
+    column = models.IpAddress.country if by == 'country' else models.IpAddress.asn
+    items = [
+        {'key': str(key), 'name': ip_geo.asn_names.get(key) if by == 'asn' else None, 'users': users, 'ips': ips}
+        for key, users, ips in aggregate_users_by_ip_tag(db, column, limit)
+    ]
+    return {'by': by, 'items': items}
+
+
+@router.get('/internal/ip-geo')
+def return_ip_geo_index_stats(have_access: bool = Depends(is_admin)):
+    return ip_geo.stats()
+
+
+@router.post('/internal/ip-geo/backfill')
+async def backfill_ip_geo(have_access: bool = Depends(is_admin)):
+    # Проставляет страну и ASN всем ip, например после первой загрузки или обновления базы
+    if ip_geo.index is None:
+        raise HTTPException(status_code=400, detail='IP geo database is not loaded')
+    return {'tagged': await asyncio.to_thread(tag_all_ip_addresses)}
+
+
+@router.get('/internal/pool')
+def return_pool_stats(have_access: bool = Depends(is_admin)):
+    return pool_monitor.stats()
+
+
+@router.get('/internal/token-cache')
+def return_token_cache_stats(have_access: bool = Depends(is_admin)):
+    return token_cache.stats()
+
+
+@router.get('/internal/image-worker')
+def return_image_worker_stats(have_access: bool = Depends(is_admin)):
+    return image_worker.stats()
@@ -86,6 +86,12 @@ class QuestBase(QuestShortData):
     description: str
     tasks: List[TaskBase] = []
 
+class QuestCursorPage(BaseModel):
+    items: List[QuestShortData]
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+
+
 class ProjectBase(IdModel):
     name: str = Field(..., max_length=50)
     image: str
@@ -117,4 +123,48 @@ class GrabDocs(BaseModel):
 
 
 class CountUsers(BaseModel):
-    count: int
\ No newline at end of file
+    count: int
+
+
+class VisitorStatsPoint(BaseModel):
+    period_start: datetime
+    unique_ips: int
+    unique_users: int
+
+
+class VisitorHistory(BaseModel):
+    granularity: str
+    items: List[VisitorStatsPoint]
+
+
+class IpUserVisit(BaseModel):
+    id: str
+    username: str
+    visited_at: Optional[datetime] = None
+
+
+class IpLookupItem(BaseModel):
+    ip: str
+    visited_at: Optional[datetime] = None
+    country: Optional[str] = None
+    asn: Optional[int] = None
+    users: List[IpUserVisit]
+
+
+class IpLookupResult(BaseModel):
+    first: str
+    last: str
+    items: List[IpLookupItem]
+    next_after: Optional[str] = None
+
+
+class IpTagStats(BaseModel):
+    key: str
+    name: Optional[str] = None
+    users: int
+    ips: int
+
+
+class IpGeoStats(BaseModel):
+    by: str
+    items: List[IpTagStats]
\ No newline at end of file
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TOKEN_CACHE_MAX_SIZE = int(os.getenv('TOKEN_CACHE_MAX_SIZE', 10000))
+TOKEN_CACHE_TTL = float(os.getenv('TOKEN_CACHE_TTL', 60))  # секунды, но не дольше exp самого JWT
+# 0 отключает кеширование неизвестных токенов
+TOKEN_CACHE_NEGATIVE_TTL = float(os.getenv('TOKEN_CACHE_NEGATIVE_TTL', 10))
+
+
+class TokenRecord(NamedTuple):
+    id: int
+    access_token: str
+    user_id: str
+
+
+class TokenCache:
+    """LRU-кеш валидности access токенов с TTL.
+
+    Кеш локален для процесса: удаление токена в другом воркере станет видно здесь не позже чем через TTL.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_MAX_SIZE, ttl: float = TOKEN_CACHE_TTL,
+                 negative_ttl: float = TOKEN_CACHE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        # access_token -> (TokenRecord или None для неизвестного токена, момент истечения по time.monotonic)
+        self._entries: OrderedDict[str, tuple[TokenRecord | None, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, access_token: str) -> tuple[bool, TokenRecord | None]:
+        """Возвращает (найден ли в кеше, запись). Запись None при найденном ключе - токен известен как невалидный."""
+        with self._lock:
+            entry = self._entries.get(access_token)
+
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[access_token]
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(access_token)
+            record = entry[0]
+            if record is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, record
+
+    def add(self, record: TokenRecord, exp: float | None = None):
+        ttl = self.ttl
+        if exp is not None:
+            ttl = min(ttl, exp - time.time())
+        if ttl > 0:
+            self._put(record.access_token, record, ttl)
+
+    def add_negative(self, access_token: str):
+        if self.negative_ttl > 0:
+            self._put(access_token, None, self.negative_ttl)
+
+    def _put(self, access_token: str, record: TokenRecord | None, ttl: float):
+        with self._lock:
+            self._entries[access_token] = (record, time.monotonic() + ttl)
+            self._entries.move_to_end(access_token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *access_tokens: str):
+        with self._lock:
+            for access_token in access_tokens:
+                self._entries.pop(access_token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+token_cache = TokenCache()
@@ -1,5 +1,7 @@
+import base64
+import json
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 import jwt
@@ -7,7 +9,9 @@ from fastapi import HTTPException
 from sqlalchemy.orm import Session
 from starlette import status
 
-from app.crud import get_user_by_web3_address
+from app import models
+from app.crud import get_user_by_web3_address, get_token_with_user
+from app.token_cache import TokenRecord
 from app.schemas import TimeLeft
 
 load_dotenv()
@@ -38,6 +42,63 @@ def get_user_from_token(db: Session, token: str):
     return user
 
 
+class AuthContext:
+    """Результат аутентификации запроса: payload JWT, запись токена и пользователь.
+
+    Создается один раз на запрос (IpCollectorMiddleware) и хранится в request.state.auth.
+    """
+
+    def __init__(self, claims: dict, token: TokenRecord, user: models.User):
+        self.claims = claims
+        self.token = token
+        self.user = user
+
+    @property
+    def access_token(self) -> str:
+        return self.token.access_token
+
+
+def resolve_auth_context(db: Session, token: str) -> AuthContext:
+    payload = decode_token(token)
+
+    if payload.get("sub") is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    result = get_token_with_user(db, token, payload.get("exp"))
+
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    token_record, user = result
+    return AuthContext(payload, token_record, user)
+
+
+def get_token_expiration(token: str) -> datetime:
+    payload = decode_token(token)
+    return datetime.fromtimestamp(payload["exp"], tz=timezone.utc)
+
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    # Непрозрачный для клиента курсор: base64 от [created_at, id]
+    return base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 def get_time_until_midnight():
     now = datetime.now()
     midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
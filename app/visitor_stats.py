@@ -0,0 +1,126 @@
+import math
+import os
+from datetime import datetime, timedelta, timezone, date, time
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from app.crud import get_changed_online_rollups, upsert_visitor_hourly_stats, merge_visitor_daily_stats, \
+    get_visitor_hourly_stats, get_visitor_daily_stats
+from app.database import SessionLocal
+from app.online_counter import HyperLogLog, merge_registers, get_hour_start
+from app.periodic import PeriodicTask
+
+load_dotenv()
+
+VISITOR_ROLLUP_INTERVAL = float(os.getenv('VISITOR_ROLLUP_INTERVAL', 300))  # секунды, 0 отключает пересчет
+VISITOR_ROLLUP_BATCH_SIZE = int(os.getenv('VISITOR_ROLLUP_BATCH_SIZE', 500))  # часов за одну транзакцию
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+
+def count_registers(registers: bytes | None) -> int:
+    return HyperLogLog(registers).count()
+
+
+def roll_up_visitors(db) -> int:
+    """Пересчитывает visitor_hourly_stats и visitor_daily_stats по часам online_rollups, изменившимся с прошлого раза.
+
+    Число за час берется из его скетча, а скетч часа вливается в скетч суток, поэтому повторный пересчет
+    того же часа ничего не портит и сырые таблицы (user_ip, ip_addresses) не читаются.
+    """
+    total = 0
+    while True:
+        rollups = get_changed_online_rollups(db, VISITOR_ROLLUP_BATCH_SIZE)
+        days: dict[date, tuple[list[bytes], list[bytes]]] = {}
+        for rollup in rollups:
+            users_sketch = rollup.users_sketch or bytes(len(rollup.sketch))
+            # updated_at копируется из online_rollups: если час обновят во время пересчета, он попадет в следующий
+            upsert_visitor_hourly_stats(db, rollup.period_start, count_registers(rollup.sketch),
+                                        count_registers(users_sketch), rollup.updated_at)
+
+            ips, users = days.setdefault(get_hour_start(rollup.period_start).date(), ([], []))
+            ips.append(rollup.sketch)
+            users.append(users_sketch)
+
+        for day, (ips, users) in days.items():
+            merge_visitor_daily_stats(db, day, bytes(merge_registers(*ips)), bytes(merge_registers(*users)),
+                                      merge_registers, count_registers)
+        db.commit()
+
+        total += len(rollups)
+        if len(rollups) < VISITOR_ROLLUP_BATCH_SIZE:
+            return total
+
+
+def run_visitor_rollup():
+    db = SessionLocal()
+    try:
+        updated = roll_up_visitors(db)
+        if updated:
+            print(f'Visitor rollup: {updated} hours updated')
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+visitor_rollup = PeriodicTask(run_visitor_rollup, VISITOR_ROLLUP_INTERVAL, 'visitor_rollup')
+
+
+def get_day_start(day: date) -> datetime:
+    return datetime.combine(day, time(), tzinfo=timezone.utc)
+
+
+def get_visitor_history(db, start: datetime, end: datetime, points: int) -> dict:
+    """Ряд уникальных ip и пользователей за [start, end) не длиннее points точек.
+
+    Если часов в диапазоне не больше points, отдаются часы, иначе сутки, а при длинном диапазоне
+    сутки склеиваются в интервалы по N дней объединением их скетчей. Границы расширяются до целого часа или дня.
+    """
+    start = get_hour_start(start)
+    end = end if end.tzinfo else end.replace(tzinfo=timezone.utc)
+    if end <= start:
+        raise HTTPException(status_code=400, detail='end must be greater than start')
+
+    hours = math.ceil((end - start) / HOUR)
+    if hours <= points:
+        rows = {get_hour_start(period_start): (ips, users)
+                for period_start, ips, users in get_visitor_hourly_stats(db, start, end)}
+        items = []
+        for index in range(hours):
+            period_start = start + index * HOUR
+            ips, users = rows.get(period_start, (0, 0))
+            items.append({'period_start': period_start, 'unique_ips': ips, 'unique_users': users})
+        return {'granularity': '1h', 'items': items}
+
+    start_day = start.date()
+    end_day = (end - timedelta(microseconds=1)).date() + DAY
+    days = (end_day - start_day).days
+    bucket_days = math.ceil(days / points)
+
+    if bucket_days == 1:
+        rows = {day: (ips, users) for day, ips, users in get_visitor_daily_stats(db, start_day, end_day)}
+        items = []
+        for index in range(days):
+            day = start_day + index * DAY
+            ips, users = rows.get(day, (0, 0))
+            items.append({'period_start': get_day_start(day), 'unique_ips': ips, 'unique_users': users})
+        return {'granularity': '1d', 'items': items}
+
+    # Уникальных за несколько дней нельзя получить суммой по дням, поэтому объединяются скетчи
+    buckets = [([], []) for _ in range(math.ceil(days / bucket_days))]
+    for day, _, _, ips_sketch, users_sketch in get_visitor_daily_stats(db, start_day, end_day, with_sketches=True):
+        ips, users = buckets[(day - start_day).days // bucket_days]
+        ips.append(ips_sketch)
+        users.append(users_sketch)
+
+    items = [
+        {'period_start': get_day_start(start_day + index * bucket_days * DAY),
+         'unique_ips': count_registers(merge_registers(*ips)) if ips else 0,
+         'unique_users': count_registers(merge_registers(*users)) if users else 0}
+        for index, (ips, users) in enumerate(buckets)
+    ]
+    return {'granularity': f'{bucket_days}d', 'items': items}
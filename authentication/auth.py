@@ -10,7 +10,7 @@ from dotenv import load_dotenv
 
 from app.crud import add_ip_to_user, add_token_to_user, link_web3_address, get_user_by_web3_address
 from app.models import WalletNetwork
-from app.utils import get_user_from_token, decode_token, JWT_SECRET_KEY, ALGORITHM
+from app.utils import get_user_from_token, decode_token, get_token_expiration, JWT_SECRET_KEY, ALGORITHM
 from authentication.wallet_validators import validate_ethereum_wallet, validate_solana_wallet
 
 load_dotenv()
@@ -97,7 +97,8 @@ def verify_signature(db: Session, temp_token: str, signature: str, client_ip: st
 
     if not access_token:
         access_token = create_access_token(web3_address)  # Создаем долгосрочный токен
-        add_token_to_user(db, user.id, access_token)  # Привязываем токен к пользователю
+        # Привязываем токен к пользователю
+        add_token_to_user(db, user.id, access_token, get_token_expiration(access_token))
 
     return {"access_token": access_token, 'web3_address': web3_address,
             'wallet_network': network}
@@ -1,12 +1,29 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import delete, select
 from sqlalchemy.orm import Session
 
 from app import models
-from authentication.auth import validate_token
+from app.token_cache import token_cache
+
+
+def delete_expired_tokens(db: Session, batch_size: int = 1000) -> int:
+    # Удаляем пачками по индексу expires_at, чтобы не держать долгие блокировки на tokens
+    now = datetime.now(timezone.utc)
+    deleted = 0
+
+    while True:
+        expired_ids = select(models.Token.id).where(models.Token.expires_at < now).limit(batch_size)
+        access_tokens = db.execute(
+            delete(models.Token)
+            .where(models.Token.id.in_(expired_ids))
+            .returning(models.Token.access_token)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        db.commit()
 
+        token_cache.invalidate(*access_tokens)
+        deleted += len(access_tokens)
 
-def delete_expired_tokens(db: Session):
-    tokens = db.query(models.Token).all()
-    for token in tokens:
-        if not validate_token(db, token.access_token):
-            db.delete(token)
-    db.commit()
+        if len(access_tokens) < batch_size:
+            return deleted
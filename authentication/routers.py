@@ -5,11 +5,9 @@ from app.crud import deactivate_token, link_web3_address
 from app.database import get_db
 from app.dependencies import verify_token
 from app.limiter import limiter
-from app.utils import get_user_from_token
 from authentication import schemas
 
 from authentication.auth import generate_nonce, verify_signature, validate_token, extract_token_from_header_value
-from authentication.crud import delete_expired_tokens
 from authentication.schemas import VerifySignatureRequest
 
 auth_router = APIRouter()
@@ -30,12 +28,6 @@ def generate_nonce_route(request: Request, address: str, db: Session = Depends(g
 @limiter.limit("8/minute")
 def verify_signature_route(request: Request, body: VerifySignatureRequest, type: str, db: Session = Depends(get_db)):
 
-    try:
-        delete_expired_tokens(db)
-    except Exception as e:
-        print(e)
-        raise HTTPException(status_code=400, detail='Error while handling token')
-
     if type == 'sign_in':
         try:
             client_ip = request.client.host
@@ -51,7 +43,10 @@ def verify_signature_route(request: Request, body: VerifySignatureRequest, type:
     elif type == 'link':
         try:
             client_ip = request.client.host
-            token = verify_token()
+            auth = request.state.auth
+            if auth is None:
+                raise HTTPException(status_code=401, detail='Invalid or expired token')
+            token = auth.access_token
             result = verify_signature(db, body.temp_token, body.signature, client_ip, token)
             web3_address = result['web3_address']
 
@@ -0,0 +1,28 @@
+import os
+
+from dotenv import load_dotenv
+
+from app.database import SessionLocal
+from app.periodic import PeriodicTask
+from authentication.crud import delete_expired_tokens
+
+load_dotenv()
+
+TOKEN_SWEEP_INTERVAL = float(os.getenv('TOKEN_SWEEP_INTERVAL', 3600))  # секунды, 0 отключает очистку
+TOKEN_SWEEP_BATCH_SIZE = int(os.getenv('TOKEN_SWEEP_BATCH_SIZE', 1000))
+
+
+def sweep_expired_tokens():
+    db = SessionLocal()
+    try:
+        deleted = delete_expired_tokens(db, TOKEN_SWEEP_BATCH_SIZE)
+        if deleted:
+            print(f'Deleted {deleted} expired tokens')
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+expired_token_sweeper = PeriodicTask(sweep_expired_tokens, TOKEN_SWEEP_INTERVAL, 'expired_token_sweeper')
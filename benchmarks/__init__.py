@@ -0,0 +1,37 @@
+"""Микробенчмарки горячих путей. Запуск из корня проекта: python -m benchmarks.<модуль>
+
+Приложение читает настройки при импорте, поэтому недостающие переменные окружения заполняются тестовыми значениями.
+"""
+import os
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/benchmark.db')
+for name, value in {
+    'JWT_SECRET_KEY': 'benchmark-secret',
+    'ADMIN_LOGIN': 'admin',
+    'ADMIN_PASSWORD': 'admin',
+    'AWS_ACCESS_KEY_ID': 'AKIDEXAMPLE',
+    'AWS_SECRET_ACCESS_KEY': 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+    'REGION_NAME': 'eu-central-1',
+    'BUCKET_NAME': 'benchmark-bucket',
+}.items():
+    os.environ.setdefault(name, value)
+
+
+def report(name: str, count: int, elapsed: float):
+    print(f'{name:<45} {count / elapsed:>12,.0f} ops/s {elapsed / count * 1e6:>10.2f} us/op')
+
+
+def measure(name: str, func, count: int):
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    report(name, count, time.perf_counter() - start)
+
+
+async def measure_async(name: str, func, count: int):
+    start = time.perf_counter()
+    for _ in range(count):
+        await func()
+    report(name, count, time.perf_counter() - start)
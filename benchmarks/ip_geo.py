@@ -0,0 +1,78 @@
+"""Поиск страны и ASN по индексу диапазонов (app/ip_geo.py) на синтетической базе размером с ip2asn.
+
+python -m benchmarks.ip_geo [число IPv4 диапазонов]
+"""
+import bisect
+import gzip
+import ipaddress
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import measure
+from app.ip_geo import IpGeo, IpRangeIndex
+
+V4_RANGES = int(sys.argv[1]) if len(sys.argv) > 1 else 450000
+V6_RANGES = V4_RANGES // 4
+SAMPLE_SIZE = 200000
+
+
+def write_ranges(path: str, rng: random.Random) -> tuple[int, int]:
+    start = int(ipaddress.IPv4Address('1.0.0.0'))
+    with gzip.open(path, 'wt') as file:
+        file.write('range_start\trange_end\tAS_number\tcountry_code\tAS_description\n')
+        for _ in range(V4_RANGES):
+            size = rng.choice((256, 512, 1024, 4096))
+            asn = rng.randint(1, 60000)
+            file.write(f'{ipaddress.IPv4Address(start)}\t{ipaddress.IPv4Address(start + size - 1)}\t{asn}\t'
+                       f'{rng.choice(("US", "DE", "RU", "BR", "CN"))}\tAS-{asn}\n')
+            start += size + rng.choice((0, 0, 256))
+        v6_start = int(ipaddress.IPv6Address('2001:200::'))
+        for index in range(V6_RANGES):
+            first = v6_start + (index << 96)
+            file.write(f'{ipaddress.IPv6Address(first)}\t{ipaddress.IPv6Address(first + (1 << 96) - 1)}\t'
+                       f'{64000 + index % 1000}\tJP\tV6-{index % 1000}\n')
+    return int(ipaddress.IPv4Address('1.0.0.0')), start
+
+
+def main():
+    rng = random.Random(1)
+    directory = tempfile.mkdtemp()
+    source_path = os.path.join(directory, 'ip2asn.tsv.gz')
+    first, last = write_ranges(source_path, rng)
+
+    geo = IpGeo(source_path)
+    started_at = time.perf_counter()
+    geo.load()
+    print(f'build index: {time.perf_counter() - started_at:.2f}s, {geo.stats()}')
+    started_at = time.perf_counter()
+    index = IpRangeIndex(f'{source_path}.idx')
+    print(f'open index: {(time.perf_counter() - started_at) * 1000:.1f}ms')
+
+    ips = [str(ipaddress.IPv4Address(rng.randrange(first, last))) for _ in range(SAMPLE_SIZE)]
+    ints = [int(ipaddress.IPv4Address(ip)) for ip in ips]
+    v6_ips = [str(ipaddress.IPv6Address(int(ipaddress.IPv6Address('2001:200::')) + (rng.randrange(V6_RANGES) << 96)
+                                        + rng.getrandbits(64))) for _ in range(SAMPLE_SIZE)]
+
+    ip_cycle, int_cycle, v6_cycle = itertools.cycle(ips), itertools.cycle(ints), itertools.cycle(v6_ips)
+    measure('IpRangeIndex.lookup (IPv4 string)', lambda: index.lookup(next(ip_cycle)), SAMPLE_SIZE)
+    measure('IpRangeIndex.lookup (IPv6 string)', lambda: index.lookup(next(v6_cycle)), SAMPLE_SIZE)
+    measure('bisect over mmap array (IPv4 int)', lambda: bisect.bisect_right(index.v4_starts, next(int_cycle)),
+            SAMPLE_SIZE)
+
+    batch = ips[:10000]
+    started_at = time.perf_counter()
+    geo.tag(batch)
+    elapsed = time.perf_counter() - started_at
+    print(f'{"IpGeo.tag (batch of 10000)":<45} {len(batch) / elapsed:>12,.0f} ips/s')
+
+    del geo, index
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Накладные расходы стека middleware на запрос: BaseHTTPMiddleware (прежний) против чистого ASGI.
+
+Запросы идут прямо в ASGI приложение с тривиальным роутом, без сети и HTTP клиента.
+В прежних классах запись ip в БД заменена на буфер, как в текущих: сравнивается только сама обвязка middleware.
+
+python -m benchmarks.middlewares
+"""
+import asyncio
+import json
+
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+
+from benchmarks import measure_async
+from app.ip_collector import ip_visit_buffer
+from app.middlewares import AuthAdminMiddleware, IpCollectorMiddleware, DbSessionMiddleware, ADMIN_SEED_PARAMETER
+
+REQUESTS = 5000
+
+
+class LegacyAuthAdminMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        if 'admin' not in request.url.path:
+            return await call_next(request)
+
+        seed_value = None
+        if request.method == 'GET':
+            seed_value = request.query_params.get('seed')
+        if request.method == 'POST':
+            try:
+                seed_value = json.loads(await request.body()).get('seed')
+            except:
+                pass
+        if seed_value != ADMIN_SEED_PARAMETER:
+            return JSONResponse(status_code=404, content={'detail': 'Not Found'})
+        return await call_next(request)
+
+
+class LegacyIpCollectorMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        ip_visit_buffer.add(None, IpCollectorMiddleware.get_client_ip(request))
+        return await call_next(request)
+
+
+def create_app(*middlewares) -> FastAPI:
+    app = FastAPI()
+
+    @app.get('/ping')
+    async def ping():
+        return PlainTextResponse('pong')
+
+    for middleware in middlewares:
+        app.add_middleware(middleware)
+    return app
+
+
+def create_request(app: FastAPI):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': '/ping', 'raw_path': b'/ping', 'root_path': '', 'query_string': b'',
+        'headers': [(b'host', b'benchmark'), (b'x-forwarded-for', b'203.0.113.7')],
+        'client': ('203.0.113.7', 50000), 'server': ('benchmark', 80),
+    }
+
+    async def send(message):
+        pass
+
+    async def request():
+        # Как у сервера: одно сообщение с телом, дальше - только разрыв соединения
+        messages = iter([{'type': 'http.request', 'body': b'', 'more_body': False}])
+
+        async def receive():
+            return next(messages, {'type': 'http.disconnect'})
+
+        await app({**scope, 'state': {}}, receive, send)
+
+    return request
+
+
+async def main():
+    stacks = {
+        'no middleware': create_app(),
+        'BaseHTTPMiddleware (auth admin, ip collector)':
+            create_app(LegacyAuthAdminMiddleware, LegacyIpCollectorMiddleware),
+        'pure ASGI (auth admin, ip collector, db session)':
+            create_app(AuthAdminMiddleware, IpCollectorMiddleware, DbSessionMiddleware),
+    }
+    for name, app in stacks.items():
+        request = create_request(app)
+        for _ in range(500):
+            await request()
+        await measure_async(name, request, REQUESTS)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+"""Presigned GET ссылки: aioboto3 (прежний путь) против локального S3Presigner.
+
+python -m benchmarks.presigner
+"""
+import asyncio
+import itertools
+from datetime import datetime, timezone
+
+from benchmarks import measure, measure_async
+from s3_manager.aws_s3_config import create_s3_client, BUCKET_NAME
+from s3_manager.presigner import S3Presigner
+
+KEYS = [f'images/{index:06d}.webp' for index in range(1000)]
+
+
+async def main():
+    keys = itertools.cycle(KEYS)
+
+    async def fresh_client():
+        # Так работал gen_presigned_url до общего клиента: новый клиент на каждую ссылку
+        async with create_s3_client() as client:
+            await client.generate_presigned_url('get_object', Params={'Bucket': BUCKET_NAME, 'Key': next(keys)},
+                                                ExpiresIn=60)
+
+    await measure_async('aioboto3, new client per url', fresh_client, 200)
+
+    async with create_s3_client() as client:
+        async def shared_client():
+            await client.generate_presigned_url('get_object', Params={'Bucket': BUCKET_NAME, 'Key': next(keys)},
+                                                ExpiresIn=60)
+
+        await measure_async('aioboto3, shared client', shared_client, 2000)
+
+    presigner = S3Presigner()
+    signed_at = datetime.now(timezone.utc)
+    measure('S3Presigner.sign (no cache)', lambda: presigner.sign(next(keys), 60, signed_at), 50000)
+    measure('S3Presigner.presign (cached, 1000 keys)', lambda: presigner.presign(next(keys), 60), 500000)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,3 +1,6 @@
+import asyncio
+from contextlib import AsyncExitStack
+
 import aioboto3
 from dotenv import load_dotenv
 import os
@@ -10,8 +13,18 @@ AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 REGION_NAME = os.getenv('REGION_NAME')
 BUCKET_NAME = os.getenv('BUCKET_NAME')
 
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 50))
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT', 5))
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT', 30))
+
 
-config=Config(signature_version='s3v4', region_name=REGION_NAME)
+config = Config(
+    signature_version='s3v4',
+    region_name=REGION_NAME,
+    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    connect_timeout=S3_CONNECT_TIMEOUT,
+    read_timeout=S3_READ_TIMEOUT
+)
 
 def create_s3_client():
     session = aioboto3.Session()
@@ -21,4 +34,35 @@ def create_s3_client():
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
         region_name=REGION_NAME,
         config=config
-    )
\ No newline at end of file
+    )
+
+
+class S3ClientManager:
+    """Один S3 клиент (и пул соединений) на все время жизни приложения."""
+
+    def __init__(self):
+        self._client = None
+        self._exit_stack: AsyncExitStack | None = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            if self._client is None:
+                self._exit_stack = AsyncExitStack()
+                self._client = await self._exit_stack.enter_async_context(create_s3_client())
+
+    async def stop(self):
+        async with self._lock:
+            if self._exit_stack is not None:
+                await self._exit_stack.aclose()
+            self._client = None
+            self._exit_stack = None
+
+    async def get_client(self):
+        # Клиент создается лениво, если приложение не вызвало start (например, в скриптах)
+        if self._client is None:
+            await self.start()
+        return self._client
+
+
+s3_client_manager = S3ClientManager()
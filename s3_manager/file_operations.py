@@ -1,34 +1,188 @@
+import hashlib
 import re
-from puremagic import from_string
+from multipart.multipart import MultipartParser, parse_options_header
+from puremagic import from_string, PureError
 from PIL.Image import Resampling
-from fastapi import HTTPException
+from fastapi import HTTPException, UploadFile
+from starlette.requests import Request
 from PIL import Image
 from io import BytesIO
 
+# Сигнатуры png и jpeg находятся в первых байтах файла, остальное для определения типа не нужно
+SNIFF_SIZE = 512
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Запас на boundary и заголовки частей multipart сверх размера самого файла
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+def sniff_file_type(head: bytes, supported_file_types: dict) -> str:
+    try:
+        file_type = from_string(head, mime=True)
+    except PureError:
+        file_type = None
+    if file_type not in supported_file_types:
+        raise HTTPException(status_code=400, detail="Supported file types are {}".format(supported_file_types))
+    return file_type
+
 
 def validate_file(contents: bytes, max_size: int, supported_file_types: dict):
     file_size = len(contents)
     if not(0 < file_size <= max_size):
         raise HTTPException(status_code=400, detail="File size is not between 0 and 1 MB!")
 
-    file_type = from_string(contents, mime=True)
-    if file_type not in supported_file_types:
-        raise HTTPException(status_code=400, detail="Supported file types are {}".format(supported_file_types))
+    return sniff_file_type(contents[:SNIFF_SIZE], supported_file_types)
 
-    return file_type
 
+class UploadValidator:
+    """Собирает файл по кускам и отклоняет его сразу, как только превышен размер или по первым байтам ясен тип."""
+
+    def __init__(self, max_size: int, supported_file_types: dict):
+        self.max_size = max_size
+        self.supported_file_types = supported_file_types
+        self.buffer = bytearray()
+        self.file_type = None
+
+    def feed(self, chunk: bytes):
+        if len(self.buffer) + len(chunk) > self.max_size:
+            raise HTTPException(status_code=413, detail="File size is not between 0 and 1 MB!")
+        self.buffer += chunk
+
+        if self.file_type is None and len(self.buffer) >= SNIFF_SIZE:
+            self.file_type = sniff_file_type(bytes(self.buffer[:SNIFF_SIZE]), self.supported_file_types)
+
+    def finish(self) -> tuple[bytes, str]:
+        if not self.buffer:
+            raise HTTPException(status_code=400, detail="File size is not between 0 and 1 MB!")
+        if self.file_type is None:
+            self.file_type = sniff_file_type(bytes(self.buffer), self.supported_file_types)
+        return bytes(self.buffer), self.file_type
+
+
+async def read_upload_file(file: UploadFile, max_size: int, supported_file_types: dict) -> tuple[bytes, str]:
+    validator = UploadValidator(max_size, supported_file_types)
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        validator.feed(chunk)
+    return validator.finish()
+
+
+async def read_multipart_file(request: Request, field_name: str, max_size: int,
+                              supported_file_types: dict) -> tuple[bytes, str]:
+    """Читает поле field_name из multipart тела запроса по мере получения, не дожидаясь всего тела."""
+    max_body_size = max_size + MULTIPART_OVERHEAD
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > max_body_size:
+        raise HTTPException(status_code=413, detail="File size is not between 0 and 1 MB!")
+
+    content_type, params = parse_options_header(request.headers.get('content-type', ''))
+    boundary = params.get(b'boundary')
+    if content_type != b'multipart/form-data' or not boundary:
+        raise HTTPException(status_code=400, detail='Expected multipart/form-data')
+
+    validator = UploadValidator(max_size, supported_file_types)
+    part = {'header_field': b'', 'header_value': b'', 'headers': {}, 'is_file': False, 'found': False}
+
+    def on_part_begin():
+        part.update(header_field=b'', header_value=b'', headers={}, is_file=False)
+
+    def on_header_field(data, start, end):
+        part['header_field'] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part['header_value'] += data[start:end]
 
-def find_nearest_size(sizes, width, height):
-    # Находит ближайший допустимый размер для заданных ширины и высоты.
-    distances = [(abs(w - width) + abs(h - height), (w, h)) for w, h in sizes]
-    return min(distances)[1]
+    def on_header_end():
+        part['headers'][part['header_field'].lower()] = part['header_value']
+        part['header_field'] = part['header_value'] = b''
 
+    def on_headers_finished():
+        disposition, options = parse_options_header(part['headers'].get(b'content-disposition', b''))
+        part['is_file'] = options.get(b'name') == field_name.encode() and not part['found']
+        part['found'] = part['found'] or part['is_file']
+
+    def on_part_data(data, start, end):
+        if part['is_file']:
+            validator.feed(data[start:end])
+
+    parser = MultipartParser(boundary, {
+        'on_part_begin': on_part_begin,
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': on_headers_finished,
+        'on_part_data': on_part_data,
+    })
+
+    received = 0
+    async for chunk in request.stream():
+        # Тело без Content-Length (chunked) тоже обрывается на превышении лимита
+        received += len(chunk)
+        if received > max_body_size:
+            raise HTTPException(status_code=413, detail="File size is not between 0 and 1 MB!")
+        parser.write(chunk)
+    parser.finalize()
+
+    if not part['found']:
+        raise HTTPException(status_code=400, detail=f'Field "{field_name}" with file is required')
+    return validator.finish()
+
+
+# Варианты картинки хранятся рядом под ключами вида image/avatar/<id>_<hash>_256x256.jpeg
+RENDITION_PATH_PATTERN = re.compile(r'^(?P<base>.+)_(?P<width>\d+)x(?P<height>\d+)\.(?P<extension>\w+)$')
+CONTENT_HASH_PATTERN = re.compile(r'_[0-9a-f]{16}$')
+
+
+def get_content_hash(contents: bytes, *settings) -> str:
+    # В хеш входят и настройки обработки: при их изменении та же картинка получит новые ключи
+    digest = hashlib.sha256(contents)
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()[:16]
+
+
+def is_immutable_path(filepath: str) -> bool:
+    # По ключу с хешем содержимого всегда лежат одни и те же байты
+    match = RENDITION_PATH_PATTERN.match(filepath)
+    return match is not None and CONTENT_HASH_PATTERN.search(match['base']) is not None
+
+
+def get_rendition_path(base_path: str, size: tuple[int, int], extension: str) -> str:
+    width, height = size
+    return f'{base_path}_{width}x{height}.{extension}'
+
+
+def pick_rendition_size(sizes, width: int) -> tuple[int, int]:
+    # Самый маленький вариант не уже запрошенной ширины, иначе самый большой: клиент только уменьшает картинку
+    sizes = sorted(sizes)
+    for size in sizes:
+        if size[0] >= width:
+            return size
+    return sizes[-1]
+
+
+def render_image_variants(image_bytes: bytes, file_type: str, sizes, webp_quality: int | None = None) -> dict:
+    """Все размеры из sizes (и их WebP копии, если передан webp_quality) из одного декодирования.
+
+    Возвращает {(size, extension): bytes}.
+    """
+    image_format = file_type.upper().split('/')[-1]
+    largest = max(sizes, key=lambda size: size[0] * size[1])
 
-def resize_image(image_bytes: bytes, file_type: str, sizes: tuple) -> bytes:
     with Image.open(BytesIO(image_bytes)) as img:
-        width, height = img.size
-        nearest_size = find_nearest_size(sizes, width, height)
-        img = img.resize(nearest_size, Resampling.LANCZOS)
-        output = BytesIO()
-        img.save(output, format=file_type.upper().split('/')[-1])
-        return output.getvalue()
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8), но не меньше самого большого варианта
+        if img.format == 'JPEG':
+            img.draft(img.mode, largest)
+        img.load()
+
+        variants = {}
+        for size in sizes:
+            resized = img.resize(size, Resampling.LANCZOS)
+
+            output = BytesIO()
+            resized.save(output, format=image_format)
+            variants[(size, file_type)] = output.getvalue()
+
+            if webp_quality is not None:
+                output = BytesIO()
+                resized.save(output, format='WEBP', quality=webp_quality)
+                variants[(size, 'webp')] = output.getvalue()
+
+        return variants
@@ -0,0 +1,181 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+load_dotenv()
+
+IMAGE_WORKER_PROCESSES = int(os.getenv('IMAGE_WORKER_PROCESSES', 2))  # 0 - обработка в потоке без пула процессов
+IMAGE_WORKER_QUEUE_SIZE = int(os.getenv('IMAGE_WORKER_QUEUE_SIZE', 16))  # сколько задач может ждать свободный процесс
+IMAGE_WORKER_TIMEOUT = float(os.getenv('IMAGE_WORKER_TIMEOUT', 10))  # секунды на одну задачу
+
+
+class ImageWorker:
+    """Пул процессов для обработки изображений (Pillow), чтобы декодирование и ресайз не блокировали event loop.
+
+    Одновременно выполняется не больше processes задач, еще queue_size ждут своей очереди,
+    остальные сразу получают 503. Слот освобождается, когда задача закончилась или упала по таймауту.
+    По таймауту пул пересоздается, а его процессы завершаются, чтобы зависшая задача не занимала процесс дальше
+    (задачи, выполнявшиеся в том же пуле одновременно с ней, получат 503).
+    """
+
+    def __init__(self, processes: int = IMAGE_WORKER_PROCESSES, queue_size: int = IMAGE_WORKER_QUEUE_SIZE,
+                 timeout: float = IMAGE_WORKER_TIMEOUT):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.timeout = timeout
+
+        self._executor: ProcessPoolExecutor | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        self.jobs = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.failed = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.processing_total = 0.0
+        self.processing_max = 0.0
+
+    def start(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(max(self.processes, 1))
+        if self._executor is None and self.processes > 0:
+            # spawn вместо fork: дочерние процессы не наследуют event loop, потоки и соединения с БД
+            self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+
+    async def stop(self):
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown, True, cancel_futures=True)
+
+    def _reset_executor(self, executor: ProcessPoolExecutor | None, terminate: bool = False):
+        # Следующая задача поднимет новый пул через start(). Пул, который уже заменили, не трогаем
+        if executor is None or executor is not self._executor:
+            return
+        self._executor = None
+        if terminate:
+            # shutdown() не останавливает уже запущенные задачи, поэтому процессы завершаем сами
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, func: Callable, *args) -> asyncio.Future:
+        if self._executor is None:
+            return asyncio.ensure_future(asyncio.to_thread(func, *args))
+        return asyncio.wrap_future(self._executor.submit(func, *args))
+
+    def _record(self, queue_wait: float, processing: float | None):
+        with self._lock:
+            self.jobs += 1
+            self.queue_wait_total += queue_wait
+            self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+            if processing is not None:
+                self.processing_total += processing
+                self.processing_max = max(self.processing_max, processing)
+
+    async def run(self, func: Callable, *args):
+        self.start()
+
+        if self._pending >= max(self.processes, 1) + self.queue_size:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail='Image worker is busy, try again later')
+
+        self._pending += 1
+        queued_at = time.perf_counter()
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            self._pending -= 1
+            raise
+
+        released = False
+
+        def release(done: asyncio.Future | None = None):
+            # Вызывается и по таймауту, и по завершении задачи - слот освобождаем один раз
+            nonlocal released
+            if done is not None and not done.cancelled():
+                # Ошибку задачи, которую уже никто не ждет (таймаут), забираем, чтобы asyncio не ругался в лог
+                done.exception()
+            if released:
+                return
+            released = True
+            self._pending -= 1
+            self._slots.release()
+
+        started_at = time.perf_counter()
+        queue_wait = started_at - queued_at
+        executor = self._executor
+        try:
+            future = self._submit(func, *args)
+        except Exception as e:
+            # Задача не попала в пул (пул сломан или уже остановлен) - слот освобождаем сразу
+            release()
+            self.failed += 1
+            print(f'Image job was not submitted, restarting pool: {e}')
+            self._reset_executor(executor)
+            raise HTTPException(status_code=503, detail='Image worker is unavailable, try again later')
+
+        future.add_done_callback(release)
+
+        try:
+            # shield: отмена ожидания не должна отменять future, его завершение освобождает слот
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._record(queue_wait, None)
+            print(f'Image job timed out after {self.timeout}s (queue wait {queue_wait:.3f}s), restarting pool')
+            self._reset_executor(executor, terminate=True)
+            release()
+            raise HTTPException(status_code=504, detail='Image processing timed out')
+        except BrokenProcessPool as e:
+            # Процесс пула упал (например, OOM на огромной картинке) - следующая задача поднимет новый пул
+            self.failed += 1
+            self._record(queue_wait, time.perf_counter() - started_at)
+            print(f'Image worker pool is broken, restarting: {e}')
+            self._reset_executor(executor)
+            raise HTTPException(status_code=503, detail='Image worker is unavailable, try again later')
+        except Exception as e:
+            self.failed += 1
+            self._record(queue_wait, time.perf_counter() - started_at)
+            print(f'Image job failed: {e}')
+            raise HTTPException(status_code=400, detail='Failed to process image')
+
+        processing = time.perf_counter() - started_at
+        self._record(queue_wait, processing)
+        print(f'Image job done: queue wait {queue_wait:.3f}s, processing {processing:.3f}s')
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            finished = self.jobs - self.timeouts
+            return {
+                'processes': self.processes,
+                'queue_size': self.queue_size,
+                'pending': self._pending,
+                'jobs': self.jobs,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'failed': self.failed,
+                'queue_wait': {
+                    'avg_seconds': round(self.queue_wait_total / self.jobs, 6) if self.jobs else 0.0,
+                    'max_seconds': round(self.queue_wait_max, 6),
+                },
+                'processing': {
+                    'avg_seconds': round(self.processing_total / finished, 6) if finished else 0.0,
+                    'max_seconds': round(self.processing_max, 6),
+                },
+            }
+
+
+image_worker = ImageWorker()
@@ -0,0 +1,119 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from dotenv import load_dotenv
+
+from s3_manager.aws_s3_config import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, REGION_NAME, BUCKET_NAME
+
+load_dotenv()
+
+# Хост, на который выписываются ссылки (по умолчанию как у botocore: глобальный virtual-hosted endpoint)
+S3_PRESIGN_HOST = os.getenv('S3_PRESIGN_HOST') or f'{BUCKET_NAME}.s3.amazonaws.com'
+# Внутри одного интервала ссылка на файл не меняется, поэтому ее кешируют браузер и CDN
+S3_PRESIGN_BUCKET_SECONDS = int(os.getenv('S3_PRESIGN_BUCKET_SECONDS', 60))
+S3_PRESIGN_CACHE_SIZE = int(os.getenv('S3_PRESIGN_CACHE_SIZE', 50000))
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+def _quote(value: str, safe: str = '-_.~') -> str:
+    return quote(value, safe=safe)
+
+
+class S3Presigner:
+    """Подпись GET ссылок на S3 (SigV4 query string) без обращения к botocore.
+
+    Ключ подписи выводится один раз на день и регион, готовые ссылки кешируются на интервал bucket_seconds:
+    X-Amz-Date выставляется на начало интервала, а срок жизни продлевается на длину интервала,
+    поэтому любая выданная ссылка действует не меньше запрошенного expiration.
+    """
+
+    def __init__(self, access_key: str = AWS_ACCESS_KEY_ID, secret_key: str = AWS_SECRET_ACCESS_KEY,
+                 region: str = REGION_NAME, bucket: str = BUCKET_NAME, host: str = S3_PRESIGN_HOST,
+                 bucket_seconds: int = S3_PRESIGN_BUCKET_SECONDS, cache_size: int = S3_PRESIGN_CACHE_SIZE):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.bucket = bucket
+        self.host = host
+        self.bucket_seconds = max(bucket_seconds, 1)
+        self.cache_size = cache_size
+
+        self._signing_keys: dict[tuple[str, str], bytes] = {}
+        self._urls: dict[tuple[str, int, int], tuple[int, str]] = {}
+        self._urls_time_bucket = None
+        self._lock = threading.Lock()
+
+    def _get_signing_key(self, date_stamp: str) -> bytes:
+        key = (date_stamp, self.region)
+        signing_key = self._signing_keys.get(key)
+        if signing_key is None:
+            k_date = _hmac(('AWS4' + self.secret_key).encode(), date_stamp)
+            k_region = _hmac(k_date, self.region)
+            k_service = _hmac(k_region, 's3')
+            signing_key = _hmac(k_service, 'aws4_request')
+            # Ключи за прошлые дни больше не понадобятся
+            self._signing_keys = {key: signing_key}
+        return signing_key
+
+    def sign(self, filepath: str, expiration: int, signed_at: datetime) -> str:
+        amz_date = signed_at.strftime('%Y%m%dT%H%M%SZ')
+        date_stamp = signed_at.strftime('%Y%m%d')
+        scope = f'{date_stamp}/{self.region}/s3/aws4_request'
+
+        canonical_uri = '/' + _quote(filepath, safe='/~')
+        query = '&'.join(f'{name}={_quote(value)}' for name, value in (
+            ('X-Amz-Algorithm', ALGORITHM),
+            ('X-Amz-Credential', f'{self.access_key}/{scope}'),
+            ('X-Amz-Date', amz_date),
+            ('X-Amz-Expires', str(expiration)),
+            ('X-Amz-SignedHeaders', 'host'),
+        ))
+
+        canonical_request = '\n'.join((
+            'GET', canonical_uri, query, f'host:{self.host}\n', 'host', 'UNSIGNED-PAYLOAD'
+        ))
+        string_to_sign = '\n'.join((
+            ALGORITHM, amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()
+        ))
+        signature = hmac.new(self._get_signing_key(date_stamp), string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        return f'https://{self.host}{canonical_uri}?{query}&X-Amz-Signature={signature}'
+
+    def presign(self, filepath: str, expiration: int = 60, bucket_seconds: int | None = None) -> str | None:
+        # bucket_seconds больше стандартного - ссылка дольше не меняется (для неизменяемых ключей)
+        if not (self.access_key and self.secret_key):
+            return None
+
+        now = int(time.time())
+        bucket_seconds = max(bucket_seconds or self.bucket_seconds, 1)
+        signed_at_ts = now // bucket_seconds * bucket_seconds
+        cache_key = (filepath, expiration, bucket_seconds)
+
+        with self._lock:
+            time_bucket = now // self.bucket_seconds
+            if self._urls_time_bucket != time_bucket or len(self._urls) >= self.cache_size:
+                self._urls = {}
+                self._urls_time_bucket = time_bucket
+
+            cached = self._urls.get(cache_key)
+            if cached is not None and cached[0] == signed_at_ts:
+                return cached[1]
+
+            signed_at = datetime.fromtimestamp(signed_at_ts, tz=timezone.utc)
+            url = self.sign(filepath, expiration + bucket_seconds, signed_at)
+            self._urls[cache_key] = (signed_at_ts, url)
+
+        return url
+
+
+s3_presigner = S3Presigner()
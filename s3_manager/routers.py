@@ -1,21 +1,47 @@
+import asyncio
 import base64
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
 
-import aioboto3
-from botocore.exceptions import NoCredentialsError
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
+from dotenv import load_dotenv
+from fastapi import APIRouter, UploadFile, HTTPException, Depends, Query, BackgroundTasks
 from fastapi.responses import JSONResponse
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
 
-from app.database import get_db
-from app.dependencies import verify_token
-from app.utils import get_user_from_token
-from s3_manager.file_operations import validate_file, resize_image
-from s3_manager.aws_s3_config import BUCKET_NAME, config, create_s3_client
+from app.database import get_db, SessionLocal
+from app.dependencies import get_current_user
+from starlette.requests import Request
+
+from s3_manager.file_operations import validate_file, render_image_variants, get_rendition_path, \
+    pick_rendition_size, get_content_hash, is_immutable_path, read_upload_file, read_multipart_file, \
+    RENDITION_PATH_PATTERN
+from s3_manager.aws_s3_config import BUCKET_NAME, s3_client_manager
+from s3_manager.presigner import s3_presigner
+from s3_manager.image_worker import image_worker
+from s3_manager.schemes import AvatarUploadRequest, AvatarUploadForm, AvatarUploadComplete, AvatarUploadStatus
 from admin.dependencies import is_admin
 from app import models
 
+load_dotenv()
+
 file_router = APIRouter()
 
+# Вместе с каждым размером сохраняется его WebP копия
+IMAGE_WEBP_ENABLED = os.getenv('IMAGE_WEBP_ENABLED', 'false').lower() == 'true'
+IMAGE_WEBP_QUALITY = int(os.getenv('IMAGE_WEBP_QUALITY', 80))
+# Ключи с хешем содержимого не перезаписываются, поэтому ссылки на них живут долго и кешируются браузером/CDN.
+# Ссылка не меняется IMAGE_URL_BUCKET_SECONDS и действует не меньше IMAGE_URL_EXPIRATION (в сумме до 7 дней)
+IMAGE_URL_EXPIRATION = int(os.getenv('IMAGE_URL_EXPIRATION', 86400))
+IMAGE_URL_BUCKET_SECONDS = int(os.getenv('IMAGE_URL_BUCKET_SECONDS', 3600))
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Загрузка аватара напрямую в бакет: исходники лежат под этим префиксом до обработки
+# (на префикс стоит повесить lifecycle правило, чтобы брошенные загрузки удалялись сами)
+AVATAR_UPLOAD_PREFIX = os.getenv('AVATAR_UPLOAD_PREFIX', 'uploads/avatar/')
+AVATAR_UPLOAD_EXPIRATION = int(os.getenv('AVATAR_UPLOAD_EXPIRATION', 600))  # секунды
+
 
 def get_class_dir_name(model_class) -> str:
     class_name = model_class.__name__
@@ -71,66 +97,186 @@ SUPPORTED_FILE_TYPES = {
     'image/jpeg': 'jpeg'
 }
 
-# Создание клиента S3 с использованием aioboto3
-session = aioboto3.Session()
+IMAGE_SIZES = {config['class']: config['size'] for config in FILE_PATHS.values()}
+
 bucket = BUCKET_NAME
 
+S3_DELETE_BATCH_SIZE = 1000  # ограничение delete_objects
+# Файлы моложе этого возраста сборщик мусора не трогает: загрузка могла еще не закоммитить filepath
+S3_GC_MIN_AGE = int(os.getenv('S3_GC_MIN_AGE', 3600))
+
+# Ссылки на фоновые задачи, иначе сборщик мусора может удалить задачу до ее завершения
+background_tasks_set: set[asyncio.Task] = set()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks_set.add(task)
+    task.add_done_callback(background_tasks_set.discard)
+
+
+class ImageOptions(NamedTuple):
+    width: Optional[int] = None
+    webp: bool = False
+
+
+def get_image_options(image_width: Optional[int] = Query(None, ge=1, le=4096),
+                      image_format: Optional[str] = Query(None, pattern='^webp$')) -> ImageOptions:
+    return ImageOptions(width=image_width, webp=image_format == 'webp')
+
+
+def get_image_path(obj, options: ImageOptions | None = None) -> str:
+    # В filepath лежит самый большой вариант, остальные размеры находятся по тому же шаблону ключа
+    match = RENDITION_PATH_PATTERN.match(obj.filepath)
+    if options is None or match is None or type(obj) not in IMAGE_SIZES:
+        return obj.filepath  # дефолтные картинки и файлы, загруженные до появления вариантов
+
+    size = (int(match['width']), int(match['height']))
+    if options.width is not None:
+        size = pick_rendition_size(IMAGE_SIZES[type(obj)], options.width)
+    extension = 'webp' if options.webp and IMAGE_WEBP_ENABLED else match['extension']
+    return get_rendition_path(match['base'], size, extension)
+
 
 async def s3_upload(contents: bytes, key: str):
     print(f'Uploading file {key} to s3')
-    async with create_s3_client() as client:
-        try:
-            await client.put_object(Body=contents, Bucket=bucket, Key=key)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail='Failed to upload file')
+    client = await s3_client_manager.get_client()
+    try:
+        extension = key.rsplit('.', 1)[-1]
+        await client.put_object(Body=contents, Bucket=bucket, Key=key, ContentType=f'image/{extension}',
+                                CacheControl=IMAGE_CACHE_CONTROL)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail='Failed to upload file')
 
 
-async def s3_delete(key: str):
-    print(f'Deleting file {key} from s3')
-    async with create_s3_client() as client:
+async def s3_delete_keys(keys: list[str]) -> int:
+    # delete_objects принимает не больше 1000 ключей за запрос
+    client = await s3_client_manager.get_client()
+    deleted = 0
+    for i in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+        chunk = keys[i:i + S3_DELETE_BATCH_SIZE]
+        print(f'Deleting {len(chunk)} files from s3')
         try:
-            await client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key}]})
+            response = await client.delete_objects(
+                Bucket=bucket, Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
+            )
         except Exception as e:
             raise HTTPException(status_code=500, detail='Failed to delete old file')
 
+        errors = response.get('Errors', [])
+        for error in errors:
+            print(f"Failed to delete {error.get('Key')}: {error.get('Message')}")
+        deleted += len(chunk) - len(errors)
+    return deleted
 
-async def s3_delete_old_files(prefix: str):
-    async with create_s3_client() as client:
-        response = await client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                await s3_delete(obj['Key'])
+
+async def s3_list_objects(prefix: str):
+    # list_objects_v2 отдает не больше 1000 ключей за раз, пагинатор проходит по всем страницам
+    client = await s3_client_manager.get_client()
+    paginator = client.get_paginator('list_objects_v2')
+    async for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+async def s3_delete_image(filepath: str, sizes):
+    # Удаляет все варианты старой картинки одним запросом, вызывается в фоне уже после коммита
+    match = RENDITION_PATH_PATTERN.match(filepath)
+    if match is not None:
+        keys = [get_rendition_path(match['base'], size, extension)
+                for size in sizes for extension in (match['extension'], 'webp')]
+    else:
+        keys = [filepath]
+
+    try:
+        await s3_delete_keys(keys)
+    except Exception as e:
+        print(f'Failed to delete old image {filepath}: {e}')
+
+
+async def s3_delete_old_files(prefix: str) -> int:
+    # Ключи удаляются пачками по мере чтения страниц списка, запускается в фоне через run_in_background
+    keys = []
+    deleted = 0
+    try:
+        async for obj in s3_list_objects(prefix):
+            keys.append(obj['Key'])
+            if len(keys) >= S3_DELETE_BATCH_SIZE:
+                deleted += await s3_delete_keys(keys)
+                keys = []
+        if keys:
+            deleted += await s3_delete_keys(keys)
+    except Exception as e:
+        print(f'Failed to delete files with prefix {prefix}: {e}')
+    return deleted
 
 
 async def s3_download(key: str) -> bytes:
     print(f'Downloading file {key} from s3')
-    async with create_s3_client() as client:
-        try:
-            response = await client.get_object(Bucket=BUCKET_NAME, Key=key)
-            async with response['Body'] as stream:
-                contents = await stream.read()
-            return contents
-        except Exception as e:
-            print(e)
-            raise HTTPException(status_code=500, detail='Failed to download file:')
+    client = await s3_client_manager.get_client()
+    try:
+        response = await client.get_object(Bucket=BUCKET_NAME, Key=key)
+        async with response['Body'] as stream:
+            contents = await stream.read()
+        return contents
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail='Failed to download file:')
 
 
 async def gen_presigned_url(filepath, expiration=60):
-    async with create_s3_client() as client:
-        try:
-            response = await client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': BUCKET_NAME, 'Key': filepath},
-                ExpiresIn=expiration
-            )
-            return response
-        except NoCredentialsError:
-            print("Ошибка: Неверные учетные данные AWS")
-            return None
+    # Подпись считается локально и кешируется, запросов к botocore нет
+    response = s3_presigner.presign(filepath, expiration)
+    if response is None:
+        print("Ошибка: Неверные учетные данные AWS")
+    return response
+
 
+async def gen_image_url(obj, options: ImageOptions | None = None, expiration=60):
+    filepath = get_image_path(obj, options)
+    if is_immutable_path(filepath):
+        return s3_presigner.presign(filepath, max(expiration, IMAGE_URL_EXPIRATION), IMAGE_URL_BUCKET_SECONDS)
+    return await gen_presigned_url(filepath, expiration)
 
-async def upload_avatar_on_s3(base64_image: str, token: str = Depends(verify_token),
-                              db: Session = Depends(get_db)):
+
+async def upload_image_variants(contents: bytes, file_type: str, sizes, base_path: str) -> str:
+    # Pillow работает в отдельном процессе и не блокирует event loop
+    variants = await image_worker.run(render_image_variants, contents, file_type, sizes,
+                                      IMAGE_WEBP_QUALITY if IMAGE_WEBP_ENABLED else None)
+
+    # Все варианты загружаются параллельно
+    await asyncio.gather(*(
+        s3_upload(contents=variant, key=get_rendition_path(base_path, size, extension))
+        for (size, extension), variant in variants.items()
+    ))
+
+    largest = max(sizes, key=lambda size: size[0] * size[1])
+    return get_rendition_path(base_path, largest, file_type)
+
+
+async def replace_image(obj, file_dir: str, contents: bytes, file_type: str) -> str | None:
+    """Загружает картинку под ключами с хешем содержимого и переключает на нее obj.filepath.
+
+    Возвращает путь старой картинки, которую можно удалить после коммита, или None.
+    """
+    sizes = FILE_PATHS[file_dir]['size']
+    object_path = FILE_PATHS[file_dir]['dirname'] + str(obj.id)
+    base_path = f'{object_path}_{get_content_hash(contents, sizes, IMAGE_WEBP_ENABLED)}'
+
+    old_path = obj.filepath
+    match = RENDITION_PATH_PATTERN.match(old_path or '')
+    if match is not None and match['base'] == base_path:
+        return None  # те же байты уже загружены
+
+    obj.filepath = await upload_image_variants(contents, file_type, sizes, base_path)
+
+    # Дефолтные и чужие картинки не удаляем
+    if old_path and (old_path.startswith(object_path + '_') or old_path.startswith(object_path + '.')):
+        return old_path
+    return None
+
+
+async def upload_avatar_on_s3(base64_image: str, user: models.User, db: Session, background_tasks: BackgroundTasks):
     try:
         image_data = base64.b64decode(base64_image)
         file_type = validate_file(image_data, MAX_FILE_SIZE, SUPPORTED_FILE_TYPES)
@@ -138,64 +284,215 @@ async def upload_avatar_on_s3(base64_image: str, token: str = Depends(verify_tok
         print(e)
         raise HTTPException(status_code=500, detail='Something went wrong with file data.')
 
-    user = get_user_from_token(db, token)
-    file_path_no_extension = FILE_PATHS['avatar']['dirname'] + user.id
+    try:
+        old_path = await replace_image(user, 'avatar', image_data, SUPPORTED_FILE_TYPES[file_type])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail='Something went wrong.')
+
+    # Фоновые задачи выполняются после ответа, то есть после коммита нового filepath
+    if old_path:
+        background_tasks.add_task(s3_delete_image, old_path, FILE_PATHS['avatar']['size'])
 
-    await s3_delete_old_files(file_path_no_extension)
+    return JSONResponse(status_code=200, content={"message": "File uploaded successfully"})
 
-    resized_contents = resize_image(image_data, SUPPORTED_FILE_TYPES[file_type], FILE_PATHS['avatar']['size'])
 
-    full_path = file_path_no_extension + '.' + SUPPORTED_FILE_TYPES[file_type]
+async def store_any_file(file_dir: str, id, contents: bytes, file_type: str, db: Session) -> str:
+    obj_class = FILE_PATHS[file_dir]['class']
 
-    try:
-        await s3_upload(contents=resized_contents,
-                        key=full_path)
+    id = str(id)
+    id = int(id) if id.isdigit() else id
+
+    found_object = db.query(obj_class).filter(obj_class.id == id).first()
+
+    if not found_object:
+        raise HTTPException(status_code=400,
+                            detail='Object "{}" with id={} not found'.format(file_dir, id))
 
-        user.filepath = full_path
-        db.commit()
+    try:
+        old_path = await replace_image(found_object, file_dir, contents, SUPPORTED_FILE_TYPES[file_type])
 
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail='Something went wrong.')
+        raise HTTPException(status_code=500, detail='Something went while file uploading wrong.')
 
-    return JSONResponse(status_code=200, content={"message": "File uploaded successfully"})
+    # Новый filepath коммитит DbSessionMiddleware в конце запроса
+    db.flush()
 
+    if old_path:
+        # Старые файлы удаляются в фоне и только после коммита: при откате объект ссылается на них по-прежнему.
+        # Коммит идет в потоке, поэтому задача ставится в event loop через call_soon_threadsafe
+        loop = asyncio.get_running_loop()
+        size = FILE_PATHS[file_dir]['size']
+        run_after_commit(db, lambda: loop.call_soon_threadsafe(
+            lambda: run_in_background(s3_delete_image(old_path, size))
+        ))
+
+    return found_object.filepath
 
-@file_router.post("/upload/any/{file_dir}/{id}")  # Роут только для админов!
-async def upload_any_on_s3(file_dir: str, id: str, file: UploadFile = File(...), db: Session = Depends(get_db),
-                           have_access: bool = Depends(is_admin)):
-    contents = await file.read()
-    file_type = validate_file(contents, MAX_FILE_SIZE, SUPPORTED_FILE_TYPES)
 
+async def upload_any_file(file_dir: str, id, file: UploadFile, db: Session) -> str:
+    # Для админки: файл уже разобран sqladmin, читаем его кусками с теми же проверками
     if file_dir not in FILE_PATHS.keys():
         raise HTTPException(status_code=400, detail='Available file dirs are: {}'.format(FILE_PATHS.keys()))
 
-    id = str(id)
-    file_path_no_extension = FILE_PATHS[file_dir]['dirname'] + id
+    contents, file_type = await read_upload_file(file, MAX_FILE_SIZE, SUPPORTED_FILE_TYPES)
+    return await store_any_file(file_dir, id, contents, file_type, db)
+
+
+UPLOAD_REQUEST_BODY = {
+    'requestBody': {
+        'required': True,
+        'content': {'multipart/form-data': {'schema': {
+            'type': 'object',
+            'required': ['file'],
+            'properties': {'file': {'type': 'string', 'format': 'binary'}},
+        }}},
+    }
+}
+
+
+@file_router.post("/upload/any/{file_dir}/{id}", openapi_extra=UPLOAD_REQUEST_BODY)  # Роут только для админов!
+async def upload_any_on_s3(file_dir: str, id: str, request: Request, db: Session = Depends(get_db),
+                           have_access: bool = Depends(is_admin)):
+    if file_dir not in FILE_PATHS.keys():
+        raise HTTPException(status_code=400, detail='Available file dirs are: {}'.format(FILE_PATHS.keys()))
 
-    await s3_delete_old_files(file_path_no_extension)
+    # Тело читается потоком: слишком большой файл или неподдерживаемый тип обрывают запрос до конца загрузки
+    contents, file_type = await read_multipart_file(request, 'file', MAX_FILE_SIZE, SUPPORTED_FILE_TYPES)
+    return await store_any_file(file_dir, id, contents, file_type, db)
+
+
+def is_default_image(key: str) -> bool:
+    return key.rsplit('/', 1)[-1].startswith('default.')
+
+
+@file_router.post("/maintenance/gc")  # Роут только для админов!
+async def collect_unreferenced_files(dry_run: bool = True, db: Session = Depends(get_db),
+                                     have_access: bool = Depends(is_admin)):
+    # Ключи и префиксы вариантов всех картинок, на которые ссылается какой-нибудь filepath
+    referenced_paths = set()
+    referenced_bases = set()
+    for config in FILE_PATHS.values():
+        obj_class = config['class']
+        for filepath in db.scalars(select(obj_class.filepath).distinct()):
+            referenced_paths.add(filepath)
+            match = RENDITION_PATH_PATTERN.match(filepath)
+            if match is not None:
+                referenced_bases.add(match['base'])
+
+    min_modified_at = datetime.now(timezone.utc) - timedelta(seconds=S3_GC_MIN_AGE)
+    scanned = 0
+    unreferenced = []
+    for dirname in {config['dirname'] for config in FILE_PATHS.values()}:
+        async for obj in s3_list_objects(dirname):
+            scanned += 1
+            key = obj['Key']
+            match = RENDITION_PATH_PATTERN.match(key)
+            if key in referenced_paths or (match is not None and match['base'] in referenced_bases):
+                continue
+            if is_default_image(key) or obj['LastModified'] > min_modified_at:
+                continue
+            unreferenced.append(key)
+
+    deleted = 0 if dry_run else await s3_delete_keys(unreferenced)
+    print(f'S3 gc: scanned {scanned}, unreferenced {len(unreferenced)}, deleted {deleted}')
+
+    return {
+        'dry_run': dry_run,
+        'scanned': scanned,
+        'unreferenced': len(unreferenced),
+        'deleted': deleted,
+        'keys': unreferenced[:100],
+    }
 
-    resized_contents = resize_image(contents, SUPPORTED_FILE_TYPES[file_type], FILE_PATHS[file_dir]['size'])
 
-    full_path = file_path_no_extension + '.' + SUPPORTED_FILE_TYPES[file_type]
+@file_router.post("/avatar/upload-url", response_model=AvatarUploadForm)
+async def create_avatar_upload(upload: AvatarUploadRequest, user: models.User = Depends(get_current_user)):
+    # Клиент загружает файл формой прямо в S3, размер и тип проверяет сам S3 по условиям подписи
+    if upload.content_type not in SUPPORTED_FILE_TYPES:
+        raise HTTPException(status_code=400,
+                            detail="Supported file types are {}".format(list(SUPPORTED_FILE_TYPES)))
 
+    key = f'{AVATAR_UPLOAD_PREFIX}{user.id}/{uuid.uuid4().hex}'
+    client = await s3_client_manager.get_client()
     try:
-        await s3_upload(contents=resized_contents,
-                        key=full_path)
+        form = await client.generate_presigned_post(
+            Bucket=bucket,
+            Key=key,
+            Fields={'Content-Type': upload.content_type},
+            Conditions=[
+                {'Content-Type': upload.content_type},
+                ['content-length-range', 1, MAX_FILE_SIZE],
+            ],
+            ExpiresIn=AVATAR_UPLOAD_EXPIRATION,
+        )
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail='Failed to create upload form')
+
+    return AvatarUploadForm(url=form['url'], fields=form['fields'], key=key, expires_in=AVATAR_UPLOAD_EXPIRATION)
+
 
+async def process_uploaded_avatar(user_id: str, key: str):
+    # Работает в фоне после ответа, поэтому открывает свою сессию БД
+    try:
+        contents = await s3_download(key)
+        file_type = validate_file(contents, MAX_FILE_SIZE, SUPPORTED_FILE_TYPES)
+
+        # Сессия не держит соединение из пула, пока идут ресайз и загрузка в S3:
+        # пользователь читается до обработки, а новый путь пишется отдельной короткой транзакцией
+        with SessionLocal() as db:
+            user = db.get(models.User, user_id)
+            if user is None:
+                return
+        current_path = user.filepath
+
+        old_path = await replace_image(user, 'avatar', contents, SUPPORTED_FILE_TYPES[file_type])
+        if user.filepath == current_path:
+            return
+
+        with SessionLocal() as db:
+            # Если аватар успели сменить, пока шла обработка, его не перезаписываем
+            updated = db.execute(
+                update(models.User)
+                .where(models.User.id == user_id, models.User.filepath == current_path)
+                .values(filepath=user.filepath)
+            ).rowcount
+            db.commit()
+
+        if not updated:
+            await s3_delete_image(user.filepath, FILE_PATHS['avatar']['size'])
+        elif old_path:
+            await s3_delete_image(old_path, FILE_PATHS['avatar']['size'])
     except Exception as e:
-        raise HTTPException(status_code=500, detail='Something went while file uploading wrong.')
+        print(f'Failed to process uploaded avatar {key}: {e}')
+    finally:
+        try:
+            await s3_delete_keys([key])
+        except Exception as e:
+            print(f'Failed to delete uploaded avatar {key}: {e}')
 
-    obj_class = FILE_PATHS[file_dir]['class']
 
-    id = int(id) if id.isdigit() else id
+@file_router.post("/avatar/complete", response_model=AvatarUploadStatus, status_code=202)
+async def complete_avatar_upload(upload: AvatarUploadComplete, user: models.User = Depends(get_current_user)):
+    if not upload.key.startswith(f'{AVATAR_UPLOAD_PREFIX}{user.id}/'):
+        raise HTTPException(status_code=400, detail='Invalid upload key')
 
-    found_object = db.query(obj_class).filter(obj_class.id == id).first()
+    # Дешевая проверка до постановки в обработку: файл загружен и не больше лимита
+    client = await s3_client_manager.get_client()
+    try:
+        head = await client.head_object(Bucket=bucket, Key=upload.key)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail='Uploaded file not found')
 
-    if not found_object:
-        raise HTTPException(status_code=400,
-                            detail='Object "{}" with id={} not found'.format(file_dir, id))
+    if not (0 < head['ContentLength'] <= MAX_FILE_SIZE):
+        run_in_background(s3_delete_keys([upload.key]))
+        raise HTTPException(status_code=400, detail="File size is not between 0 and 1 MB!")
 
-    found_object.filepath = full_path
-    db.commit()
+    # Скачивание, проверка содержимого, ресайз и загрузка вариантов идут в фоне, новый аватар появится в GET /user/
+    run_in_background(process_uploaded_avatar(user.id, upload.key))
 
-    return full_path
+    return AvatarUploadStatus(status='processing')
@@ -1 +1,20 @@
-from pydantic import BaseModel
\ No newline at end of file
+from pydantic import BaseModel
+
+
+class AvatarUploadRequest(BaseModel):
+    content_type: str
+
+
+class AvatarUploadForm(BaseModel):
+    url: str
+    fields: dict[str, str]
+    key: str
+    expires_in: int
+
+
+class AvatarUploadComplete(BaseModel):
+    key: str
+
+
+class AvatarUploadStatus(BaseModel):
+    status: str
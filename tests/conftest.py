@@ -0,0 +1,79 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+# Приложение читает настройки при импорте, поэтому окружение задается до импорта app.*.
+# DATABASE_URL можно передать снаружи (например, Postgres), по умолчанию - временный файл SQLite
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/test.db')
+for name, value in {
+    'JWT_SECRET_KEY': 'test-secret',
+    'ADMIN_LOGIN': 'admin',
+    'ADMIN_PASSWORD': 'admin',
+    'ADMIN_SEED_PARAMETER': 'test-seed',
+    'AWS_ACCESS_KEY_ID': 'AKIDEXAMPLE',
+    'AWS_SECRET_ACCESS_KEY': 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+    'REGION_NAME': 'eu-central-1',
+    'BUCKET_NAME': 'test-bucket',
+}.items():
+    os.environ.setdefault(name, value)
+
+import pytest
+from sqlalchemy import event
+
+from app.database import engine, SessionLocal
+from app.models import Base
+
+
+@pytest.fixture(scope='session', autouse=True)
+def tables():
+    Base.metadata.create_all(engine)
+    yield
+    Base.metadata.drop_all(engine)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+        # Каждый тест начинает с пустых таблиц
+        with engine.begin() as connection:
+            for table in reversed(Base.metadata.sorted_tables):
+                connection.execute(table.delete())
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements: list[str] = []
+        self.commits = 0
+
+    def __len__(self):
+        return len(self.statements)
+
+
+@pytest.fixture
+def count_queries():
+    """Контекстный менеджер, считающий запросы (before_cursor_execute) и коммиты движка внутри блока."""
+
+    @contextmanager
+    def counting():
+        counter = QueryCounter()
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            counter.statements.append(statement)
+
+        def commit(conn):
+            counter.commits += 1
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'commit', commit)
+        try:
+            yield counter
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+            event.remove(engine, 'commit', commit)
+
+    return counting
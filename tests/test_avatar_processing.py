@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from app import models
+from app.database import engine
+from s3_manager import routers
+
+OLD_AVATAR = 'image/avatar/{id}_0123456789abcdef.jpeg'
+NEW_AVATAR = 'image/avatar/{id}_fedcba9876543210.jpeg'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """Подменяет обращения к S3 и записывает, что удалялось и сколько соединений БД было занято при загрузке."""
+    calls = {'deleted': [], 'checked_out': []}
+
+    async def s3_download(key):
+        return b'image'
+
+    async def upload_image_variants(contents, file_type, sizes, base_path):
+        calls['checked_out'].append(engine.pool.checkedout())
+        await calls.get('during_upload', asyncio.sleep)(0)
+        return NEW_AVATAR.format(id=base_path.rsplit('/', 1)[1].split('_')[0])
+
+    async def s3_delete_image(filepath, sizes):
+        calls['deleted'].append(filepath)
+
+    async def s3_delete_keys(keys):
+        pass
+
+    monkeypatch.setattr(routers, 's3_download', s3_download)
+    monkeypatch.setattr(routers, 'validate_file', lambda contents, max_size, types: 'image/jpeg')
+    monkeypatch.setattr(routers, 'upload_image_variants', upload_image_variants)
+    monkeypatch.setattr(routers, 's3_delete_image', s3_delete_image)
+    monkeypatch.setattr(routers, 's3_delete_keys', s3_delete_keys)
+    return calls
+
+
+def add_user(db) -> int:
+    user = models.User(username='avatar_owner')
+    db.add(user)
+    db.flush()
+    user_id = user.id
+    user.filepath = OLD_AVATAR.format(id=user_id)
+    # После коммита сессия теста возвращает соединение в пул
+    db.commit()
+    return user_id
+
+
+def test_avatar_is_processed_without_holding_a_connection(db, s3):
+    user_id = add_user(db)
+
+    asyncio.run(routers.process_uploaded_avatar(user_id, 'upload/avatar'))
+
+    assert s3['checked_out'] == [0]
+    db.expire_all()
+    assert db.get(models.User, user_id).filepath == NEW_AVATAR.format(id=user_id)
+    assert s3['deleted'] == [OLD_AVATAR.format(id=user_id)]
+
+
+def test_avatar_changed_during_processing_is_kept(db, s3):
+    user_id = add_user(db)
+    concurrent_path = f'image/avatar/{user_id}_concurrent.jpeg'
+
+    async def change_avatar(_):
+        db.get(models.User, user_id).filepath = concurrent_path
+        db.commit()
+
+    s3['during_upload'] = change_avatar
+    asyncio.run(routers.process_uploaded_avatar(user_id, 'upload/avatar'))
+
+    db.expire_all()
+    assert db.get(models.User, user_id).filepath == concurrent_path
+    # Загруженная, но так и не назначенная картинка удаляется
+    assert s3['deleted'] == [NEW_AVATAR.format(id=user_id)]
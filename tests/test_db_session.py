@@ -0,0 +1,99 @@
+import threading
+from datetime import datetime, timezone
+
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from app import models
+from app.crud import create_user, deactivate_token
+from app.database import engine, get_db, run_after_commit
+from app.middlewares import DbSessionMiddleware
+from app.token_cache import token_cache, TokenRecord
+
+app = FastAPI()
+app.add_middleware(DbSessionMiddleware)
+loop_threads = []
+
+
+@app.post('/users/{username}')
+async def add_user(username: str, fail: bool = False, db: Session = Depends(get_db)):
+    loop_threads.append(threading.get_ident())
+    create_user(db, 'web3', username)
+    if fail:
+        raise HTTPException(status_code=400, detail='fail')
+    return {'ok': True}
+
+
+@app.get('/ping')
+async def ping():
+    return {'ok': True}
+
+
+client = TestClient(app)
+
+
+def count_commits(func):
+    threads = []
+
+    def commit(conn):
+        threads.append(threading.get_ident())
+
+    event.listen(engine, 'commit', commit)
+    try:
+        func()
+    finally:
+        event.remove(engine, 'commit', commit)
+    return threads
+
+
+def get_usernames(db) -> list[str]:
+    return list(db.execute(select(models.User.username)).scalars())
+
+
+def test_request_writes_are_committed_off_the_event_loop(db):
+    loop_threads.clear()
+    commit_threads = count_commits(lambda: client.post('/users/committed'))
+
+    assert get_usernames(db) == ['committed']
+    assert len(commit_threads) == 1
+    assert commit_threads[0] != loop_threads[0]
+
+
+def test_failed_request_is_rolled_back(db):
+    commit_threads = count_commits(lambda: client.post('/users/rolled_back', params={'fail': True}))
+
+    assert get_usernames(db) == []
+    assert commit_threads == []
+
+
+def test_request_without_db_does_not_commit():
+    assert count_commits(lambda: client.get('/ping')) == []
+
+
+def test_after_commit_callbacks(db):
+    calls = []
+
+    run_after_commit(db, lambda: calls.append('rolled back'))
+    db.add(models.User(username='rolled_back'))
+    db.rollback()
+    run_after_commit(db, lambda: calls.append('committed'))
+    db.add(models.User(username='committed'))
+    db.commit()
+    db.commit()
+
+    assert calls == ['committed']
+
+
+def test_deactivated_token_is_evicted_again_after_commit(db):
+    user = create_user(db, 'web3', 'token_owner')
+    db.add(models.Token(access_token='token', user_id=user.id, expires_at=datetime.now(timezone.utc)))
+    db.commit()
+
+    deactivate_token(db, 'token')
+    # До коммита строка еще видна другим транзакциям, и параллельный запрос успел закешировать токен
+    token_cache.add(TokenRecord(1, 'token', user.id), None)
+    db.commit()
+
+    assert token_cache.get('token') == (False, None)
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from s3_manager.image_worker import ImageWorker
+
+
+def double(value: int) -> int:
+    return value * 2
+
+
+def test_run_returns_result():
+    worker = ImageWorker(processes=0, queue_size=0, timeout=5)
+
+    assert asyncio.run(worker.run(double, 21)) == 42
+    assert worker.stats()['pending'] == 0
+
+
+def test_failed_submit_releases_slot(monkeypatch):
+    async def scenario():
+        worker = ImageWorker(processes=0, queue_size=1, timeout=5)
+        worker.start()
+
+        def broken_submit(func, *args):
+            raise RuntimeError('cannot schedule new futures after shutdown')
+
+        # Отказов больше, чем слотов и мест в очереди: занятый слот не дал бы пройти следующей задаче
+        with monkeypatch.context() as patch:
+            patch.setattr(worker, '_submit', broken_submit)
+            for _ in range(5):
+                with pytest.raises(HTTPException) as error:
+                    await worker.run(double, 1)
+                assert error.value.status_code == 503
+
+        assert worker.stats()['pending'] == 0
+        assert worker.failed == 5
+        assert await asyncio.wait_for(worker.run(double, 4), 1) == 8
+
+    asyncio.run(scenario())
+
+
+def test_timeout_recycles_pool():
+    async def scenario():
+        worker = ImageWorker(processes=1, queue_size=0, timeout=1)
+        try:
+            with pytest.raises(HTTPException) as error:
+                await worker.run(time.sleep, 60)
+            assert error.value.status_code == 504
+            assert worker.stats()['pending'] == 0
+
+            # Единственный процесс пула завис бы в sleep: без пересоздания пула следующая задача не дождалась бы слота
+            worker.timeout = 30
+            started_at = time.perf_counter()
+            assert await worker.run(double, 4) == 8
+            assert time.perf_counter() - started_at < 30
+            assert worker.timeouts == 1
+        finally:
+            await worker.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,43 @@
+from sqlalchemy import select
+
+from app import models
+from app import ip_collector
+from app.ip_collector import IpVisitBuffer
+
+
+def fail_flush(db, visits, ip_tags=None):
+    raise RuntimeError('database is unavailable')
+
+
+def test_failed_flush_returns_visits_to_buffer(db, monkeypatch):
+    buffer = IpVisitBuffer(max_retries=2)
+    buffer.add(None, '198.51.100.1')
+    buffer.add(None, '198.51.100.2')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(ip_collector, 'bulk_upsert_ip_visits', fail_flush)
+        buffer._write(buffer._take())
+
+    assert set(buffer._visits) == {(None, '198.51.100.1'), (None, '198.51.100.2')}
+    assert buffer.failed == 0
+
+    # Следующий сброс удался - посещения записаны, счетчики повторов очищены
+    buffer._write(buffer._take())
+
+    assert sorted(db.execute(select(models.IpAddress.ip)).scalars()) == ['198.51.100.1', '198.51.100.2']
+    assert buffer._retries == {}
+
+
+def test_visit_is_dropped_after_max_retries(monkeypatch):
+    buffer = IpVisitBuffer(max_retries=2)
+    buffer.add(None, '198.51.100.1')
+    monkeypatch.setattr(ip_collector, 'bulk_upsert_ip_visits', fail_flush)
+
+    for _ in range(2):
+        buffer._write(buffer._take())
+        assert list(buffer._visits) == [(None, '198.51.100.1')]
+
+    buffer._write(buffer._take())
+
+    assert buffer._visits == {}
+    assert buffer.failed == 1
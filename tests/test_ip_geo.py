@@ -0,0 +1,153 @@
+import gzip
+import os
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from sqlalchemy import select
+
+from app import models
+from app.ip_geo import IpGeo, IpRangeIndex, build_ip_range_index, read_ranges, tag_all_ip_addresses
+
+RANGES_PATH = Path(__file__).parent / 'data' / 'ip2asn.tsv'
+
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+    index_path = tmp_path_factory.mktemp('ip_geo') / 'ip2asn.tsv.idx'
+    build_ip_range_index(str(RANGES_PATH), str(index_path))
+    return IpRangeIndex(str(index_path))
+
+
+@pytest.fixture
+def loaded_geo(tmp_path):
+    source_path = tmp_path / 'ip2asn.tsv'
+    shutil.copy(RANGES_PATH, source_path)
+    geo = IpGeo(str(source_path))
+    geo.load()
+    return geo
+
+
+def test_read_ranges_skips_header_and_unrouted():
+    ranges = list(read_ranges(str(RANGES_PATH)))
+
+    assert len(ranges) == 7
+    assert all(asn != 0 for start, end, asn, country, as_name in ranges)
+
+
+def test_read_ranges_from_gzipped_csv(tmp_path):
+    source_path = tmp_path / 'ranges.csv.gz'
+    with gzip.open(source_path, 'wt') as file:
+        file.write('range_start,range_end,AS_number,country_code,AS_description\n')
+        file.write('8.8.8.0,8.8.8.255,AS15169,US,GOOGLE\n')
+        file.write('broken,row,1,US,X\n')
+
+    assert [(str(start), str(end), asn, country, as_name)
+            for start, end, asn, country, as_name in read_ranges(str(source_path))] == [
+        ('8.8.8.0', '8.8.8.255', 15169, 'US', 'GOOGLE')
+    ]
+
+
+def test_index_sizes(index):
+    assert len(index.v4_starts) == 4
+    assert len(index.v6_starts) == 3
+    assert len(index) == 7
+    # Повторяющиеся метки хранятся один раз
+    assert len(index.labels) == 6
+
+
+@pytest.mark.parametrize('ip, expected', [
+    ('1.0.0.0', ('US', 13335, 'CLOUDFLARENET')),
+    ('1.0.0.255', ('US', 13335, 'CLOUDFLARENET')),
+    ('1.0.5.10', ('AU', 38803, 'WPL-AS-AP Wirefreebroadband Pty Ltd')),
+    ('1.0.7.255', ('AU', 38803, 'WPL-AS-AP Wirefreebroadband Pty Ltd')),
+    ('8.8.8.8', ('US', 15169, 'GOOGLE')),
+    # Неанонсированный диапазон, промежуток между диапазонами, до первого и после последнего
+    ('1.0.2.1', None),
+    ('1.0.8.0', None),
+    ('0.255.255.255', None),
+    ('200.0.0.1', None),
+])
+def test_ipv4_lookup(index, ip, expected):
+    assert index.lookup(ip) == expected
+
+
+def test_ipv4_mapped_lookup_uses_ipv4_ranges(index):
+    assert index.lookup('::ffff:8.8.8.8') == ('US', 15169, 'GOOGLE')
+    assert index.lookup('::ffff:1.0.2.1') is None
+
+
+@pytest.mark.parametrize('ip, expected', [
+    ('2001:200::1', ('JP', 2500, 'WIDE-BB WIDE Project')),
+    ('2001:200:ffff:ffff:ffff:ffff:ffff:ffff', ('JP', 2500, 'WIDE-BB WIDE Project')),
+    # Диапазон ровно /64: младшие 64 бита не влияют, соседняя /64 уже не входит
+    ('2a00:1450:4000::1', ('IE', 15169, 'GOOGLE')),
+    ('2a00:1450:4000:0:ffff:ffff:ffff:ffff', ('IE', 15169, 'GOOGLE')),
+    ('2a00:1450:4000:1::1', None),
+    ('2a00:1450:3fff:ffff:ffff:ffff:ffff:ffff', None),
+    ('2a02:6b8:0:1::feed', ('RU', 13238, 'YANDEX')),
+    ('2001:db8::1', None),
+    ('::1', None),
+])
+def test_ipv6_lookup(index, ip, expected):
+    assert index.lookup(ip) == expected
+
+
+def test_index_file_is_rejected_without_magic(tmp_path):
+    path = tmp_path / 'bad.idx'
+    path.write_bytes(bytes(64))
+
+    with pytest.raises(ValueError):
+        IpRangeIndex(str(path))
+
+
+def test_load_builds_index_next_to_source(loaded_geo):
+    assert os.path.exists(f'{loaded_geo.source_path}.idx')
+    assert loaded_geo.stats()['loaded']
+    assert loaded_geo.asn_names[15169] == 'GOOGLE'
+
+
+def test_load_rebuilds_stale_index(loaded_geo):
+    index_path = f'{loaded_geo.source_path}.idx'
+    with open(loaded_geo.source_path, 'a') as file:
+        file.write('9.9.9.0\t9.9.9.255\t19281\tUS\tQUAD9\n')
+    stale = os.path.getmtime(index_path) - 10
+    os.utime(index_path, (stale, stale))
+
+    geo = IpGeo(loaded_geo.source_path)
+    geo.load()
+
+    assert geo.index.lookup('9.9.9.9') == ('US', 19281, 'QUAD9')
+
+
+def test_load_without_source_keeps_geo_disabled(tmp_path):
+    geo = IpGeo(str(tmp_path / 'missing.tsv'))
+    geo.load()
+
+    assert geo.tag(['8.8.8.8']) is None
+    assert not geo.stats()['loaded']
+
+
+def test_tag(loaded_geo):
+    assert loaded_geo.tag(['8.8.8.8', '1.0.2.1', 'not an ip']) == {
+        '8.8.8.8': ('US', 15169),
+        '1.0.2.1': (None, None),
+        'not an ip': (None, None),
+    }
+
+
+def test_tag_all_ip_addresses(db, loaded_geo, monkeypatch):
+    monkeypatch.setattr('app.ip_geo.ip_geo', loaded_geo)
+    monkeypatch.setattr('app.ip_geo.IP_GEO_BACKFILL_BATCH_SIZE', 2)
+    now = datetime.now(timezone.utc)
+    db.add_all([models.IpAddress(ip=ip, visited_at=now) for ip in ('8.8.8.8', '1.0.0.1', '200.0.0.1', '2a02:6b8::1')])
+    db.commit()
+
+    assert tag_all_ip_addresses() == 4
+
+    db.expire_all()
+    assert dict(db.execute(select(models.IpAddress.ip, models.IpAddress.country)).all()) == {
+        '8.8.8.8': 'US', '1.0.0.1': 'US', '200.0.0.1': None, '2a02:6b8::1': 'RU'
+    }
+    assert dict(db.execute(select(models.IpAddress.ip, models.IpAddress.asn)).all())['2a02:6b8::1'] == 13238
@@ -0,0 +1,74 @@
+import ipaddress
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import models
+from app.crud import bulk_upsert_ip_visits
+from app.ip_types import IpAddressType, normalize_ip, ip_to_bytes, ip_from_bytes, get_network_range
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1.2.3.4', '1.2.3.4'),
+    (' 1.2.3.4 ', '1.2.3.4'),
+    ('::ffff:1.2.3.4', '1.2.3.4'),
+    ('::1.2.3.4', '::102:304'),
+    ('2001:DB8::1', '2001:db8::1'),
+    ('testclient', None),
+    ('', None),
+    (None, None),
+])
+def test_normalize_ip(value, expected):
+    assert normalize_ip(value) == expected
+
+
+@pytest.mark.parametrize('ip', ['1.2.3.4', '::102:304', '::1', '2001:db8::1', '255.255.255.255'])
+def test_bytes_round_trip(ip):
+    assert len(ip_to_bytes(ip)) == 16
+    assert ip_from_bytes(ip_to_bytes(ip)) == ip
+
+
+@pytest.mark.parametrize('ip', ['::1.2.3.4', '::ffff:1.2.3.4', '1.2.3.4', '2001:db8::1'])
+def test_sqlite_type_round_trip_is_normalized(ip):
+    column_type = IpAddressType()
+    dialect = sqlite.dialect()
+
+    assert column_type.process_result_value(column_type.process_bind_param(ip, dialect), dialect) == normalize_ip(ip)
+
+
+@pytest.mark.parametrize('value, expected', [
+    # Postgres печатает адреса из ::/96 через точки, psycopg2 отдает этот текст как есть
+    ('::1.2.3.4', '::102:304'),
+    ('1.2.3.4', '1.2.3.4'),
+    ('2001:db8::1', '2001:db8::1'),
+    # asyncpg отдает объекты ipaddress
+    (ipaddress.ip_address('::1.2.3.4'), '::102:304'),
+    (ipaddress.ip_address('1.2.3.4'), '1.2.3.4'),
+])
+def test_postgres_result_matches_normalized_key(value, expected):
+    assert IpAddressType().process_result_value(value, postgresql.dialect()) == expected
+
+
+def test_ipv4_compatible_address_flushes_with_user(db):
+    user = models.User(username='visitor')
+    db.add(user)
+    db.commit()
+    user_id = user.id
+    ip = normalize_ip('::1.2.3.4')
+    now = datetime.now(timezone.utc)
+
+    bulk_upsert_ip_visits(db, {(user_id, ip): now, (None, '1.2.3.4'): now})
+
+    assert sorted(db.execute(select(models.IpAddress.ip)).scalars()) == ['1.2.3.4', '::102:304']
+    linked = db.execute(
+        select(models.IpAddress.ip).join(models.user_ip).where(models.user_ip.c.user_id == user_id)
+    ).scalars().all()
+    assert linked == [ip]
+
+
+def test_network_range_unmaps_ipv4_mapped_networks():
+    assert get_network_range('10.0.0.0/24') == ('10.0.0.0', '10.0.0.255')
+    assert get_network_range('::ffff:10.0.0.0/120') == ('10.0.0.0', '10.0.0.255')
+    assert get_network_range('2001:db8::/126') == ('2001:db8::', '2001:db8::3')
@@ -0,0 +1,98 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from app import models
+from app.crud import add_ip_to_user, bulk_upsert_ip_visits
+
+
+def create_user(db, username: str = 'visitor') -> str:
+    user = models.User(username=username)
+    db.add(user)
+    db.commit()
+    # id читается до замера: после коммита объект просрочен, и обращение к нему - лишний SELECT
+    return user.id
+
+
+def expected_round_trips(db) -> int:
+    # В Postgres ip и связь пишутся одним запросом через CTE, SQLite не умеет INSERT внутри CTE
+    return 1 if db.get_bind().dialect.name == 'postgresql' else 2
+
+
+def test_add_ip_to_user_round_trips(db, count_queries):
+    user_id = create_user(db)
+
+    with count_queries() as queries:
+        visited_at = add_ip_to_user(db, user_id, '203.0.113.7')
+
+    assert len(queries) == expected_round_trips(db)
+    # Коммитит DbSessionMiddleware в конце запроса, сама функция только пишет
+    assert queries.commits == 0
+    assert visited_at is not None
+
+
+def test_add_ip_to_user_repeated_visit_round_trips(db, count_queries):
+    user_id = create_user(db)
+    first = add_ip_to_user(db, user_id, '203.0.113.7')
+    db.commit()
+
+    with count_queries() as queries:
+        second = add_ip_to_user(db, user_id, '203.0.113.7')
+
+    assert len(queries) == expected_round_trips(db)
+    assert queries.commits == 0
+    assert second >= first
+    assert db.execute(select(models.user_ip.c.ip_address_id)).all() == db.execute(select(models.IpAddress.id)).all()
+
+
+def test_add_ip_to_user_skips_non_ip(db, count_queries):
+    user_id = create_user(db)
+
+    with count_queries() as queries:
+        assert add_ip_to_user(db, user_id, 'testclient') is None
+
+    assert len(queries) == 0
+
+
+def test_bulk_upsert_single_visit_round_trips(db, count_queries):
+    user_id = create_user(db)
+    visits = {(user_id, '198.51.100.1'): datetime.now(timezone.utc)}
+
+    with count_queries() as queries:
+        bulk_upsert_ip_visits(db, visits)
+
+    # Один upsert в ip_addresses и один в user_ip при любом размере батча
+    assert len(queries) == 2
+    assert queries.commits == 1
+
+
+def test_bulk_upsert_round_trips_do_not_grow_with_batch(db, count_queries):
+    user_ids = [create_user(db, f'visitor_{index}') for index in range(5)]
+    now = datetime.now(timezone.utc)
+    visits = {(user_id, f'198.51.100.{index}'): now for index in range(20) for user_id in user_ids}
+    visits.update({(None, f'192.0.2.{index}'): now for index in range(20)})
+
+    with count_queries() as queries:
+        bulk_upsert_ip_visits(db, visits)
+
+    assert len(queries) == 2
+    assert queries.commits == 1
+    assert len(db.execute(select(models.IpAddress.id)).all()) == 40
+    assert len(db.execute(select(models.user_ip.c.user_id)).all()) == 100
+
+
+def test_bulk_upsert_splits_large_buffer_into_chunks(db, count_queries):
+    # Полный буфер по умолчанию (IP_BUFFER_MAX_SIZE): одним VALUES это больше 32766 параметров SQLite
+    user_ids = [create_user(db, f'visitor_{index}') for index in range(4)]
+    now = datetime.now(timezone.utc)
+    visits = {(None, f'10.{index >> 16}.{index >> 8 & 255}.{index & 255}'): now for index in range(8000)}
+    visits.update({(user_id, f'10.0.{index >> 8}.{index & 255}'): now for user_id in user_ids for index in range(500)})
+
+    with count_queries() as queries:
+        bulk_upsert_ip_visits(db, visits)
+
+    # 8000 ip и 2000 связей по 1000 строк за запрос
+    assert len(queries) == 8 + 2
+    assert queries.commits == 1
+    assert len(db.execute(select(models.IpAddress.id)).all()) == 8000
+    assert len(db.execute(select(models.user_ip.c.user_id)).all()) == 2000
@@ -0,0 +1,38 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.middlewares import ADMIN_SEED_BODY_LIMIT, is_admin_path
+
+client = TestClient(app)
+
+
+def test_admin_paths_match_by_prefix():
+    assert is_admin_path('/admin')
+    assert is_admin_path('/admin/quest/list')
+    assert is_admin_path('/auth/admin/token')
+    assert not is_admin_path('/administrator')
+    assert not is_admin_path('/quests/admin')
+
+
+def test_admin_post_without_seed_is_hidden(db):
+    response = client.post('/auth/admin/token', json={'username': 'admin', 'password': 'admin'})
+
+    assert response.status_code == 404
+
+
+def test_admin_post_body_is_replayed_to_route(db):
+    # Middleware прочитала тело ради seed, роут логина должен получить его целиком
+    response = client.post('/auth/admin/token',
+                           json={'seed': 'test-seed', 'username': 'nobody', 'password': 'wrong'})
+
+    assert response.status_code == 401
+
+
+def test_admin_post_over_limit_is_rejected(db):
+    body = json.dumps({'username': 'admin', 'password': 'x' * ADMIN_SEED_BODY_LIMIT, 'seed': 'test-seed'})
+
+    response = client.post('/auth/admin/token', content=body, headers={'Content-Type': 'application/json'})
+
+    assert response.status_code == 413
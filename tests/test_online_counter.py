@@ -0,0 +1,16 @@
+from datetime import datetime, timedelta, timezone
+
+from app.online_counter import OnlineCounter, get_hour_start
+
+
+def test_rolling_window_covers_full_24_hours():
+    counter = OnlineCounter(cache_seconds=0)
+    now = datetime.now(timezone.utc)
+    # Посещение ровно 24 часа назад лежит в часе current_hour - 24h и должно попасть в окно
+    counter.add_visits({
+        (None, '10.0.0.1'): now - timedelta(hours=24),
+        (None, '10.0.0.2'): now,
+        (None, '10.0.0.3'): get_hour_start(now) - timedelta(hours=25),
+    })
+
+    assert counter.count('rolling') == 2
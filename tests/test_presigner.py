@@ -0,0 +1,70 @@
+from datetime import datetime, timezone
+from unittest import mock
+from urllib.parse import urlsplit, parse_qs
+
+import botocore.session
+import pytest
+from botocore.config import Config
+
+from s3_manager.presigner import S3Presigner
+
+ACCESS_KEY = 'AKIDEXAMPLE'
+SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+BUCKET = 'test-bucket'
+SIGNED_AT = datetime(2024, 7, 15, 12, 30, 45, tzinfo=timezone.utc)
+
+KEYS = [
+    'avatars/user.png',
+    'images/5f/5fa0a96c1e.webp',
+    'quests/my image (1).jpg',
+    'tasks/a+b=c&d.png',
+    'chains/~tilde/under_score-dash.png',
+    'projects/логотип проекта.png',
+    'docs/file%20name.pdf',
+]
+
+
+def botocore_presigned_url(region: str, key: str, expiration: int) -> str:
+    client = botocore.session.get_session().create_client(
+        's3', region_name=region, aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY,
+        config=Config(signature_version='s3v4')
+    )
+    # botocore берет время подписи из datetime.utcnow()
+    with mock.patch('botocore.auth.datetime') as frozen_datetime:
+        frozen_datetime.datetime.utcnow.return_value = SIGNED_AT.replace(tzinfo=None)
+        return client.generate_presigned_url(
+            'get_object', Params={'Bucket': BUCKET, 'Key': key}, ExpiresIn=expiration
+        )
+
+
+@pytest.mark.parametrize('region', ['us-east-1', 'eu-central-1'])
+@pytest.mark.parametrize('key', KEYS)
+def test_sign_matches_botocore(region, key):
+    presigner = S3Presigner(ACCESS_KEY, SECRET_KEY, region, BUCKET, f'{BUCKET}.s3.amazonaws.com')
+
+    assert presigner.sign(key, 3600, SIGNED_AT) == botocore_presigned_url(region, key, 3600)
+
+
+def test_presign_is_stable_within_time_bucket():
+    presigner = S3Presigner(ACCESS_KEY, SECRET_KEY, 'eu-central-1', BUCKET, f'{BUCKET}.s3.amazonaws.com',
+                            bucket_seconds=60)
+
+    minute_start = SIGNED_AT.replace(second=0).timestamp()
+    with mock.patch('s3_manager.presigner.time.time', return_value=minute_start + 5):
+        first = presigner.presign('avatars/user.png', 600)
+    with mock.patch('s3_manager.presigner.time.time', return_value=minute_start + 59):
+        second = presigner.presign('avatars/user.png', 600)
+    with mock.patch('s3_manager.presigner.time.time', return_value=minute_start + 65):
+        third = presigner.presign('avatars/user.png', 600)
+
+    assert first == second
+    assert third != first
+
+    query = parse_qs(urlsplit(first).query)
+    # Дата подписи - начало интервала, срок жизни продлен на длину интервала
+    assert query['X-Amz-Date'] == ['20240715T123000Z']
+    assert query['X-Amz-Expires'] == ['660']
+
+
+def test_presign_without_credentials():
+    assert S3Presigner('', '', 'eu-central-1', BUCKET, f'{BUCKET}.s3.amazonaws.com').presign('a.png') is None
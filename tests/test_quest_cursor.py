@@ -0,0 +1,85 @@
+import importlib.util
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, inspect, insert, text
+from sqlalchemy.exc import IntegrityError
+
+from app import models
+from app.main import app
+
+client = TestClient(app)
+
+MIGRATION_PATH = (Path(__file__).parent.parent / 'alembic' / 'versions'
+                  / '4f8b2c6d1e3a_make_quests_created_at_not_null.py')
+
+
+def load_migration():
+    spec = importlib.util.spec_from_file_location('make_quests_created_at_not_null', MIGRATION_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_migration(connection, step: str):
+    with Operations.context(MigrationContext.configure(connection)):
+        getattr(load_migration(), step)()
+
+
+def test_migration_backfills_null_created_at(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/migration.db')
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE quests (id INTEGER PRIMARY KEY, title VARCHAR(70), created_at DATETIME)'))
+        connection.execute(text('CREATE INDEX ix_quests_created_at_id ON quests (created_at, id)'))
+        connection.execute(text("INSERT INTO quests (id, title, created_at) VALUES "
+                                "(1, 'dated', '2024-07-01 00:00:00.000000'), (2, 'undated', NULL)"))
+
+        run_migration(connection, 'upgrade')
+
+        assert connection.execute(text('SELECT count(*) FROM quests WHERE created_at IS NULL')).scalar() == 0
+        assert connection.execute(text('SELECT created_at FROM quests WHERE id = 1')).scalar().startswith('2024-07-01')
+        columns = {column['name']: column for column in inspect(connection).get_columns('quests')}
+        assert not columns['created_at']['nullable']
+        assert 'ix_quests_created_at_id' in {index['name'] for index in inspect(connection).get_indexes('quests')}
+
+        run_migration(connection, 'downgrade')
+
+        columns = {column['name']: column for column in inspect(connection).get_columns('quests')}
+        assert columns['created_at']['nullable']
+    engine.dispose()
+
+
+def test_quest_without_created_at_is_rejected(db):
+    # ORM подставляет значение по умолчанию, NULL может прийти только прямым INSERT
+    with pytest.raises(IntegrityError):
+        db.execute(insert(models.Quest).values(title='undated', description='description',
+                                               filepath='image/quest/default.jpeg', created_at=None))
+
+
+@pytest.mark.parametrize('filter', [None, 'new'])
+def test_cursor_pages_cover_every_quest_once(db, filter):
+    base = datetime(2024, 7, 1, tzinfo=timezone.utc)
+    # Одинаковые даты (стандартное значение модели) и дата-заглушка из миграции для старых квестов без даты
+    dates = [base, base, base + timedelta(hours=1), datetime(1970, 1, 1, tzinfo=timezone.utc), base, base]
+    db.add_all([models.Quest(title=f'Quest {index}', description='description', created_at=created_at)
+                for index, created_at in enumerate(dates)])
+    db.commit()
+
+    seen = []
+    url = '/quests/cursor?size=2' + (f'&filter={filter}' if filter else '')
+    cursor = None
+    while True:
+        response = client.get(url + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200, response.text
+        page = response.json()
+        seen.extend(item['title'] for item in page['items'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    assert sorted(seen) == sorted(f'Quest {index}' for index in range(len(dates)))
+    assert (seen[0] if filter is None else seen[-1]) == 'Quest 3'
@@ -0,0 +1,60 @@
+import pytest
+from fastapi.testclient import TestClient
+from fastapi_pagination import add_pagination
+
+from app import models
+from app.main import app
+
+# Без with: фоновые задачи из startup сами ходят в БД и сбивали бы подсчет запросов.
+# Роуты подключаются после add_pagination, которую библиотека повторяет в startup, поэтому здесь вручную
+add_pagination(app)
+client = TestClient(app)
+
+
+def create_quests(db, quests: int, tasks_per_quest: int, prefix: str = '') -> list[int]:
+    quest_ids = []
+    for index in range(quests):
+        # У каждого квеста своя сеть и проект, чтобы страница не могла обойтись одной загрузкой
+        quest = models.Quest(
+            title=f'Quest {index}', description='description',
+            chain=models.Chain(name=f'{prefix}Chain {index}'), project=models.Project(name=f'{prefix}Project {index}'),
+            tasks=[models.Task(title=f'Task {task}', description='description', button_link='https://example.com')
+                   for task in range(tasks_per_quest)]
+        )
+        db.add(quest)
+        db.flush()
+        quest_ids.append(quest.id)
+    db.commit()
+    return quest_ids
+
+
+def get_counted(count_queries, url: str):
+    with count_queries() as queries:
+        response = client.get(url)
+    assert response.status_code == 200, response.text
+    return response.json(), len(queries)
+
+
+def test_quest_detail_query_count_does_not_depend_on_tasks(db, count_queries):
+    one_task, many_tasks = create_quests(db, 1, 1, 'a') + create_quests(db, 1, 15, 'b')
+
+    quest, one_task_queries = get_counted(count_queries, f'/quest/{one_task}')
+    assert len(quest['tasks']) == 1
+    quest, many_tasks_queries = get_counted(count_queries, f'/quest/{many_tasks}')
+    assert len(quest['tasks']) == 15
+    assert quest['chain_name'] and quest['project_name']
+
+    assert many_tasks_queries == one_task_queries
+
+
+@pytest.mark.parametrize('url', ['/quests?size={size}', '/quests/cursor?size={size}'])
+def test_quest_page_query_count_does_not_depend_on_page_size(db, count_queries, url):
+    create_quests(db, 12, 3)
+
+    page, small_page_queries = get_counted(count_queries, url.format(size=1))
+    assert len(page['items']) == 1
+    page, large_page_queries = get_counted(count_queries, url.format(size=10))
+    assert len(page['items']) == 10
+    assert all(item['task_count'] == 3 and item['chain_name'] and item['project_name'] for item in page['items'])
+
+    assert large_page_queries == small_page_queries